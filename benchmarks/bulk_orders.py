@@ -0,0 +1,75 @@
+"""
+Measures order ingestion in orders per second through POST /api/v1/users/orders/bulk as the
+number of orders per request grows, against the database specified by the DATABASE_URL
+environment variable. For comparison it also places the same orders one request at a time through
+POST /api/v1/users/orders. Requests go through the Flask test client, so JSON parsing and
+validation are included but no network is.
+
+Run from the repository root with: python -m benchmarks.bulk_orders [--orders N]
+"""
+import argparse, os, time
+import psycopg2
+from flask_jwt_extended import create_access_token
+from fastfoodfast import app
+from .serving_modes import ensure_menu
+
+CUSTOMER = 'benchmark customer'
+BATCH_SIZES = [1, 10, 100, 1000]
+
+
+def make_order():
+    return {'items': [{'item': 'benchmark chips', 'quantity': 2} for _ in range(3)]}
+
+
+def time_bulk(client, headers, batch_size, order_count):
+    """Returns the orders per second stored by bulk requests of <batch_size> orders each"""
+    started = time.perf_counter()
+    for _ in range(max(order_count // batch_size, 1)):
+        orders = [make_order() for _ in range(batch_size)]
+        response = client.post('/api/v1/users/orders/bulk', json={'orders': orders}, headers=headers)
+        assert response.status_code == 201, response.get_json()
+    return max(order_count // batch_size, 1) * batch_size / (time.perf_counter() - started)
+
+
+def time_single(client, headers, order_count):
+    """Returns the orders per second stored by one request per order"""
+    started = time.perf_counter()
+    for _ in range(order_count):
+        response = client.post('/api/v1/users/orders', json=make_order(), headers=headers)
+        assert response.status_code == 201, response.get_json()
+    return order_count / (time.perf_counter() - started)
+
+
+def clean_orders(conn):
+    cursor = conn.cursor()
+    cursor.execute(
+        'DELETE FROM order_items WHERE order_id IN (SELECT id FROM orders WHERE customer = %s)',
+        (CUSTOMER, )
+    )
+    cursor.execute('DELETE FROM orders WHERE customer = %s', (CUSTOMER, ))
+    conn.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--orders', type=int, default=2000, help='orders placed per batch size')
+    arguments = parser.parse_args()
+    client = app.test_client()
+    with app.app_context():
+        headers = {'Authorization': 'Bearer ' + create_access_token(identity=CUSTOMER)}
+    conn = psycopg2.connect(os.getenv('DATABASE_URL'))
+    ensure_menu(conn) # orders are priced from the menu
+    try:
+        single = time_single(client, headers, min(arguments.orders, 500))
+        print('one order per request: {:.1f} orders/s'.format(single))
+        print('{:>12} {:>12} {:>10}'.format('batch size', 'orders/s', 'speedup'))
+        for batch_size in BATCH_SIZES:
+            rate = time_bulk(client, headers, batch_size, arguments.orders)
+            print('{:>12} {:>12.1f} {:>9.1f}x'.format(batch_size, rate, rate / single))
+    finally:
+        clean_orders(conn)
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
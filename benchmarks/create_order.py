@@ -0,0 +1,84 @@
+"""
+Measures how many orders per second Orders.create_order stores as the number of items per order
+grows, against the database specified by the DATABASE_URL environment variable. For comparison it
+also times the previous strategy of one INSERT per item after re-selecting the order's id.
+
+Run from the repository root with: python -m benchmarks.create_order [--orders N]
+"""
+import argparse, os, time, uuid
+import psycopg2
+from fastfoodfast.models import Orders
+from .serving_modes import ensure_menu
+
+CUSTOMER = 'benchmark customer'
+ITEM_COUNTS = [1, 5, 10, 20, 50, 100]
+
+
+def make_order(item_count):
+    return {
+        'items': [{'item': 'benchmark chips', 'quantity': 2, 'cost': 8000} for _ in range(item_count)]
+    }
+
+
+def legacy_create_order(cursor, order, customer):
+    """The statements create_order used to issue: 2 for the order, then one per item"""
+    order_id = str(uuid.uuid4())[:8]
+    total_cost = sum(float(item['cost']) for item in order['items'])
+    cursor.execute(
+        'INSERT INTO orders (public_id, customer, status, total_cost) VALUES (%s, %s, %s, %s)',
+        (order_id, customer, 'new', total_cost)
+    )
+    cursor.execute('SELECT id FROM orders WHERE public_id = %s', (order_id, ))
+    primary_key = cursor.fetchone()[0]
+    for item in order['items']:
+        cursor.execute(
+            'INSERT INTO order_items (order_id, item, quantity, cost) VALUES (%s, %s, %s, %s)',
+            (primary_key, item['item'], item['quantity'], item['cost'])
+        )
+
+
+def time_orders(create, item_count, order_count):
+    """Returns the orders per second achieved by calling create once per order"""
+    started = time.perf_counter()
+    for _ in range(order_count):
+        create(make_order(item_count))
+    return order_count / (time.perf_counter() - started)
+
+
+def clean_orders(conn):
+    cursor = conn.cursor()
+    cursor.execute(
+        'DELETE FROM order_items WHERE order_id IN (SELECT id FROM orders WHERE customer = %s)',
+        (CUSTOMER, )
+    )
+    cursor.execute('DELETE FROM orders WHERE customer = %s', (CUSTOMER, ))
+    conn.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--orders', type=int, default=200, help='orders created per item count')
+    arguments = parser.parse_args()
+    orders_model = Orders()
+    conn = psycopg2.connect(os.getenv('DATABASE_URL'))
+    ensure_menu(conn) # orders are priced from the menu
+
+    def create_legacy(order):
+        with conn:
+            legacy_create_order(conn.cursor(), order, CUSTOMER)
+
+    print('{:>6} {:>16} {:>16}'.format('items', 'orders/s', 'legacy orders/s'))
+    try:
+        for item_count in ITEM_COUNTS:
+            rate = time_orders(
+                lambda order: orders_model.create_order(order, CUSTOMER), item_count, arguments.orders
+            )
+            legacy_rate = time_orders(create_legacy, item_count, arguments.orders)
+            print('{:>6} {:>16.1f} {:>16.1f}'.format(item_count, rate, legacy_rate))
+    finally:
+        clean_orders(conn)
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
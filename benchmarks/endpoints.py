@@ -0,0 +1,387 @@
+"""
+Load-tests every route of the API against the database specified by the DATABASE_URL environment
+variable, through the Flask test client (no network) and over HTTP to a gunicorn server started on
+a local port. Each route is driven by concurrent clients, reporting throughput, latency percentiles
+and, through the test client, the database statements executed per request, as counted by the
+request metrics.
+
+With STORAGE_BACKEND=memory, the test client runs the API on the in-memory storage backend, which
+profiles the API logic apart from the database; HTTP servers would each have a store of their own,
+so only the client transport is available then.
+
+Results can be saved as JSON and compared with a saved baseline, flagging routes whose throughput
+dropped or whose p95 latency grew by more than a tolerance; the script then exits with status 1.
+
+Run from the repository root with:
+
+    python -m benchmarks.endpoints [--concurrency 1 8] [--output results.json]
+                                   [--baseline baseline.json]
+"""
+import argparse, json, os, platform, random, string, threading, time
+from collections import namedtuple
+from http.client import HTTPConnection
+import psycopg2
+from flask_jwt_extended import create_access_token
+from fastfoodfast import app, ingestion
+from fastfoodfast.models import Users, Orders, Menu
+from fastfoodfast.metrics import metrics
+from fastfoodfast.storage import get_storage
+from .serving_modes import HOST, PORT, start_server
+
+PREFIX = 'zzbench endpoints' # benchmark users, orders and menu items are removed by this prefix
+PASSWORD = 'B3nchmark'
+Request = namedtuple('Request', 'method path body headers')
+
+
+def random_name():
+    return PREFIX + ' ' + ''.join(random.choice(string.ascii_lowercase) for _ in range(12))
+
+
+class Fixture:
+    """The users, order and menu items that the scenarios' requests refer to"""
+    def __init__(self, conn=None):
+        self.conn = conn # to clean up with, unless the data is kept in memory
+        self.customer = random_name()
+        Users().register_user({
+            'username': self.customer, 'password': PASSWORD,
+            'email': 'bench@mail.com', 'telephone': '+256-700-000000'
+        })
+        with app.app_context():
+            self.customer_headers = self.authorization(self.customer, False)
+            self.admin_headers = self.authorization('admin', True)
+        # orders are priced from the menu, so they are for an item of the fixture's own
+        dish = Menu().add_menu_item({'item': random_name(), 'unit': 'plate', 'rate': 2000})
+        self.order = {'items': [{'item': dish['item'], 'quantity': 2}]}
+        self.order_id = self.insert_orders(1)[0]
+        self.menu_item_id = self.insert_menu_items(1)[0]
+
+    @staticmethod
+    def authorization(identity, admin):
+        token = create_access_token(identity=identity, user_claims={'admin': admin})
+        return {'Authorization': 'Bearer ' + token}
+
+    def insert_orders(self, count):
+        results = Orders().create_orders([self.order] * count, self.customer)
+        self.flush_order_queue()
+        return [result['order']['order-id'] for result in results]
+
+    @staticmethod
+    def flush_order_queue():
+        """Stores the orders queued by this process, if ORDER_QUEUE_DIR queues them"""
+        if ingestion.order_queue is not None:
+            ingestion.order_queue.flush()
+
+    def insert_menu_items(self, count):
+        return [
+            Menu().add_menu_item({'item': random_name(), 'unit': 'plate', 'rate': 4000})['id']
+            for _ in range(count)
+        ]
+
+    def clean(self):
+        self.flush_order_queue()
+        if self.conn is None:
+            return
+        cursor = self.conn.cursor()
+        cursor.execute(
+            'DELETE FROM order_items WHERE order_id IN'
+            ' (SELECT id FROM orders WHERE customer LIKE %s)', (PREFIX + '%', )
+        )
+        cursor.execute('DELETE FROM orders WHERE customer LIKE %s', (PREFIX + '%', ))
+        cursor.execute('DELETE FROM menu WHERE item LIKE %s', (PREFIX + '%', ))
+        cursor.execute('DELETE FROM users WHERE username LIKE %s', (PREFIX + '%', ))
+        self.conn.commit()
+
+
+def signup(fixture, count):
+    return [
+        Request('POST', '/api/v1/auth/signup', {
+            'username': random_name(), 'password': PASSWORD,
+            'email': 'bench@mail.com', 'telephone': '+256-700-000000'
+        }, {})
+        for _ in range(count)
+    ]
+
+
+def login(fixture, count):
+    credentials = {'username': fixture.customer, 'password': PASSWORD}
+    return [Request('POST', '/api/v1/auth/login', credentials, {})] * count
+
+
+def place_order(fixture, count):
+    request = Request('POST', '/api/v1/users/orders', fixture.order, fixture.customer_headers)
+    return [request] * count
+
+
+def place_bulk_orders(fixture, count):
+    orders = {'orders': [fixture.order] * 10}
+    return [Request('POST', '/api/v1/users/orders/bulk', orders, fixture.customer_headers)] * count
+
+
+def order_history(fixture, count):
+    return [Request('GET', '/api/v1/users/orders', None, fixture.customer_headers)] * count
+
+
+def all_orders(fixture, count):
+    return [Request('GET', '/api/v1/orders', None, fixture.admin_headers)] * count
+
+
+def get_order(fixture, count):
+    path = '/api/v1/orders/{}'.format(fixture.order_id)
+    return [Request('GET', path, None, fixture.admin_headers)] * count
+
+
+def update_status(fixture, count):
+    """Each request changes the status of an order of its own"""
+    return [
+        Request('PUT', '/api/v1/orders/{}'.format(order_id), {'status': 'processing'},
+                fixture.admin_headers)
+        for order_id in fixture.insert_orders(count)
+    ]
+
+
+def update_bulk_status(fixture, count):
+    """Each request changes the status of 10 orders of its own"""
+    order_ids = fixture.insert_orders(count * 10)
+    return [
+        Request('PUT', '/api/v1/orders/status',
+                {'status': 'processing', 'order-ids': order_ids[start:start + 10]},
+                fixture.admin_headers)
+        for start in range(0, count * 10, 10)
+    ]
+
+
+def sales_report(fixture, count):
+    return [Request('GET', '/api/v1/stats/sales', None, fixture.admin_headers)] * count
+
+
+def read_menu(fixture, count):
+    return [Request('GET', '/api/v1/menu', None, fixture.customer_headers)] * count
+
+
+def get_menu_item(fixture, count):
+    path = '/api/v1/menu/{}'.format(fixture.menu_item_id)
+    return [Request('GET', path, None, fixture.customer_headers)] * count
+
+
+def add_menu_item(fixture, count):
+    return [
+        Request('POST', '/api/v1/menu', {'item': random_name(), 'unit': 'plate', 'rate': 4000},
+                fixture.admin_headers)
+        for _ in range(count)
+    ]
+
+
+def edit_menu_item(fixture, count):
+    path = '/api/v1/menu/{}'.format(fixture.menu_item_id)
+    return [
+        Request('PUT', path, {'item': random_name(), 'unit': 'plate', 'rate': 4000},
+                fixture.admin_headers)
+        for _ in range(count)
+    ]
+
+
+def delete_menu_item(fixture, count):
+    """Each request deletes a menu item of its own"""
+    return [
+        Request('DELETE', '/api/v1/menu/{}'.format(identity), None, fixture.admin_headers)
+        for identity in fixture.insert_menu_items(count)
+    ]
+
+
+SCENARIOS = {
+    'signup': signup, 'login': login, 'place-order': place_order,
+    'place-bulk-orders': place_bulk_orders, 'order-history': order_history,
+    'all-orders': all_orders, 'get-order': get_order, 'update-status': update_status,
+    'update-bulk-status': update_bulk_status, 'sales-report': sales_report,
+    'read-menu': read_menu, 'get-menu-item': get_menu_item, 'add-menu-item': add_menu_item,
+    'edit-menu-item': edit_menu_item, 'delete-menu-item': delete_menu_item
+}
+
+
+def client_sender():
+    """Returns a function sending a request through a Flask test client, returning its status"""
+    client = app.test_client()
+
+    def send(request):
+        return client.open(
+            request.path, method=request.method, json=request.body, headers=request.headers
+        ).status_code
+    return send
+
+
+def http_sender():
+    """Returns a function sending a request over a keep-alive HTTP connection"""
+    connection = HTTPConnection(HOST, PORT)
+
+    def send(request):
+        headers = dict(request.headers)
+        body = None
+        if request.body is not None:
+            body = json.dumps(request.body)
+            headers['Content-Type'] = 'application/json'
+        connection.request(request.method, request.path, body, headers)
+        response = connection.getresponse()
+        response.read()
+        return response.status
+    return send
+
+
+def run_load(make_sender, requests, concurrency):
+    """
+    Sends <requests> from <concurrency> threads, each with a sender of its own. Returns the
+    elapsed seconds, the latency of each request and the statuses of failed ones.
+    """
+    pending = iter(requests)
+    lock = threading.Lock()
+    latencies, errors = list(), list()
+
+    def worker():
+        send = make_sender()
+        while True:
+            with lock:
+                request = next(pending, None)
+            if request is None:
+                return
+            started = time.perf_counter()
+            status = send(request)
+            latency = time.perf_counter() - started
+            with lock:
+                latencies.append(latency)
+                if status >= 400:
+                    errors.append(status)
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - started, latencies, errors
+
+
+def percentile(latencies, fraction):
+    return sorted(latencies)[min(int(len(latencies) * fraction), len(latencies) - 1)] * 1000
+
+
+def measure(transport, make_sender, fixture, scenario, concurrency, count, warmup, counted):
+    run_load(make_sender, SCENARIOS[scenario](fixture, warmup), concurrency)
+    requests = SCENARIOS[scenario](fixture, count)
+    statements = metrics.statement_count()
+    elapsed, latencies, errors = run_load(make_sender, requests, concurrency)
+    return {
+        'transport': transport, 'scenario': scenario, 'concurrency': concurrency,
+        'requests': len(latencies), 'errors': len(errors),
+        'throughput': round(len(latencies) / elapsed, 1),
+        'p50-ms': round(percentile(latencies, 0.5), 2),
+        'p95-ms': round(percentile(latencies, 0.95), 2),
+        'p99-ms': round(percentile(latencies, 0.99), 2),
+        # the server's statements are not visible to this process
+        'queries-per-request': round((metrics.statement_count() - statements) / len(latencies), 2)
+        if counted and transport == 'client' else None
+    }
+
+
+def key(result):
+    return result['transport'], result['scenario'], result['concurrency']
+
+
+def regressions(results, baseline, tolerance):
+    """Returns a description of each result that is more than <tolerance> worse than baseline"""
+    previous = {key(result): result for result in baseline['results']}
+    found = list()
+    for result in results:
+        before = previous.get(key(result))
+        if before is None:
+            continue
+        if result['throughput'] < before['throughput'] * (1 - tolerance):
+            found.append('{} {} x{}: throughput {} -> {} req/s'.format(
+                *key(result), before['throughput'], result['throughput']
+            ))
+        if result['p95-ms'] > before['p95-ms'] * (1 + tolerance):
+            found.append('{} {} x{}: p95 {} -> {} ms'.format(
+                *key(result), before['p95-ms'], result['p95-ms']
+            ))
+        if (result['queries-per-request'] or 0) > (before['queries-per-request'] or 0):
+            found.append('{} {} x{}: queries per request {} -> {}'.format(
+                *key(result), before['queries-per-request'], result['queries-per-request']
+            ))
+    return found
+
+
+def print_result(result):
+    queries = result['queries-per-request']
+    print('{:>9} {:>18} {:>5} {:>10.1f} {:>9.2f} {:>9.2f} {:>9.2f} {:>8} {:>7}'.format(
+        result['transport'], result['scenario'], result['concurrency'], result['throughput'],
+        result['p50-ms'], result['p95-ms'], result['p99-ms'],
+        '-' if queries is None else queries, result['errors']
+    ))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--scenarios', nargs='+', choices=list(SCENARIOS), default=list(SCENARIOS))
+    parser.add_argument('--transports', nargs='+', choices=['client', 'http'],
+                        default=['client', 'http'])
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 8])
+    parser.add_argument('--requests', type=int, default=200, help='timed requests per run')
+    parser.add_argument('--warmup', type=int, default=10, help='untimed requests before each run')
+    parser.add_argument('--mode', choices=['wsgi', 'asgi'], default='wsgi',
+                        help='serving mode of the HTTP server')
+    parser.add_argument('--workers', type=int, default=2, help='HTTP server processes')
+    parser.add_argument('--threads', type=int, default=4, help='threads per gunicorn worker')
+    parser.add_argument('--output', help='file to save the results to as JSON')
+    parser.add_argument('--baseline', help='results saved by an earlier run to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='fraction by which a result may be worse than the baseline')
+    arguments = parser.parse_args()
+    in_database = get_storage().name == 'postgres'
+    if not in_database and 'http' in arguments.transports:
+        parser.error('only the client transport can be used with the memory storage backend')
+    conn = None
+    if in_database:
+        conn = psycopg2.connect(os.getenv('DATABASE_URL'))
+    fixture = Fixture(conn)
+    results = list()
+    print('{:>9} {:>18} {:>5} {:>10} {:>9} {:>9} {:>9} {:>8} {:>7}'.format(
+        'transport', 'scenario', 'conc', 'req/s', 'p50 (ms)', 'p95 (ms)', 'p99 (ms)', 'queries',
+        'errors'
+    ))
+    try:
+        for transport in arguments.transports:
+            server = None
+            if transport == 'http':
+                server = start_server(arguments.mode, arguments.workers, arguments.threads)
+            make_sender = client_sender if transport == 'client' else http_sender
+            try:
+                for scenario in arguments.scenarios:
+                    for concurrency in arguments.concurrency:
+                        result = measure(
+                            transport, make_sender, fixture, scenario, concurrency,
+                            arguments.requests, arguments.warmup, in_database
+                        )
+                        print_result(result)
+                        results.append(result)
+            finally:
+                if server is not None:
+                    server.terminate()
+                    server.wait()
+    finally:
+        fixture.clean()
+        if conn is not None:
+            conn.close()
+    if arguments.output:
+        with open(arguments.output, 'w') as output:
+            json.dump({
+                'started': time.strftime('%Y-%m-%dT%H:%M:%S'), 'python': platform.python_version(),
+                'arguments': vars(arguments), 'results': results
+            }, output, indent=2)
+    if arguments.baseline:
+        with open(arguments.baseline) as baseline:
+            found = regressions(results, json.load(baseline), arguments.tolerance)
+        for regression in found:
+            print('REGRESSION ' + regression)
+        if found:
+            raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
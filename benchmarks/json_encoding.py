@@ -0,0 +1,89 @@
+"""
+Measures the CPU time taken to serialize a listing of 10,000 orders with each JSON encoder, as
+jsonify does for a single response and as the streamed listings do in batches, and the bytes each
+serialization puts on the wire uncompressed, gzipped and deflated at several levels, along with
+the CPU time compression adds. No database is needed.
+
+Run from the repository root with: python -m benchmarks.json_encoding [--orders N] [--repeat N]
+"""
+import argparse, random, time, uuid
+from fastfoodfast import app, encoding
+from fastfoodfast.fastfoodfast import stream_orders
+from flask import json
+
+ITEMS = [('rolex', 1500), ('fried chicken', 12000), ('chips', 3000), ('passion juice', 2000)]
+LEVELS = [1, 6, 9]
+
+
+def make_orders(count):
+    """Returns <count> orders shaped like those of GET /api/v1/orders, of 1 to 4 items each"""
+    orders = list()
+    for _ in range(count):
+        items = [
+            {'item': name, 'quantity': float(quantity), 'cost': float(rate * quantity)}
+            for (name, rate), quantity in zip(
+                random.sample(ITEMS, random.randint(1, len(ITEMS))), [1, 2, 3, 1]
+            )
+        ]
+        orders.append({
+            'order-id': str(uuid.uuid4())[:8],
+            'customer': 'customer {}'.format(random.randint(1, 500)),
+            'status': random.choice(['new', 'processing', 'complete', 'cancelled']),
+            'total-cost': sum(item['cost'] for item in items), 'items': items
+        })
+    return orders
+
+
+def cpu_time(function, repeat):
+    """Returns the least CPU time in milliseconds that <function> took over <repeat> runs"""
+    best = float('inf')
+    for _ in range(repeat):
+        started = time.process_time()
+        function()
+        best = min(best, time.process_time() - started)
+    return best * 1000
+
+
+def serializations(orders):
+    """The listing serializations timed: a jsonify'd page and a streamed document"""
+    return {
+        'response': lambda: (json.dumps({'orders': orders, 'next-cursor': None}) + '\n').encode(),
+        'stream': lambda: [chunk.encode() for chunk in stream_orders(iter(orders))]
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--orders', type=int, default=10000, help='orders in the listing')
+    parser.add_argument('--repeat', type=int, default=5, help='runs timed per measurement')
+    arguments = parser.parse_args()
+    random.seed(1)
+    orders = make_orders(arguments.orders)
+    encoders = [name for name in encoding.ENCODERS if name != 'orjson' or encoding.orjson]
+    print('{:>8} {:>9} {:>10} {:>11} {:>10} {:>12}'.format(
+        'encoder', 'listing', 'json (ms)', 'coding', 'bytes', 'compress (ms)'
+    ))
+    with app.app_context():
+        for name in encoders:
+            encoding.JSON_ENCODER = name
+            for listing, serialize in serializations(orders).items():
+                json_time = cpu_time(serialize, arguments.repeat)
+                body = serialize()
+                chunks = body if isinstance(body, list) else [body]
+                print('{:>8} {:>9} {:>10.1f} {:>11} {:>10} {:>12}'.format(
+                    name, listing, json_time, 'identity', sum(map(len, chunks)), '-'
+                ))
+                for content_coding in encoding.WINDOW_BITS:
+                    for level in LEVELS:
+                        encoding.COMPRESSION_LEVEL = level
+
+                        def compressed():
+                            return list(encoding.compress_chunks(chunks, content_coding))
+                        print('{:>8} {:>9} {:>10} {:>11} {:>10} {:>12.1f}'.format(
+                            '', '', '', '{} {}'.format(content_coding, level),
+                            sum(map(len, compressed())), cpu_time(compressed, arguments.repeat)
+                        ))
+
+
+if __name__ == '__main__':
+    main()
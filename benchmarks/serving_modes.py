@@ -0,0 +1,153 @@
+"""
+Compares the sync (WSGI) and async (ASGI) serving modes on concurrent order
+placement and menu reads, against the database specified by the DATABASE_URL environment
+variable. Each mode is started as a server process on a local port, then loaded by concurrent
+keep-alive clients, reporting requests per second and latency percentiles.
+
+Run from the repository root with: python -m benchmarks.serving_modes [--concurrency 1 16 64]
+"""
+import argparse, asyncio, json, os, socket, subprocess, sys, time
+import psycopg2
+from flask_jwt_extended import create_access_token
+from fastfoodfast import app
+
+CUSTOMER = 'benchmark customer'
+HOST = '127.0.0.1'
+PORT = 8765
+ORDER = json.dumps({'items': [{'item': 'benchmark chips', 'quantity': 2}]}).encode()
+
+
+def server_command(mode, workers, threads):
+    """Both modes are served by gunicorn, the async one through uvicorn's worker class"""
+    command = [
+        sys.executable, '-m', 'gunicorn', '--workers', str(workers),
+        '--bind', '{}:{}'.format(HOST, PORT)
+    ]
+    if mode == 'wsgi':
+        return command + ['--threads', str(threads), 'fastfoodfast:app']
+    return command + ['--worker-class', 'uvicorn.workers.UvicornWorker', 'fastfoodfast.asgi:app']
+
+
+def start_server(mode, workers, threads):
+    server = subprocess.Popen(server_command(mode, workers, threads), stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection((HOST, PORT)).close()
+            return server
+        except OSError:
+            time.sleep(0.2)
+    server.terminate()
+    raise RuntimeError('{} server did not start'.format(mode))
+
+
+def make_request(scenario, token):
+    if scenario == 'place-order':
+        head = 'POST /api/v1/users/orders HTTP/1.1\r\nContent-Type: application/json\r\n'
+        body = ORDER
+    else:
+        head, body = 'GET /api/v1/menu HTTP/1.1\r\n', b''
+    head += 'Host: {}\r\nAuthorization: Bearer {}\r\nContent-Length: {}\r\n\r\n'.format(
+        HOST, token, len(body)
+    )
+    return head.encode() + body
+
+
+async def client(request, deadline, latencies, errors):
+    """Sends <request> over one keep-alive connection until <deadline>, timing each response"""
+    reader, writer = await asyncio.open_connection(HOST, PORT)
+    try:
+        while time.monotonic() < deadline:
+            started = time.perf_counter()
+            writer.write(request)
+            status = int((await reader.readline()).split()[1])
+            length = 0
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b''):
+                    break
+                name, _, value = line.decode('latin-1').partition(':')
+                if name.lower() == 'content-length':
+                    length = int(value)
+            await reader.readexactly(length)
+            latencies.append(time.perf_counter() - started)
+            if status >= 400:
+                errors.append(status)
+    finally:
+        writer.close()
+
+
+async def run_load(request, concurrency, duration):
+    latencies, errors = list(), list()
+    deadline = time.monotonic() + duration
+    await asyncio.gather(*[
+        client(request, deadline, latencies, errors) for _ in range(concurrency)
+    ])
+    return latencies, errors
+
+
+def percentile(latencies, fraction):
+    return sorted(latencies)[min(int(len(latencies) * fraction), len(latencies) - 1)] * 1000
+
+
+def clean_orders(conn):
+    cursor = conn.cursor()
+    cursor.execute(
+        'DELETE FROM order_items WHERE order_id IN (SELECT id FROM orders WHERE customer = %s)',
+        (CUSTOMER, )
+    )
+    cursor.execute('DELETE FROM orders WHERE customer = %s', (CUSTOMER, ))
+    conn.commit()
+
+
+def ensure_menu(conn):
+    """
+    Makes sure the benchmark chips are on the menu, for menu reads, which answer 404 on an empty
+    menu, and for orders, which are priced from it
+    """
+    cursor = conn.cursor()
+    cursor.execute(
+        "INSERT INTO menu (item, unit, rate) VALUES ('benchmark chips', 'plate', 4000)"
+        ' ON CONFLICT ((lower(item))) DO NOTHING'
+    )
+    conn.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 16, 64])
+    parser.add_argument('--duration', type=float, default=10, help='seconds of load per run')
+    parser.add_argument('--workers', type=int, default=2, help='server processes per mode')
+    parser.add_argument('--threads', type=int, default=4, help='threads per gunicorn worker')
+    arguments = parser.parse_args()
+    with app.app_context():
+        token = create_access_token(identity=CUSTOMER, user_claims={'admin': False})
+    conn = psycopg2.connect(os.getenv('DATABASE_URL'))
+    ensure_menu(conn)
+    print('{:>5} {:>12} {:>12} {:>10} {:>10} {:>10} {:>7}'.format(
+        'mode', 'scenario', 'concurrency', 'req/s', 'p50 (ms)', 'p99 (ms)', 'errors'
+    ))
+    try:
+        for mode in ['wsgi', 'asgi']:
+            server = start_server(mode, arguments.workers, arguments.threads)
+            try:
+                for scenario in ['place-order', 'read-menu']:
+                    request = make_request(scenario, token)
+                    for concurrency in arguments.concurrency:
+                        latencies, errors = asyncio.run(
+                            run_load(request, concurrency, arguments.duration)
+                        )
+                        print('{:>5} {:>12} {:>12} {:>10.1f} {:>10.2f} {:>10.2f} {:>7}'.format(
+                            mode, scenario, concurrency, len(latencies) / arguments.duration,
+                            percentile(latencies, 0.5), percentile(latencies, 0.99), len(errors)
+                        ))
+            finally:
+                server.terminate()
+                server.wait()
+    finally:
+        clean_orders(conn)
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+"""
+Measures the latency of the database work done by Users.register_user, inserting the user under
+the case-insensitive uniqueness check on usernames, as the users table grows from a thousand to a
+million rows, against the database specified by the DATABASE_URL environment variable. Password
+hashing is left out, being done once up front, so that it does not drown out the database work.
+For comparison it also times the previous duplicate check, which read every username.
+
+Run from the repository root with: python -m benchmarks.signup [--sizes 1000 10000 ...]
+"""
+import argparse, os, random, string, time
+import psycopg2
+from fastfoodfast.hashing import hasher
+from fastfoodfast.models import Users
+
+SEED_PREFIX = 'zzbench' # seeded and registered benchmark users are removed by this prefix
+LEGACY_LIMIT = 100000 # the legacy full scan gets too slow to be worth timing beyond this
+
+
+def seed_users(conn, total):
+    """Tops the benchmark users up to <total> rows with bulk inserts"""
+    cursor = conn.cursor()
+    cursor.execute("SELECT count(*) FROM users WHERE username LIKE %s", (SEED_PREFIX + '%', ))
+    present = cursor.fetchone()[0]
+    cursor.execute(
+        'INSERT INTO users (username, password, admin)'
+        ' SELECT %s || n, %s, false FROM generate_series(%s, %s) AS n',
+        (SEED_PREFIX, 'not a real hash', present + 1, total)
+    )
+    cursor.execute('ANALYZE users')
+    conn.commit()
+
+
+def random_user():
+    name = ''.join(random.choice(string.ascii_lowercase) for _ in range(12))
+    return {
+        'username': 'Zzbench ' + name, 'password': 'B3nchmark',
+        'email': 'bench@mail.com', 'telephone': '+256-700-000000'
+    }
+
+
+def time_signups(users_model, count):
+    """Returns the median latency in milliseconds of inserting <count> new users"""
+    password_hash = hasher.hash(random_user()['password'])
+    latencies = list()
+    for _ in range(count):
+        user = random_user()
+        started = time.perf_counter()
+        if not users_model.storage.insert_user(
+            user['username'], password_hash, user['email'], user['telephone']
+        ):
+            raise Exception('{} already exists!'.format(user['username']))
+        latencies.append((time.perf_counter() - started) * 1000)
+    return sorted(latencies)[len(latencies) // 2]
+
+
+def time_legacy_checks(conn, count):
+    """Returns the median latency in milliseconds of the old scan over every username"""
+    cursor = conn.cursor()
+    latencies = list()
+    for _ in range(count):
+        username = random_user()['username']
+        started = time.perf_counter()
+        cursor.execute('SELECT username FROM users')
+        for record in cursor.fetchall():
+            if username in record:
+                break
+        latencies.append((time.perf_counter() - started) * 1000)
+    conn.rollback()
+    return sorted(latencies)[len(latencies) // 2]
+
+
+def clean_users(conn):
+    cursor = conn.cursor()
+    cursor.execute('DELETE FROM users WHERE lower(username) LIKE %s', (SEED_PREFIX + '%', ))
+    conn.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        '--sizes', type=int, nargs='+', default=[1000, 10000, 100000, 1000000],
+        help='numbers of users at which signups are timed'
+    )
+    parser.add_argument('--signups', type=int, default=50, help='signups timed at each size')
+    arguments = parser.parse_args()
+    users_model = Users()
+    conn = psycopg2.connect(os.getenv('DATABASE_URL'))
+    print('{:>9} {:>18} {:>24}'.format('users', 'signup p50 (ms)', 'legacy check p50 (ms)'))
+    try:
+        for size in sorted(arguments.sizes):
+            seed_users(conn, size)
+            signup = time_signups(users_model, arguments.signups)
+            legacy = 'skipped'
+            if size <= LEGACY_LIMIT:
+                legacy = '{:.2f}'.format(time_legacy_checks(conn, arguments.signups))
+            print('{:>9} {:>18.2f} {:>24}'.format(size, signup, legacy))
+    finally:
+        clean_users(conn)
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+"""
+Compares the time taken to validate orders of 1 to 500 items by the schema based validator with
+that of the previous assert based validator, which compiled its regular expression and parsed
+each number twice for every item. No database is needed.
+
+Run from the repository root with: python -m benchmarks.validation [--repeat N]
+"""
+import argparse, re, timeit
+from fastfoodfast.validation import Validation
+
+ITEM_COUNTS = [1, 10, 50, 100, 500]
+
+
+class LegacyValidation:
+    """The order validation code that the schemas replaced, kept for comparison"""
+    def validate_order(self, order):
+        assert isinstance(order, dict), 'Order data must be represented in JSON!'
+        assert 'items' in order, 'items to order not specified!'
+        assert isinstance(order['items'], list), 'Specify order items as a list'
+        assert len(order['items']) > 0, 'Items list empty!'
+        for item in order['items']:
+            self.validate_order_item(item)
+
+    def validate_order_item(self, item):
+        assert isinstance(item, dict), 'Specify order item as a dictionary!'
+        assert 'item' in item, 'Specify item name!'
+        assert 'quantity' in item, 'Item quantity not specified!'
+        assert 'cost' in item, 'Item cost not specified!'
+        assert isinstance(item['item'], str), 'Item name must be a string!'
+        pattern = re.compile(r'[a-zA-Z]{2,30}( [a-zA-Z]{2,30})*$')
+        assert pattern.match(item['item'].strip()), 'Invalid item specified!'
+        assert float(item['quantity']), 'Specify quantity as a number!'
+        assert float(item['quantity']) > 0, 'Item quantity cannot be negative!'
+        assert float(item['cost']), 'Specify item cost as a number!'
+        assert float(item['cost']) > 0, 'Item cost cannot be negative!'
+        assert len(item) == 3, 'Redundant fields in request data!'
+
+
+def make_order(item_count):
+    return {
+        'items': [
+            {'item': 'fried chicken', 'quantity': 2, 'cost': '12000'} for _ in range(item_count)
+        ]
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=2000, help='validations timed per size')
+    arguments = parser.parse_args()
+    validators = {'schema': Validation(), 'legacy': LegacyValidation()}
+    if not __debug__:
+        print('Warning: running with -O, the legacy validator skips its asserts')
+    print('{:>6} {:>14} {:>14} {:>9}'.format('items', 'schema (us)', 'legacy (us)', 'speedup'))
+    for item_count in ITEM_COUNTS:
+        order = make_order(item_count)
+        timings = {
+            name: min(timeit.repeat(
+                lambda: validator.validate_order(order), number=arguments.repeat, repeat=7
+            )) / arguments.repeat * 1e6
+            for name, validator in validators.items()
+        }
+        print('{:>6} {:>14.2f} {:>14.2f} {:>8.2f}x'.format(
+            item_count, timings['schema'], timings['legacy'], timings['legacy'] / timings['schema']
+        ))
+
+
+if __name__ == '__main__':
+    main()
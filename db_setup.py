@@ -1,70 +1,471 @@
 """
 This module sets up tables in the database specified by the DATABASE_URL environment variable.
-It should only be executed for initial setup, when the tables are not in existence otherwise
-data will be lost.
+
+The schema is built by a list of versioned migrations. 'python db_setup.py migrate' (or just
+'python db_setup.py') applies the migrations that the database has not seen yet and never drops
+data, so it is safe to run against a live database on every deploy. Index migrations use
+CREATE INDEX CONCURRENTLY so that they do not block reads and writes while they build.
+'python db_setup.py testdb' drops and recreates all tables of the test database.
+
+'python db_setup.py archive [days]' moves the orders completed or cancelled that were placed more
+than <days> days ago (default ORDER_ARCHIVE_DAYS, else 90) out of the orders and order_items
+tables, which the API's queries then no longer wade through, into archived_orders, a table of
+monthly partitions. Run it daily, e.g. from cron; each run moves what aged since the last one.
 """
 
 import psycopg2, os, sys
 from werkzeug.security import generate_password_hash
 
+MIGRATIONS_LOCK = 20181018 # advisory lock held while migrating, so that migrators do not race
+ORDER_ARCHIVE_DAYS = int(os.getenv('ORDER_ARCHIVE_DAYS', 90))
 
-def create_tables(conn):
+# (version, description, statements, concurrent) - the statements of a concurrent migration run
+# outside of a transaction, as CREATE INDEX CONCURRENTLY requires
+MIGRATIONS = [
+    (
+        1, 'create users, menu, versions, orders and order_items tables',
+        [
+            """
+            CREATE TABLE IF NOT EXISTS users (
+                Id SERIAL PRIMARY KEY,
+                Username VARCHAR(80) NOT NULL,
+                Password VARCHAR(80) NOT NULL,
+                Email VARCHAR(80),
+                Telephone VARCHAR(80),
+                Admin BOOLEAN NOT NULL
+            )
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS menu (
+                Id SERIAL PRIMARY KEY,
+                Item VARCHAR(80),
+                Unit VARCHAR(80),
+                Rate real
+            )
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS versions (
+                Name VARCHAR(80) PRIMARY KEY,
+                Version INTEGER NOT NULL
+            )
+            """,
+            "INSERT INTO versions (Name, Version) VALUES ('menu', 0) ON CONFLICT DO NOTHING",
+            """
+            CREATE TABLE IF NOT EXISTS orders (
+                Id SERIAL PRIMARY KEY,
+                Public_Id VARCHAR(80),
+                Customer VARCHAR(80),
+                Status VARCHAR(80),
+                Total_Cost REAL
+            )
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS order_items (
+                Id SERIAL PRIMARY KEY,
+                Order_Id SERIAL REFERENCES orders(Id),
+                Item VARCHAR(80),
+                Quantity REAL,
+                Cost REAL
+            )
+            """
+        ],
+        False
+    ),
+    (
+        2, 'index hot lookups and enforce unique usernames, order ids and menu items',
+        [
+            'CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS users_username_key ON users (username)',
+            'CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS orders_public_id_key ON orders (public_id)',
+            # serves order history, filtered by customer and paginated on id
+            'CREATE INDEX CONCURRENTLY IF NOT EXISTS orders_customer_id_idx ON orders (customer, id)',
+            'CREATE INDEX CONCURRENTLY IF NOT EXISTS order_items_order_id_idx ON order_items (order_id)',
+            # menu item names are unique regardless of case
+            'CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS menu_item_lower_key ON menu (lower(item))'
+        ],
+        True
+    ),
+    (
+        3, 'widen password hashes for stronger hashing methods',
+        ['ALTER TABLE users ALTER COLUMN password TYPE VARCHAR(255)'],
+        False
+    ),
+    (
+        4, 'bump the menu version on every write to the menu table',
+        [
+            # the counter of a cached table is named after it, see fastfoodfast/cache.py
+            """
+            CREATE OR REPLACE FUNCTION bump_version() RETURNS trigger AS $$
+            BEGIN
+                UPDATE versions SET version = version + 1 WHERE name = TG_TABLE_NAME;
+                RETURN NULL;
+            END;
+            $$ LANGUAGE plpgsql
+            """,
+            'DROP TRIGGER IF EXISTS menu_bump_version ON menu',
+            """
+            CREATE TRIGGER menu_bump_version AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON menu
+            FOR EACH STATEMENT EXECUTE PROCEDURE bump_version()
+            """
+        ],
+        False
+    ),
+    (
+        5, 'notify listeners on the order_events channel of new orders and status changes',
+        [
+            # the payload is delivered to listeners when the transaction commits
+            """
+            CREATE OR REPLACE FUNCTION notify_order_event() RETURNS trigger AS $$
+            BEGIN
+                PERFORM pg_notify('order_events', json_build_object(
+                    'event', CASE TG_OP WHEN 'INSERT' THEN 'created' ELSE 'updated' END,
+                    'order-id', NEW.public_id, 'customer', NEW.customer, 'status', NEW.status,
+                    'total-cost', NEW.total_cost
+                )::text);
+                RETURN NULL;
+            END;
+            $$ LANGUAGE plpgsql
+            """,
+            'DROP TRIGGER IF EXISTS orders_notify_insert ON orders',
+            """
+            CREATE TRIGGER orders_notify_insert AFTER INSERT ON orders
+            FOR EACH ROW EXECUTE PROCEDURE notify_order_event()
+            """,
+            'DROP TRIGGER IF EXISTS orders_notify_update ON orders',
+            """
+            CREATE TRIGGER orders_notify_update AFTER UPDATE OF status ON orders
+            FOR EACH ROW WHEN (OLD.status IS DISTINCT FROM NEW.status)
+            EXECUTE PROCEDURE notify_order_event()
+            """
+        ],
+        False
+    ),
+    (
+        6, 'index open orders by status for bulk status updates',
+        [
+            # only orders still moving through the kitchen are indexed, finished ones pile up
+            'CREATE INDEX CONCURRENTLY IF NOT EXISTS orders_open_status_idx ON orders (status)'
+            " WHERE status IN ('new', 'processing')"
+        ],
+        True
+    ),
+    (
+        7, 'roll up daily sales by status and by item, maintained by triggers',
+        [
+            'ALTER TABLE orders ADD COLUMN IF NOT EXISTS Created_At TIMESTAMPTZ NOT NULL'
+            ' DEFAULT now()',
+            # orders and their revenue by the UTC day they were placed and their current status.
+            # Each total is striped over 16 shard rows, picked by the writer's backend, so that
+            # concurrent transactions do not queue on the lock of a single row until they commit;
+            # readers sum the shards
+            """
+            CREATE TABLE IF NOT EXISTS daily_sales (
+                Day DATE,
+                Status VARCHAR(80),
+                Shard SMALLINT,
+                Orders INTEGER NOT NULL,
+                Revenue DOUBLE PRECISION NOT NULL,
+                PRIMARY KEY (Day, Status, Shard)
+            )
+            """,
+            # items sold by the UTC day their orders were placed, leaving out cancelled orders
+            """
+            CREATE TABLE IF NOT EXISTS daily_item_sales (
+                Day DATE,
+                Item VARCHAR(80),
+                Shard SMALLINT,
+                Quantity DOUBLE PRECISION NOT NULL,
+                Revenue DOUBLE PRECISION NOT NULL,
+                PRIMARY KEY (Day, Item, Shard)
+            )
+            """,
+            # the triggers run once per statement over its transition table 'changed', so a bulk
+            # insert costs one upsert per day and status however many orders it adds. TG_ARGV[0]
+            # is 1 for added rows and -1 for removed ones. Rows are upserted in key order, and
+            # daily_sales before daily_item_sales, so that concurrent writers do not deadlock.
+            """
+            CREATE OR REPLACE FUNCTION roll_up_orders() RETURNS trigger AS $$
+            BEGIN
+                INSERT INTO daily_sales AS sales (day, status, shard, orders, revenue)
+                SELECT (created_at AT TIME ZONE 'UTC')::date, status, pg_backend_pid() % 16,
+                    TG_ARGV[0]::integer * count(*), TG_ARGV[0]::integer * sum(total_cost)
+                FROM changed GROUP BY 1, 2 ORDER BY 1, 2
+                ON CONFLICT (day, status, shard) DO UPDATE SET
+                    orders = sales.orders + EXCLUDED.orders,
+                    revenue = sales.revenue + EXCLUDED.revenue;
+                RETURN NULL;
+            END;
+            $$ LANGUAGE plpgsql
+            """,
+            """
+            CREATE OR REPLACE FUNCTION roll_up_order_items() RETURNS trigger AS $$
+            BEGIN
+                INSERT INTO daily_item_sales AS sales (day, item, shard, quantity, revenue)
+                SELECT (o.created_at AT TIME ZONE 'UTC')::date, changed.item, pg_backend_pid() % 16,
+                    TG_ARGV[0]::integer * sum(changed.quantity),
+                    TG_ARGV[0]::integer * sum(changed.cost)
+                FROM changed JOIN orders o ON o.id = changed.order_id
+                WHERE o.status <> 'cancelled'
+                GROUP BY 1, 2 ORDER BY 1, 2
+                ON CONFLICT (day, item, shard) DO UPDATE SET
+                    quantity = sales.quantity + EXCLUDED.quantity,
+                    revenue = sales.revenue + EXCLUDED.revenue;
+                RETURN NULL;
+            END;
+            $$ LANGUAGE plpgsql
+            """,
+            # moves orders whose status changed from their old status to their new one, and takes
+            # the items of orders cancelled (or restored) out of (or back into) the item sales
+            """
+            CREATE OR REPLACE FUNCTION roll_up_status_changes() RETURNS trigger AS $$
+            BEGIN
+                INSERT INTO daily_sales AS sales (day, status, shard, orders, revenue)
+                SELECT (new_orders.created_at AT TIME ZONE 'UTC')::date, moves.status,
+                    pg_backend_pid() % 16, sum(moves.sign), sum(moves.sign * new_orders.total_cost)
+                FROM old_orders JOIN new_orders ON new_orders.id = old_orders.id
+                CROSS JOIN LATERAL (
+                    VALUES (old_orders.status, -1), (new_orders.status, 1)
+                ) AS moves (status, sign)
+                WHERE old_orders.status IS DISTINCT FROM new_orders.status
+                GROUP BY 1, 2 ORDER BY 1, 2
+                ON CONFLICT (day, status, shard) DO UPDATE SET
+                    orders = sales.orders + EXCLUDED.orders,
+                    revenue = sales.revenue + EXCLUDED.revenue;
+                INSERT INTO daily_item_sales AS sales (day, item, shard, quantity, revenue)
+                SELECT (new_orders.created_at AT TIME ZONE 'UTC')::date, i.item,
+                    pg_backend_pid() % 16, sum(moves.sign * i.quantity), sum(moves.sign * i.cost)
+                FROM old_orders JOIN new_orders ON new_orders.id = old_orders.id
+                CROSS JOIN LATERAL (
+                    VALUES (CASE WHEN new_orders.status = 'cancelled' THEN -1 ELSE 1 END)
+                ) AS moves (sign)
+                JOIN order_items i ON i.order_id = new_orders.id
+                WHERE (old_orders.status = 'cancelled') <> (new_orders.status = 'cancelled')
+                GROUP BY 1, 2 ORDER BY 1, 2
+                ON CONFLICT (day, item, shard) DO UPDATE SET
+                    quantity = sales.quantity + EXCLUDED.quantity,
+                    revenue = sales.revenue + EXCLUDED.revenue;
+                RETURN NULL;
+            END;
+            $$ LANGUAGE plpgsql
+            """,
+            'DROP TRIGGER IF EXISTS orders_roll_up_insert ON orders',
+            """
+            CREATE TRIGGER orders_roll_up_insert AFTER INSERT ON orders
+            REFERENCING NEW TABLE AS changed
+            FOR EACH STATEMENT EXECUTE PROCEDURE roll_up_orders('1')
+            """,
+            'DROP TRIGGER IF EXISTS orders_roll_up_delete ON orders',
+            """
+            CREATE TRIGGER orders_roll_up_delete AFTER DELETE ON orders
+            REFERENCING OLD TABLE AS changed
+            FOR EACH STATEMENT EXECUTE PROCEDURE roll_up_orders('-1')
+            """,
+            'DROP TRIGGER IF EXISTS orders_roll_up_update ON orders',
+            """
+            CREATE TRIGGER orders_roll_up_update AFTER UPDATE ON orders
+            REFERENCING OLD TABLE AS old_orders NEW TABLE AS new_orders
+            FOR EACH STATEMENT EXECUTE PROCEDURE roll_up_status_changes()
+            """,
+            'DROP TRIGGER IF EXISTS order_items_roll_up_insert ON order_items',
+            """
+            CREATE TRIGGER order_items_roll_up_insert AFTER INSERT ON order_items
+            REFERENCING NEW TABLE AS changed
+            FOR EACH STATEMENT EXECUTE PROCEDURE roll_up_order_items('1')
+            """,
+            'DROP TRIGGER IF EXISTS order_items_roll_up_delete ON order_items',
+            """
+            CREATE TRIGGER order_items_roll_up_delete AFTER DELETE ON order_items
+            REFERENCING OLD TABLE AS changed
+            FOR EACH STATEMENT EXECUTE PROCEDURE roll_up_order_items('-1')
+            """,
+            # existing orders were not timestamped, they are rolled up under the day of migration
+            'DELETE FROM daily_sales',
+            """
+            INSERT INTO daily_sales (day, status, shard, orders, revenue)
+            SELECT (created_at AT TIME ZONE 'UTC')::date, status, 0, count(*), sum(total_cost)
+            FROM orders GROUP BY 1, 2
+            """,
+            'DELETE FROM daily_item_sales',
+            """
+            INSERT INTO daily_item_sales (day, item, shard, quantity, revenue)
+            SELECT (o.created_at AT TIME ZONE 'UTC')::date, i.item, 0, sum(i.quantity), sum(i.cost)
+            FROM order_items i JOIN orders o ON o.id = i.order_id
+            WHERE o.status <> 'cancelled' GROUP BY 1, 2
+            """
+        ],
+        False
+    ),
+    (
+        8, 'record the responses to order requests by idempotency key',
+        [
+            """
+            CREATE TABLE IF NOT EXISTS idempotency_keys (
+                Customer VARCHAR(80),
+                Idempotency_Key VARCHAR(255),
+                Request_Hash VARCHAR(64) NOT NULL,
+                Status SMALLINT NOT NULL,
+                Body TEXT NOT NULL,
+                Created_At TIMESTAMPTZ NOT NULL DEFAULT now(),
+                PRIMARY KEY (Customer, Idempotency_Key)
+            )
+            """,
+            # expired keys are purged by age
+            'CREATE INDEX IF NOT EXISTS idempotency_keys_created_at_idx'
+            ' ON idempotency_keys (created_at)'
+        ],
+        False
+    ),
+    (
+        9, 'timestamp status changes and archive finished orders into monthly partitions',
+        [
+            # existing orders are stamped with the time of migration
+            'ALTER TABLE orders ADD COLUMN IF NOT EXISTS Updated_At TIMESTAMPTZ NOT NULL'
+            ' DEFAULT now()',
+            """
+            CREATE OR REPLACE FUNCTION touch_order() RETURNS trigger AS $$
+            BEGIN
+                NEW.updated_at := now();
+                RETURN NEW;
+            END;
+            $$ LANGUAGE plpgsql
+            """,
+            'DROP TRIGGER IF EXISTS orders_touch ON orders',
+            """
+            CREATE TRIGGER orders_touch BEFORE UPDATE OF status ON orders
+            FOR EACH ROW WHEN (OLD.status IS DISTINCT FROM NEW.status)
+            EXECUTE PROCEDURE touch_order()
+            """,
+            # finished orders moved out of orders and order_items by 'python db_setup.py archive',
+            # a row per order with its items inline, partitioned by the UTC month they were
+            # placed. The partitions are created by the archiving as it needs them. Items are
+            # kept as JSON text of positional arrays, about a third of the size of JSONB objects.
+            """
+            CREATE TABLE IF NOT EXISTS archived_orders (
+                Id INTEGER NOT NULL,
+                Public_Id VARCHAR(80) NOT NULL,
+                Customer VARCHAR(80),
+                Status VARCHAR(80) NOT NULL,
+                Total_Cost REAL,
+                Items JSON NOT NULL, -- [[item, quantity, cost], ...]
+                Created_At TIMESTAMPTZ NOT NULL,
+                Updated_At TIMESTAMPTZ NOT NULL,
+                Archived_At TIMESTAMPTZ NOT NULL DEFAULT now(),
+                PRIMARY KEY (Id, Created_At)
+            ) PARTITION BY RANGE (Created_At)
+            """,
+            'CREATE INDEX IF NOT EXISTS archived_orders_public_id_idx'
+            ' ON archived_orders (public_id)',
+            'CREATE INDEX IF NOT EXISTS archived_orders_customer_id_idx'
+            ' ON archived_orders (customer, id)',
+            # archived orders stay in the sales rollups: the archiving sets fastfoodfast.archiving
+            # for its transactions, which the delete triggers skip
+            'DROP TRIGGER IF EXISTS orders_roll_up_delete ON orders',
+            """
+            CREATE TRIGGER orders_roll_up_delete AFTER DELETE ON orders
+            REFERENCING OLD TABLE AS changed FOR EACH STATEMENT
+            WHEN (current_setting('fastfoodfast.archiving', true) IS DISTINCT FROM 'on')
+            EXECUTE PROCEDURE roll_up_orders('-1')
+            """,
+            'DROP TRIGGER IF EXISTS order_items_roll_up_delete ON order_items',
+            """
+            CREATE TRIGGER order_items_roll_up_delete AFTER DELETE ON order_items
+            REFERENCING OLD TABLE AS changed FOR EACH STATEMENT
+            WHEN (current_setting('fastfoodfast.archiving', true) IS DISTINCT FROM 'on')
+            EXECUTE PROCEDURE roll_up_order_items('-1')
+            """
+        ],
+        False
+    )
+]
+
+
+def migrate(conn):
+    """Applies the migrations that have not been applied to the database yet, in order"""
+    conn.autocommit = True
     cursor = conn.cursor()
+    cursor.execute('SELECT pg_advisory_lock(%s)', (MIGRATIONS_LOCK, ))
+    try:
+        cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+                Version INTEGER PRIMARY KEY,
+                Description VARCHAR(200),
+                Applied_At TIMESTAMP NOT NULL DEFAULT now()
+            )
+            """
+        )
+        cursor.execute('SELECT version FROM schema_migrations')
+        applied = {row[0] for row in cursor.fetchall()}
+        for version, description, statements, concurrent in MIGRATIONS:
+            if version in applied:
+                continue
+            print('Applying migration {}: {}...'.format(version, description))
+            conn.autocommit = concurrent
+            for statement in statements:
+                if concurrent:
+                    drop_invalid_index(cursor, statement)
+                cursor.execute(statement)
+            cursor.execute(
+                'INSERT INTO schema_migrations (version, description) VALUES (%s, %s)',
+                (version, description)
+            )
+            if not concurrent:
+                conn.commit()
+            conn.autocommit = True
+        seed_admin(cursor)
+    finally:
+        conn.rollback() # a no-op unless a transactional migration failed
+        conn.autocommit = True
+        cursor.execute('SELECT pg_advisory_unlock(%s)', (MIGRATIONS_LOCK, ))
+
+
+def drop_invalid_index(cursor, statement):
+    """
+    A failed CREATE INDEX CONCURRENTLY leaves an invalid index behind, which IF NOT EXISTS would
+    then skip; drop it so that the index is built again
+    """
+    words = statement.split()
+    if 'INDEX' not in words or 'EXISTS' not in words:
+        return
+    name = words[words.index('EXISTS') + 1]
     cursor.execute(
-        """
-        DROP TABLE IF EXISTS users;
-        CREATE TABLE users (
-            Id SERIAL PRIMARY KEY,
-            Username VARCHAR(80) NOT NULL,
-            Password VARCHAR(80) NOT NULL,
-            Email VARCHAR(80),
-            Telephone VARCHAR(80),
-            Admin BOOLEAN NOT NULL
-        );
-        """
+        'SELECT 1 FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid'
+        ' WHERE c.relname = %s AND NOT i.indisvalid', (name, )
     )
+    if cursor.fetchone():
+        cursor.execute('DROP INDEX CONCURRENTLY IF EXISTS {}'.format(name))
+
+
+def seed_admin(cursor):
+    """Adds the default administrator unless there already is one"""
     cursor.execute(
         """
-        INSERT INTO users (username, password, admin) VALUES (%s, %s, %s)
+        INSERT INTO users (username, password, admin) SELECT %s, %s, %s
+        WHERE NOT EXISTS (SELECT 1 FROM users WHERE username = %s)
         """,
-        ('admin', generate_password_hash('administrator', method='sha256'), True)
-    )
-    cursor.execute(
-        """
-        DROP TABLE IF EXISTS menu;
-        CREATE TABLE menu (
-            Id SERIAL PRIMARY KEY,
-            Item VARCHAR(80),
-            Unit VARCHAR(80),
-            Rate real
-        );
-        """
+        ('admin', generate_password_hash('administrator', method='sha256'), True, 'admin')
     )
+
+
+def drop_tables(conn):
+    """Drops all tables, losing their data"""
+    cursor = conn.cursor()
     cursor.execute(
         """
-        DROP TABLE IF EXISTS orders CASCADE;
-        CREATE TABLE orders (
-            Id SERIAL PRIMARY KEY,
-            Public_Id VARCHAR(80),
-            Customer VARCHAR(80),
-            Status VARCHAR(80),
-            Total_Cost REAL
-        );
+        DROP TABLE IF EXISTS order_items, orders, versions, menu, users, daily_sales,
+            daily_item_sales, idempotency_keys, archived_orders, schema_migrations CASCADE
         """
     )
     cursor.execute(
-        """
-        DROP TABLE IF EXISTS order_items;
-        CREATE TABLE order_items (
-            Id SERIAL PRIMARY KEY,
-            Order_Id SERIAL REFERENCES orders(Id),
-            Item VARCHAR(80),
-            Quantity REAL,
-            Cost REAL
-        );
-        """
+        'DROP FUNCTION IF EXISTS bump_version(), notify_order_event(), roll_up_orders(),'
+        ' roll_up_order_items(), roll_up_status_changes(), touch_order()'
     )
     conn.commit()
+
+
+def create_tables(conn):
+    """Recreates all tables from scratch, losing any data they held"""
+    drop_tables(conn)
+    migrate(conn)
     conn.close()
 
 
@@ -83,6 +484,13 @@ def setup_testdb():
     create_tables(conn)
 
 
+def archive(days):
+    """Archives the finished orders placed more than <days> days ago, through the storage"""
+    from fastfoodfast.storage import PostgresStorage
+    archived = PostgresStorage().archive_orders(days)
+    print('{} orders placed more than {} days ago archived...'.format(archived, days))
+
+
 def main():
     if len(sys.argv) == 2 and sys.argv[1] == 'testdb':
         try:
@@ -92,14 +500,21 @@ def main():
         except:
             print('Could not establish connection to the test database...')
             return
+    if len(sys.argv) in (2, 3) and sys.argv[1] == 'archive':
+        archive(int(sys.argv[2]) if len(sys.argv) == 3 else ORDER_ARCHIVE_DAYS)
+        return
+    if len(sys.argv) > 2 or (len(sys.argv) == 2 and sys.argv[1] != 'migrate'):
+        print('Usage: python db_setup.py [migrate|testdb|archive [days]]')
+        return
     conn = None
     try:
         conn = psycopg2.connect(os.getenv('DATABASE_URL'))
     except:
         print('Could not establish connection to database...')
         return
-    create_tables(conn)
-    print('Database tables successfully setup...')
+    migrate(conn)
+    conn.close()
+    print('Database migrations successfully applied...')
 
 
 if __name__ == '__main__':
@@ -0,0 +1,243 @@
+"""
+Admission control: per-client rate limits and a cap on the requests a serving process runs at
+once, so that a misbehaving client or a retry storm is turned away early instead of taking every
+worker and database connection.
+
+Requests are sorted into route classes, auth (signup and login), writes and reads, each limited by
+a token bucket per client configured by RATE_LIMIT_AUTH, RATE_LIMIT_WRITES and RATE_LIMIT_READS as
+<requests>/<seconds>, e.g. 60/60 for bursts of up to 60 requests refilled at one per second.
+Requests with a valid access token are limited per identity, others per client IP. The buckets
+live in a file mapped into memory (RATE_LIMIT_FILE, by default under /dev/shm), so every worker on
+a host enforces the same limits. Requests over a limit are answered with 429 and a Retry-After.
+
+MAX_CONCURRENT_REQUESTS caps the requests a serving process runs at once; those beyond it are
+answered at once with 503 instead of queueing for a database connection until they time out.
+Event streams and /metrics are left out of the cap. Both controls are off unless configured.
+"""
+import fcntl, hashlib, math, mmap, os, struct, tempfile, threading, time
+from flask import g, jsonify, request
+from flask_jwt_extended import verify_jwt_in_request_optional, get_jwt_identity
+from .cache import TTLCache
+
+RATE_LIMIT_SLOTS = 65536 # buckets kept; when full, the buckets of the least recent clients go
+ROUTE_CLASSES = ('auth', 'writes', 'reads')
+UNCAPPED_PATHS = {'/metrics', '/api/v1/orders/events'}
+# set in the ASGI scope of a request whose rate limit was checked by the ASGI app, so that the
+# Flask app does not take a second token if a native handler leaves the request to it
+RATE_CHECKED = 'fastfoodfast.rate_checked'
+# identities of the access tokens verified lately, sparing a second verification of the tokens that
+# clients send with every request before the routes verify them as usual
+token_identities = TTLCache(max_size=4096, ttl=60)
+
+
+class SharedBuckets:
+    """
+    Token buckets in a hash table of <slots> fixed size slots, kept in the file at <path> and
+    mapped into the memory of every process that opens it. Processes take turns with a POSIX
+    lock on the file, which forked processes do not share, and threads with a lock of their own.
+    """
+    SLOT = struct.Struct('<Qddd') # key hash, tokens, time of the last take, time it is full again
+    PROBES = 8 # slots a key may be kept in, from the one its hash points to
+
+    def __init__(self, path, slots=RATE_LIMIT_SLOTS):
+        self.path = path
+        self.slots = slots
+        self._lock = threading.Lock()
+        self._map = None
+        self._map_pid = None
+
+    def take(self, key, capacity, period, now=None):
+        """
+        Takes a token from the bucket of <key>, which holds up to <capacity> tokens refilled over
+        <period> seconds. Returns 0 if a token was taken, else the seconds until one is available.
+        """
+        now = time.monotonic() if now is None else now
+        digest = int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), 'little')
+        digest = digest or 1 # 0 marks free slots
+        rate = capacity / period
+        with self._lock:
+            table, fd = self._get_map()
+            fcntl.lockf(fd, fcntl.LOCK_EX)
+            try:
+                offset, tokens, taken = self._find(table, digest, now, capacity)
+                tokens = min(capacity, tokens + max(0.0, now - taken) * rate)
+                wait = 0.0 if tokens >= 1 else (1 - tokens) / rate
+                if not wait:
+                    tokens -= 1
+                self.SLOT.pack_into(
+                    table, offset, digest, tokens, now, now + (capacity - tokens) / rate
+                )
+                return wait
+            finally:
+                fcntl.lockf(fd, fcntl.LOCK_UN)
+
+    def _find(self, table, digest, now, capacity):
+        """
+        Returns the offset of the slot of <digest> and its bucket's tokens and last take, taking
+        a free slot, a slot whose bucket is full again or else the least recently used one
+        """
+        start = digest % self.slots
+        free, least_recent = None, None
+        for probe in range(self.PROBES):
+            offset = (start + probe) % self.slots * self.SLOT.size
+            slot_digest, tokens, taken, full_at = self.SLOT.unpack_from(table, offset)
+            if slot_digest == digest:
+                return offset, tokens, taken
+            if free is None and (slot_digest == 0 or full_at <= now):
+                free = offset
+            if least_recent is None or taken < least_recent[1]:
+                least_recent = offset, taken
+        return (least_recent[0] if free is None else free), capacity, now
+
+    def _get_map(self):
+        """Returns this process's mapping of the file and its descriptor, opening them once"""
+        if self._map is None or self._map_pid != os.getpid():
+            size = self.slots * self.SLOT.size
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+            fcntl.lockf(fd, fcntl.LOCK_EX)
+            try:
+                if os.fstat(fd).st_size != size:
+                    os.ftruncate(fd, size) # zero filled, every slot free
+            finally:
+                fcntl.lockf(fd, fcntl.LOCK_UN)
+            self._map, self._fd, self._map_pid = mmap.mmap(fd, size), fd, os.getpid()
+        return self._map, self._fd
+
+
+def parse_limit(value):
+    """Reads a rate limit given as <requests>/<seconds>, returning (requests, seconds) or None"""
+    if not value:
+        return None
+    try:
+        requests, seconds = (float(part) for part in value.split('/'))
+    except ValueError:
+        raise ValueError('Rate limits must be given as <requests>/<seconds>, e.g. 60/60')
+    if requests < 1 or seconds <= 0:
+        raise ValueError('Rate limits must allow at least 1 request over a positive period')
+    return requests, seconds
+
+
+def default_rate_limit_file():
+    directory = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+    return os.path.join(directory, 'fastfoodfast-rate-limits')
+
+
+class AdmissionControl:
+    def __init__(self, limits=None, max_concurrent=0, path=None):
+        self.limits = dict(limits or {})
+        self.buckets = SharedBuckets(path or default_rate_limit_file())
+        self.max_concurrent = max_concurrent
+        self._slots = threading.BoundedSemaphore(max_concurrent) if max_concurrent else None
+
+    def check_rate(self, route_class, client):
+        """
+        Takes a token of the client keyed by <client>() for a request of <route_class>, returning
+        0 if it is admitted, else the whole seconds it should wait before retrying
+        """
+        limit = self.limits.get(route_class)
+        if limit is None:
+            return 0
+        wait = self.buckets.take('{}:{}'.format(route_class, client()), *limit)
+        return math.ceil(wait)
+
+    def admit(self, method, path, client, rate_checked=False):
+        """
+        Decides whether to run a request, where <client> returns the key of the client that sent
+        it, only read if a rate limit applies and <rate_checked> is not set. Returns None if the
+        request is admitted, else the status code, error and Retry-After seconds to answer it
+        with. Admitted requests counted towards the concurrency cap, see capped(), must call
+        leave() when done.
+        """
+        wait = 0 if rate_checked else self.check_rate(route_class(method, path), client)
+        if wait:
+            return 429, 'Too many requests, please try again later', wait
+        if self.capped(path) and not self.enter():
+            return 503, 'The server is busy, please try again later', 1
+        return None
+
+    def capped(self, path):
+        """Returns True if requests for <path> count towards the concurrency cap"""
+        return self._slots is not None and path not in UNCAPPED_PATHS
+
+    def enter(self):
+        """Returns True if the process may run one more request, which must then call leave()"""
+        return self._slots is None or self._slots.acquire(blocking=False)
+
+    def leave(self):
+        if self._slots is not None:
+            self._slots.release()
+
+
+def client_key(identity=None, address=None):
+    """The key of a client's rate limits: the identity of its valid access token, else its IP"""
+    return 'user:{}'.format(identity) if identity is not None else 'ip:{}'.format(address)
+
+
+def route_class(method, path):
+    """Sorts a request into the route class whose rate limit applies to it"""
+    if path.startswith('/api/v1/auth/'):
+        return 'auth'
+    return 'reads' if method in ('GET', 'HEAD', 'OPTIONS') else 'writes'
+
+
+admission = AdmissionControl(
+    limits={
+        name: limit for name, limit in (
+            (name, parse_limit(os.getenv('RATE_LIMIT_' + name.upper()))) for name in ROUTE_CLASSES
+        ) if limit is not None
+    },
+    max_concurrent=int(os.getenv('MAX_CONCURRENT_REQUESTS', 0)),
+    path=os.getenv('RATE_LIMIT_FILE')
+)
+
+
+def init_app(app):
+    """Admits the requests of <app> through admission control"""
+    @app.before_request
+    def admit_request():
+        rejection = admission.admit(
+            request.method, request.path, client_of_request,
+            rate_checked=request.environ.get('asgi.scope', {}).get(RATE_CHECKED, False)
+        )
+        if rejection is None:
+            g.admitted = admission.capped(request.path)
+            return None
+        status, error, retry_after = rejection
+        response = jsonify({'error': error})
+        response.headers['Retry-After'] = str(retry_after)
+        return response, status
+
+    @app.teardown_request
+    def release_request(error=None):
+        if g.pop('admitted', False):
+            admission.leave()
+
+
+def verified_identity(authorization, verify):
+    """
+    Returns the identity of the access token sent in the <authorization> header, or None, calling
+    <verify>() to verify tokens not seen lately
+    """
+    if not authorization:
+        return None
+    identity = token_identities.get(authorization)
+    if identity is None:
+        identity = verify()
+        if identity is not None:
+            token_identities.set(authorization, identity)
+    return identity
+
+
+def client_of_request():
+    return client_key(
+        verified_identity(request.headers.get('Authorization'), verify_request_token),
+        request.remote_addr
+    )
+
+
+def verify_request_token():
+    try:
+        verify_jwt_in_request_optional()
+        return get_jwt_identity()
+    except Exception:
+        return None # an invalid token, which routes requiring one reject
@@ -0,0 +1,161 @@
+"""
+Asynchronous counterparts of the models, used by the ASGI app in asgi.py. They run the same
+queries against the same tables as models.py, through an asyncpg connection pool so that requests
+waiting on the database do not hold a thread.
+
+The pool is sized by the same DB_POOL_MIN_SIZE, DB_POOL_MAX_SIZE and DB_POOL_TIMEOUT environment
+variables as the pool of the synchronous models.
+"""
+import asyncio, itertools, os, re
+from contextlib import asynccontextmanager
+import asyncpg
+from .models import Orders, Menu, validator, menu_cache, seek_page, split_page
+from .storage import (
+    select_orders, insert_orders_statement, group_order_rows, MAX_ORDERS_PER_STATEMENT
+)
+from .pool import PoolTimeout
+
+
+def numbered(query):
+    """Rewrites the %s placeholders of a query written for psycopg2 as asyncpg's $1, $2, ..."""
+    numbers = itertools.count(1)
+    return re.sub('%s', lambda match: '${}'.format(next(numbers)), query)
+
+
+class AsyncPool:
+    """An asyncpg pool, created on first use since it must be created within the event loop"""
+    def __init__(self, dsn, min_size=1, max_size=10, timeout=5.0):
+        self.dsn = dsn
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self._pool = None
+        self._lock = asyncio.Lock()
+
+    async def open(self):
+        async with self._lock:
+            if self._pool is None:
+                self._pool = await asyncpg.create_pool(
+                    self.dsn, min_size=self.min_size, max_size=self.max_size
+                )
+        return self._pool
+
+    @asynccontextmanager
+    async def transaction(self):
+        """
+        Yields a connection checked out of the pool within a transaction, which is committed if
+        the block succeeds and rolled back otherwise
+        """
+        pool = self._pool or await self.open()
+        try:
+            conn = await pool.acquire(timeout=self.timeout)
+        except asyncio.TimeoutError:
+            raise PoolTimeout('Timed out waiting for a database connection')
+        try:
+            async with conn.transaction():
+                yield conn
+        finally:
+            await pool.release(conn)
+
+    async def close(self):
+        async with self._lock:
+            if self._pool is not None:
+                await self._pool.close()
+                self._pool = None
+
+
+_pool = None
+
+
+def get_async_pool():
+    """Returns this process's async pool, (re)creating it when DATABASE_URL changes"""
+    global _pool
+    dsn = os.getenv('DATABASE_URL')
+    if _pool is None or _pool.dsn != dsn:
+        _pool = AsyncPool(
+            dsn,
+            min_size=int(os.getenv('DB_POOL_MIN_SIZE', 1)),
+            max_size=int(os.getenv('DB_POOL_MAX_SIZE', 10)),
+            timeout=float(os.getenv('DB_POOL_TIMEOUT', 5))
+        )
+    return _pool
+
+
+class AsyncModel:
+    """Base class for the asynchronous model classes"""
+    def transaction(self):
+        return get_async_pool().transaction()
+
+    async def read_version(self, name):
+        """Returns the counter in the versions table that every write to table <name> bumps"""
+        async with self.transaction() as conn:
+            return await conn.fetchval('SELECT version FROM versions WHERE name = $1', name)
+
+
+class AsyncOrders(AsyncModel):
+    async def create_order(self, order, customer):
+        """Adds a new order to the database"""
+        prices = await AsyncMenu().get_price_index()
+        new_order = Orders.new_order(validator.validate_order(order), prices)
+        async with self.transaction() as conn:
+            await self.insert_orders(conn, [(customer, new_order)])
+        return new_order
+
+    async def create_orders(self, orders, customer, atomic=True):
+        """Adds many orders to the database at once, see Orders.create_orders"""
+        prices = await AsyncMenu().get_price_index()
+        results, new_orders = Orders.prepare_orders(orders, customer, prices, atomic)
+        if new_orders:
+            async with self.transaction() as conn:
+                for start in range(0, len(new_orders), MAX_ORDERS_PER_STATEMENT):
+                    batch = new_orders[start:start + MAX_ORDERS_PER_STATEMENT]
+                    await self.insert_orders(conn, batch)
+        return results
+
+    @staticmethod
+    async def insert_orders(conn, orders):
+        query, params = insert_orders_statement(orders)
+        await conn.execute(numbered(query), *params)
+
+    async def get_order_history_page(self, customer, limit, cursor=None):
+        """See Orders.get_order_history_page"""
+        where, params = seek_page('customer = %s', (customer, ), cursor)
+        async with self.transaction() as conn:
+            rows = await conn.fetch(numbered(select_orders(where, True)), *params, limit + 1)
+        page = split_page(list(group_order_rows(rows, include_customer=False)), limit)
+        if not page[0] and cursor is None:
+            raise Exception('No orders made by {}!'.format(customer))
+        return page
+
+
+class AsyncMenu(AsyncModel):
+    async def get_menu_version(self):
+        """Returns the version of the menu, discarding cached menu data if it has changed"""
+        version = menu_cache.recent_version()
+        if version is None:
+            version = menu_cache.update_version(await self.read_version('menu'))
+        return version
+
+    async def get_food_menu(self, return_id=True):
+        """Returns all food items in the menu, see Menu.get_food_menu"""
+        version = await self.get_menu_version()
+        return Menu.format_menu(await self.get_menu_items(version), return_id)
+
+    async def get_price_index(self):
+        """Returns the index orders are priced from, see Menu.get_price_index"""
+        version = await self.get_menu_version()
+        prices = menu_cache.lookup('prices', version)
+        if prices is None:
+            prices = Menu.index_prices(await self.get_menu_items(version))
+            menu_cache.store('prices', version, prices)
+        return prices
+
+    async def get_menu_items(self, version):
+        """Returns the rows of the menu table at <version>, from the menu cache if it has them"""
+        menu_items = menu_cache.lookup('items', version)
+        if menu_items is None:
+            async with self.transaction() as conn:
+                rows = await conn.fetch('SELECT id, item, unit, rate FROM menu ORDER BY id')
+            menu_items = tuple(tuple(row) for row in rows)
+            menu_cache.store('items', version, menu_items)
+        return menu_items
@@ -0,0 +1,321 @@
+"""
+Asynchronous (ASGI) serving mode of the API, run under an ASGI server with e.g.
+
+    gunicorn --worker-class uvicorn.workers.UvicornWorker --workers 4 fastfoodfast.asgi:app
+
+The routes under the heaviest load, placing orders, order history, the menu and the order event
+stream, are served on the event loop by the asynchronous models of aiomodels.py and the event hub
+of events.py, so requests waiting on the database or on events do not hold a thread. Every other
+route is served by the Flask app in a pool of ASGI_WSGI_THREADS threads (default 10), as are
+requests that the native handlers leave to it, such as ones without a valid access token or with
+malformed JSON, so both modes expose the same routes and JSON contracts.
+"""
+import asyncio, json, os, time
+from a2wsgi import WSGIMiddleware
+from flask import jsonify
+from flask_jwt_extended import decode_token
+from flask_jwt_extended.config import config
+from werkzeug.http import parse_etags, quote_etag, unquote_etag
+from werkzeug.urls import url_decode
+from .fastfoodfast import (
+    app as flask_app, get_page_arguments, read_bulk_orders, bulk_status_code, render_menu,
+    confirm_admin, order_event_filter, format_order_event, ROLE_CACHE_TTL,
+    ORDER_EVENTS_KEEPALIVE, ORDER_EVENTS_QUEUE_SIZE
+)
+from .admission import RATE_CHECKED, admission, client_key, verified_identity
+from .aiomodels import AsyncOrders, AsyncMenu, get_async_pool
+from . import encoding
+from .events import order_events, AsyncSubscription, AsyncFanOut
+from .ingestion import order_queue
+from .metrics import metrics
+from .models import menu_cache
+from .storage import get_storage
+
+wsgi_app = WSGIMiddleware(flask_app, workers=int(os.getenv('ASGI_WSGI_THREADS', 10)))
+orders_model = AsyncOrders()
+menu_model = AsyncMenu()
+event_fan_out = AsyncFanOut(order_events)
+
+
+class Deferred(Exception):
+    """Raised by a native handler to leave the request to the Flask app"""
+
+
+class Request:
+    """The parts of an HTTP request that the native handlers read"""
+    def __init__(self, scope, body):
+        self.body = body
+        self.headers = {
+            name.decode('latin-1').lower(): value.decode('latin-1')
+            for name, value in scope['headers']
+        }
+        self.args = url_decode(scope['query_string'])
+
+    def get_json(self):
+        """Returns the JSON body, or None if the request does not declare one, like Flask"""
+        mimetype = self.headers.get('content-type', '').split(';')[0].strip().lower()
+        if mimetype != 'application/json' and not (
+            mimetype.startswith('application/') and mimetype.endswith('+json')
+        ):
+            return None
+        try:
+            return json.loads(self.body)
+        except ValueError:
+            raise Deferred() # the Flask app answers malformed JSON with its usual error
+
+    def get_jwt_identity(self):
+        """
+        Returns the identity of the request's access token, leaving requests without a valid
+        one to the Flask app, which rejects them exactly as jwt_required does
+        """
+        return self.get_jwt()[0]
+
+    def get_jwt(self):
+        """Returns the identity and the user claims of the request's access token"""
+        parts = self.headers.get('authorization', '').split()
+        if len(parts) != 2 or parts[0] != 'Bearer':
+            raise Deferred()
+        try:
+            with flask_app.app_context():
+                token = decode_token(parts[1])
+                identity_claim, claims_key = config.identity_claim_key, config.user_claims_key
+        except Exception:
+            raise Deferred()
+        if token.get('type') != 'access':
+            raise Deferred()
+        return token[identity_claim], token.get(claims_key, {})
+
+
+def json_response(body, status_code, headers=()):
+    """Returns the status code, headers and body of the response that jsonify would give"""
+    with flask_app.app_context():
+        data = jsonify(body).get_data()
+    return status_code, [('Content-Type', 'application/json')] + list(headers), data
+
+
+async def place_new_order_for_food(request):
+    if order_queue is not None:
+        raise Deferred() # queued orders are journaled by the Flask app, on its threads
+    if 'idempotency-key' in request.headers:
+        raise Deferred() # keys are recorded by the Flask app
+    customer = request.get_jwt_identity()
+    order = request.get_json()
+    try:
+        created_order = await orders_model.create_order(order, customer)
+        return json_response(created_order, 201)
+    except Exception as e:
+        return json_response({'error': str(e)}, 400)
+
+
+async def place_new_orders_for_food(request):
+    if order_queue is not None:
+        raise Deferred()
+    customer = request.get_jwt_identity()
+    data = request.get_json()
+    try:
+        orders, atomic = read_bulk_orders(data)
+        results = await orders_model.create_orders(orders, customer, atomic)
+    except Exception as e:
+        return json_response({'error': str(e)}, 400)
+    created = sum(result['created'] for result in results)
+    return json_response({'created': created, 'results': results}, bulk_status_code(results))
+
+
+async def get_user_order_history(request):
+    if 'archived' in request.args:
+        raise Deferred() # the archive is listed by the Flask app
+    customer = request.get_jwt_identity()
+    try:
+        limit, cursor = get_page_arguments(request.args)
+    except Exception as e:
+        return json_response({'error': str(e)}, 400)
+    try:
+        orders, next_cursor = await orders_model.get_order_history_page(customer, limit, cursor)
+        return json_response({'orders': orders, 'next-cursor': next_cursor}, 200)
+    except Exception as e:
+        return json_response({'error': str(e)}, 404)
+
+
+async def get_food_items(request):
+    request.get_jwt_identity()
+    try:
+        version = await menu_model.get_menu_version()
+        rendered = menu_cache.lookup('response', version)
+        if rendered is None:
+            menu = await menu_model.get_food_menu()
+            with flask_app.app_context():
+                rendered = render_menu(menu)
+            menu_cache.store('response', version, rendered)
+    except Exception as e:
+        return json_response({'error': str(e)}, 404)
+    body, etag = rendered
+    headers = [('ETag', quote_etag(etag))]
+    if encoding.etag_matches(parse_etags(request.headers.get('if-none-match')), etag):
+        return 304, headers, b''
+    return 200, [('Content-Type', 'application/json')] + headers, body
+
+
+async def get_order_events(request):
+    identity, claims = request.get_jwt()
+    admin = claims.get('admin', False)
+    if admin and ROLE_CACHE_TTL:
+        admin = await asyncio.get_running_loop().run_in_executor(None, confirm_admin, identity)
+    headers = [
+        ('Content-Type', 'text/event-stream; charset=utf-8'), ('Cache-Control', 'no-cache'),
+        ('X-Accel-Buffering', 'no')
+    ]
+    return 200, headers, stream_order_events(order_event_filter(identity, admin))
+
+
+async def stream_order_events(accept):
+    """The asynchronous counterpart of fastfoodfast.stream_order_events"""
+    subscription = AsyncSubscription(accept, ORDER_EVENTS_QUEUE_SIZE)
+    event_fan_out.subscribe(subscription)
+    try:
+        yield b'retry: 3000\n\n'
+        while not subscription.overflowed:
+            event = await subscription.get(ORDER_EVENTS_KEEPALIVE)
+            yield (': keep-alive\n\n' if event is None else format_order_event(event)).encode()
+    finally:
+        event_fan_out.unsubscribe(subscription)
+
+
+ROUTES = {
+    ('POST', '/api/v1/users/orders'): place_new_order_for_food,
+    ('POST', '/api/v1/users/orders/bulk'): place_new_orders_for_food,
+    ('GET', '/api/v1/users/orders'): get_user_order_history,
+    ('GET', '/api/v1/menu'): get_food_items,
+    ('GET', '/api/v1/orders/events'): get_order_events
+}
+
+
+async def read_body(receive):
+    chunks = list()
+    while True:
+        message = await receive()
+        chunks.append(message.get('body', b''))
+        if not message.get('more_body', False):
+            return b''.join(chunks)
+
+
+async def stream(chunks, receive, send):
+    """Sends the body <chunks> as they come, until they run out or the client disconnects"""
+    async def until_disconnected():
+        while (await receive())['type'] != 'http.disconnect':
+            pass
+    disconnected = asyncio.ensure_future(until_disconnected())
+    try:
+        while True:
+            chunk = asyncio.ensure_future(chunks.__anext__())
+            await asyncio.wait([chunk, disconnected], return_when=asyncio.FIRST_COMPLETED)
+            if not chunk.done():
+                chunk.cancel() # unwinds the generator, which must end before it can be closed
+                await asyncio.wait([chunk])
+                return
+            try:
+                data = chunk.result()
+            except StopAsyncIteration:
+                break
+            await send({'type': 'http.response.body', 'body': data, 'more_body': True})
+        await send({'type': 'http.response.body', 'body': b''})
+    finally:
+        disconnected.cancel()
+        await chunks.aclose()
+
+
+def compress(request, status_code, headers, data):
+    """
+    Compresses the JSON <data> of a native response as encoding.compress_response does the
+    responses of the Flask app, returning its headers and body
+    """
+    if not encoding.COMPRESSION_LEVEL:
+        return headers, data
+    headers.append(('Vary', 'Accept-Encoding'))
+    content_coding = encoding.negotiate_encoding(request.headers.get('accept-encoding'))
+    if content_coding is None:
+        return headers, data
+    if status_code != 304 and len(data) < encoding.COMPRESSION_MIN_SIZE:
+        return headers, data
+    coded_headers = list()
+    for name, value in headers:
+        if name == 'ETag':
+            etag, weak = unquote_etag(value)
+            coded = encoding.coded_etag(etag, content_coding)
+            # a 304 takes the ETag of the coding only if the client's cached body is compressed
+            if status_code != 304 or parse_etags(
+                request.headers.get('if-none-match')
+            ).contains_weak(coded):
+                value = quote_etag(coded, weak)
+        coded_headers.append((name, value))
+    if status_code == 304:
+        return coded_headers, data
+    return coded_headers + [('Content-Encoding', content_coding)], encoding.compress(
+        data, content_coding
+    )
+
+
+def replay(body, receive):
+    """Returns a receive callable giving the already read <body> again, then the client's messages"""
+    pending = [{'type': 'http.request', 'body': body, 'more_body': False}]
+
+    async def replayed():
+        return pending.pop() if pending else await receive()
+    return replayed
+
+
+async def admit(request, scope, handler):
+    """Runs <handler> for <request> if admission control admits it, as the Flask app would"""
+    rejection = admission.admit(scope['method'], scope['path'], lambda: client_key(
+        verified_identity(request.headers.get('authorization'), request.get_jwt_identity)
+    ))
+    if rejection is not None:
+        status_code, error, retry_after = rejection
+        return json_response({'error': error}, status_code, [('Retry-After', str(retry_after))])
+    scope[RATE_CHECKED] = True # the token is taken, even if the handler defers to Flask
+    try:
+        return await handler(request)
+    finally:
+        if admission.capped(scope['path']):
+            admission.leave()
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await get_async_pool().close()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope, receive, send):
+    """The ASGI application"""
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+    handler = ROUTES.get((scope.get('method'), scope.get('path')))
+    if handler is None or get_storage().name != 'postgres': # the native handlers need PostgreSQL
+        return await wsgi_app(scope, receive, send)
+    body = await read_body(receive)
+    started = time.perf_counter()
+    request = Request(scope, body)
+    try:
+        status_code, headers, data = await admit(request, scope, handler)
+    except Deferred:
+        return await wsgi_app(scope, replay(body, receive), send)
+    metrics.observe_request(
+        scope['path'], scope['method'], status_code, time.perf_counter() - started
+    )
+    headers.append(('Access-Control-Allow-Origin', '*')) # as flask_cors adds to Flask's responses
+    if isinstance(data, bytes):
+        headers, data = compress(request, status_code, headers, data)
+        headers.append(('Content-Length', str(len(data))))
+    await send({
+        'type': 'http.response.start', 'status': status_code,
+        'headers': [(name.lower().encode(), value.encode()) for name, value in headers]
+    })
+    if isinstance(data, bytes):
+        await send({'type': 'http.response.body', 'body': data})
+    else:
+        await stream(data, receive, send)
@@ -0,0 +1,117 @@
+"""
+In-process caching of data that changes rarely, such as the food menu or user roles.
+
+For a VersionedCache, a trigger on the cached table bumps its counter in the versions table
+within the transaction of every write to it. Readers compare the counter with the version their
+cache was filled at, so a write made through any worker process, or directly in the database,
+invalidates the caches of all of them.
+"""
+import threading, time
+from collections import OrderedDict
+
+
+class VersionedCache:
+    def __init__(self, name, check_interval=0.0):
+        """
+        <name> identifies the counter in the versions table. The counter is read at most once
+        every <check_interval> seconds, which bounds how stale a cached value may get.
+        """
+        self.name = name
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._version = None
+        self._values = dict()
+        self._checked_at = None
+
+    def current_version(self, read_version):
+        """Returns the current version, calling <read_version> unless it was checked recently"""
+        version = self.recent_version()
+        if version is None:
+            version = self.update_version(read_version())
+        return version
+
+    def recent_version(self):
+        """Returns the version if it was checked within <check_interval> seconds, else None"""
+        now = time.monotonic()
+        with self._lock:
+            if self._checked_at is not None and now - self._checked_at < self.check_interval:
+                return self._version
+        return None
+
+    def update_version(self, version):
+        """Records <version> as just read, dropping all values if it differs from the last one"""
+        with self._lock:
+            if version != self._version:
+                self._version = version
+                self._values = dict()
+            self._checked_at = time.monotonic()
+        return version
+
+    def get(self, key, version, compute):
+        """
+        Returns the value of <key> at <version>, calling <compute> on a miss. Values are only
+        stored while <version> is current, so <compute> must read data no older than it.
+        """
+        value = self.lookup(key, version)
+        if value is None:
+            value = compute()
+            self.store(key, version, value)
+        return value
+
+    def lookup(self, key, version):
+        """Returns the value of <key> at <version>, or None if it is not cached"""
+        with self._lock:
+            if version == self._version:
+                return self._values.get(key)
+        return None
+
+    def store(self, key, version, value):
+        """Caches <value> as that of <key>, unless <version> is no longer current"""
+        with self._lock:
+            if version == self._version:
+                self._values[key] = value
+
+    def invalidate(self):
+        """Drops all values, forcing the version to be read again on next access"""
+        with self._lock:
+            self._version = None
+            self._values = dict()
+            self._checked_at = None
+
+
+class TTLCache:
+    """
+    A mapping of at most <max_size> entries, evicting the least recently used first, whose
+    entries expire <ttl> seconds after they were set, unless they are set with a ttl of their own
+    """
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict() # key: (value, expiry time)
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+            if entry[1] <= time.monotonic():
+                del self._entries[key]
+                return default
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + (self.ttl if ttl is None else ttl))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+        return default if entry is None else entry[0]
+
+    def __len__(self):
+        return len(self._entries)
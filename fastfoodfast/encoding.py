@@ -0,0 +1,141 @@
+"""
+JSON encoding and compression of the API's responses.
+
+JSON_ENCODER selects the encoder behind jsonify and the app's other serializations: 'orjson',
+the default when it is installed, serializes in native code several times faster than 'json', the
+standard library encoder that is used otherwise. Both give the same documents, although orjson
+writes them without spaces and leaves non-ASCII characters unescaped, as UTF-8.
+
+Responses of at least COMPRESSION_MIN_SIZE bytes (default 1024) are compressed with gzip or
+deflate, whichever the client's Accept-Encoding prefers, at COMPRESSION_LEVEL (1 to 9, default 6;
+0 turns compression off). Order listings repeat the same keys for every order, so they shrink
+several times over. Streamed listings are compressed chunk by chunk as they are sent, whatever
+their size; event streams are left alone, as their events are small and must not be held back.
+A compressed response's ETag is that of its uncompressed body suffixed with the content coding,
+e.g. "<etag>-gzip", so that each coding of a body keeps a strong ETag of its own, and responses
+that are not compressed keep theirs unchanged.
+"""
+import os, zlib
+from flask import json, request
+from werkzeug.http import parse_accept_header
+
+try:
+    import orjson
+except ImportError: # optional, the standard library encoder is used without it
+    orjson = None
+
+ENCODERS = ('orjson', 'json')
+JSON_ENCODER = os.getenv('JSON_ENCODER', 'orjson' if orjson is not None else 'json')
+if JSON_ENCODER not in ENCODERS:
+    raise ValueError('JSON_ENCODER must be one of ' + ', '.join(ENCODERS))
+if JSON_ENCODER == 'orjson' and orjson is None:
+    raise ValueError('JSON_ENCODER is orjson, which is not installed')
+COMPRESSION_LEVEL = int(os.getenv('COMPRESSION_LEVEL', 6))
+COMPRESSION_MIN_SIZE = int(os.getenv('COMPRESSION_MIN_SIZE', 1024))
+COMPRESSIBLE_MIMETYPES = {
+    'application/json', 'application/x-ndjson', 'text/plain', 'text/html', 'text/css',
+    'application/javascript'
+}
+# window bits of zlib giving a gzip (RFC 1952) or a zlib (RFC 1950, HTTP's deflate) stream
+WINDOW_BITS = {'gzip': 16 + zlib.MAX_WBITS, 'deflate': zlib.MAX_WBITS}
+
+
+class JSONEncoder(json.JSONEncoder):
+    """Flask's JSON encoder, serializing with orjson when JSON_ENCODER selects it"""
+    def encode(self, o):
+        if JSON_ENCODER == 'orjson' and self.indent is None:
+            # dates are passed through to Flask's default(), which formats them as HTTP dates
+            options = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+            if self.sort_keys:
+                options |= orjson.OPT_SORT_KEYS
+            try:
+                return orjson.dumps(o, default=self.default, option=options).decode()
+            except orjson.JSONEncodeError:
+                pass # e.g. integers beyond 64 bits, which the standard library encoder takes
+        return super().encode(o)
+
+
+def negotiate_encoding(accept_encoding):
+    """Returns the content coding, gzip or deflate, that <accept_encoding> prefers, or None"""
+    if not COMPRESSION_LEVEL or not accept_encoding:
+        return None
+    return parse_accept_header(accept_encoding).best_match(tuple(WINDOW_BITS))
+
+
+def coded_etag(etag, encoding):
+    """Returns the ETag of the body tagged <etag> once compressed with <encoding>"""
+    return '{}-{}'.format(etag, encoding)
+
+
+def etag_matches(etags, etag):
+    """
+    True if the parsed If-None-Match header <etags> matches <etag>, whether the client cached the
+    body it tags uncompressed or in one of the content codings
+    """
+    return etags.contains_weak(etag) or any(
+        etags.contains_weak(coded_etag(etag, encoding)) for encoding in WINDOW_BITS
+    )
+
+
+def compressor(encoding):
+    return zlib.compressobj(COMPRESSION_LEVEL, zlib.DEFLATED, WINDOW_BITS[encoding])
+
+
+def compress(data, encoding):
+    """Returns <data> compressed with <encoding>"""
+    stream = compressor(encoding)
+    return stream.compress(data) + stream.flush()
+
+
+def compress_chunks(chunks, encoding, charset='utf-8'):
+    """
+    Compresses the body <chunks> of a streamed response as they come, flushing the compressed
+    stream after every chunk so that the client is not kept waiting for data already produced
+    """
+    stream = compressor(encoding)
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode(charset)
+        data = stream.compress(chunk) + stream.flush(zlib.Z_SYNC_FLUSH)
+        if data:
+            yield data
+    yield stream.flush()
+
+
+def compress_response(response):
+    """Compresses <response> in the encoding negotiated with the client, if it is worth it"""
+    if not COMPRESSION_LEVEL or response.mimetype not in COMPRESSIBLE_MIMETYPES or (
+        'Content-Encoding' in response.headers
+    ):
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = negotiate_encoding(request.headers.get('Accept-Encoding'))
+    if encoding is None:
+        return response
+    etag, weak = response.get_etag()
+    if response.status_code == 304:
+        # the client's cached body is compressed if it sent the ETag of this coding
+        if etag and request.if_none_match.contains_weak(coded_etag(etag, encoding)):
+            response.set_etag(coded_etag(etag, encoding), weak)
+        return response
+    if response.status_code in (204, 206) or request.method == 'HEAD':
+        return response
+    if response.is_streamed:
+        response.response = compress_chunks(response.response, encoding, response.charset)
+        response.headers.pop('Content-Length', None)
+    else:
+        data = response.get_data()
+        if len(data) < COMPRESSION_MIN_SIZE:
+            return response
+        response.set_data(compress(data, encoding))
+    response.headers['Content-Encoding'] = encoding
+    if etag:
+        response.set_etag(coded_etag(etag, encoding), weak)
+    return response
+
+
+def init_app(app):
+    """Serializes the JSON of <app> with the selected encoder and compresses its responses"""
+    if not issubclass(app.json_encoder, JSONEncoder):
+        app.json_encoder = JSONEncoder
+    app.after_request(compress_response)
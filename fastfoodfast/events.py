@@ -0,0 +1,167 @@
+"""
+Push delivery of order changes. Triggers on the orders table publish an event on the
+order_events channel through PostgreSQL's NOTIFY whenever an order is created or its status
+changes, however it was written.
+
+Each process listens on the channel with a single connection, held by an EventHub thread, and
+hands every event to its in-process subscribers, so the database sees one listening connection
+per process however many clients stream events. Subscribers are bounded queues: one that falls
+ORDER_EVENTS_QUEUE_SIZE events behind is cut off, and its client should reconnect and refetch.
+Events published while the listening connection is down are lost in the same way.
+"""
+import asyncio, itertools, json, os, queue, select, threading, time
+import psycopg2, psycopg2.extensions
+
+CHANNEL = 'order_events'
+
+
+class EventHub:
+    def __init__(self, channel, connect=psycopg2.connect, reconnect_delay=1.0):
+        """
+        Relays the notifications of <channel>, decoded from JSON, to subscribers. <connect> is
+        called with the DATABASE_URL to open the listening connection.
+        """
+        self.channel = channel
+        self.connect = connect
+        self.reconnect_delay = reconnect_delay
+        self._subscribers = dict()
+        self._keys = itertools.count()
+        self._lock = threading.Lock()
+        self._listener = None
+        self._listener_pid = None
+        self.listening = threading.Event() # set while the listening connection is up
+
+    def subscribe(self, deliver):
+        """
+        Starts calling <deliver> with every event, from the listener thread, so it must not
+        block. Returns a key to unsubscribe with.
+        """
+        with self._lock:
+            if self._listener is None or self._listener_pid != os.getpid():
+                # not yet listening, or the listener belongs to the process this one forked from
+                self._listener = threading.Thread(target=self._listen, daemon=True)
+                self._listener_pid = os.getpid()
+                self._listener.start()
+            key = next(self._keys)
+            self._subscribers[key] = deliver
+        return key
+
+    def unsubscribe(self, key):
+        with self._lock:
+            self._subscribers.pop(key, None)
+
+    def publish(self, event):
+        """Hands <event> to every subscriber"""
+        with self._lock:
+            subscribers = list(self._subscribers.values())
+        for deliver in subscribers:
+            deliver(event)
+
+    def subscriber_count(self):
+        return len(self._subscribers)
+
+    def _listen(self):
+        while True:
+            conn = None
+            try:
+                conn = self.connect(os.getenv('DATABASE_URL'))
+                conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+                conn.cursor().execute('LISTEN {}'.format(self.channel))
+                self.listening.set()
+                while True:
+                    if select.select([conn], [], [], 60) == ([], [], []):
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        try:
+                            event = json.loads(conn.notifies.pop(0).payload)
+                        except ValueError:
+                            continue
+                        self.publish(event)
+            except (psycopg2.Error, OSError):
+                self.listening.clear()
+                time.sleep(self.reconnect_delay)
+            finally:
+                if conn is not None:
+                    conn.close()
+
+
+class Subscription:
+    """The events accepted by <accept>, queued for a client until it falls <size> events behind"""
+    def __init__(self, accept, size):
+        self.accept = accept
+        self.events = queue.Queue(size)
+        self.overflowed = False
+
+    def deliver(self, event):
+        if self.accept(event):
+            try:
+                self.events.put_nowait(event)
+            except queue.Full:
+                self.overflowed = True
+
+    def get(self, timeout):
+        """Returns the next event, or None if there was none within <timeout> seconds"""
+        try:
+            return self.events.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+class AsyncSubscription(Subscription):
+    """A Subscription consumed on an event loop"""
+    def __init__(self, accept, size):
+        super().__init__(accept, size)
+        self.events = asyncio.Queue(size)
+
+    def deliver(self, event):
+        if self.accept(event):
+            try:
+                self.events.put_nowait(event)
+            except asyncio.QueueFull:
+                self.overflowed = True
+
+    async def get(self, timeout):
+        try:
+            return await asyncio.wait_for(self.events.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+
+class AsyncFanOut:
+    """
+    Relays the events of <hub> to the AsyncSubscriptions of one event loop with a single hub
+    subscriber, which wakes the loop once per event however many subscriptions there are
+    """
+    def __init__(self, hub):
+        self.hub = hub
+        self._loop = None
+        self._key = None
+        self._subscriptions = set()
+
+    def subscribe(self, subscription):
+        """Subscribes <subscription>, which must be called from the running event loop"""
+        if self._loop is not asyncio.get_running_loop():
+            if self._key is not None:
+                self.hub.unsubscribe(self._key)
+            self._loop = asyncio.get_running_loop()
+            self._subscriptions = set()
+            self._key = self.hub.subscribe(self._relay)
+        self._subscriptions.add(subscription)
+
+    def unsubscribe(self, subscription):
+        self._subscriptions.discard(subscription)
+
+    def _relay(self, event):
+        """Called from the hub's listener thread, schedules the fan out on the event loop"""
+        try:
+            self._loop.call_soon_threadsafe(self._fan_out, event)
+        except RuntimeError: # the loop has been closed
+            pass
+
+    def _fan_out(self, event):
+        for subscription in list(self._subscriptions):
+            subscription.deliver(event)
+
+
+order_events = EventHub(CHANNEL)
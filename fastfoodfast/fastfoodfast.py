@@ -2,10 +2,25 @@
 Definitions of API routes for managing users, orders, and food menu data.
 """
 
-from flask import Flask, request, jsonify, Response
-from werkzeug.security import check_password_hash
-from flask_jwt_extended import JWTManager, jwt_required, create_access_token, get_jwt_identity
-from .models import Users, Orders, Menu
+from flask import Flask, request, jsonify, Response, json, stream_with_context
+from flask_jwt_extended import (
+    JWTManager, jwt_required, create_access_token, get_jwt_identity, get_jwt_claims
+)
+from .models import Users, Orders, Menu, OrderNotFound, decode_cursor, menu_cache
+from .cache import TTLCache
+from .hashing import HashingOverloaded
+from .ingestion import QueueFull, order_queue, init_app as init_ingestion
+from .idempotency import KeyReused, Replayed, check_key, fingerprint
+from .events import order_events, Subscription
+from .metrics import metrics, init_app as init_metrics
+from .encoding import etag_matches, init_app as init_encoding
+from .admission import init_app as init_admission
+from .storage import get_storage
+from hashlib import sha1
+from datetime import datetime, timedelta, timezone
+import hmac
+from functools import wraps
+import os
 from flasgger import Swagger
 from flasgger.utils import swag_from
 from flask_cors import CORS
@@ -16,9 +31,215 @@ app.config['JWT_SECRET_KEY'] = 'secret-key'
 jwt = JWTManager(app)
 Swagger(app)
 CORS(app)
+init_metrics(app)
+init_encoding(app)
+init_admission(app)
+init_ingestion(app)
 users_model = Users()
 orders_model = Orders()
 menu_model = Menu()
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+MAX_BULK_ORDERS = int(os.getenv('MAX_BULK_ORDERS', 1000)) # orders accepted by one bulk request
+DEFAULT_REPORT_DAYS = 30 # days covered by a sales report when no range is given
+MAX_REPORT_DAYS = 366
+MAX_REPORT_ITEMS = 100
+STREAM_MIMETYPES = {'json': 'application/json', 'ndjson': 'application/x-ndjson'}
+# admin claims are trusted for as long as tokens live unless ROLE_CACHE_TTL is set, in which case
+# they are confirmed against the database at most once per ROLE_CACHE_TTL seconds, bounding how
+# long a revoked admin keeps access
+ROLE_CACHE_TTL = float(os.getenv('ROLE_CACHE_TTL', 0))
+role_cache = TTLCache(max_size=1024, ttl=ROLE_CACHE_TTL)
+# seconds between keep-alive comments of an idle event stream, and events a stream may fall behind
+ORDER_EVENTS_KEEPALIVE = float(os.getenv('ORDER_EVENTS_KEEPALIVE', 15))
+ORDER_EVENTS_QUEUE_SIZE = int(os.getenv('ORDER_EVENTS_QUEUE_SIZE', 100))
+# if set, scrapers of /metrics must send it as a bearer token
+METRICS_TOKEN = os.getenv('METRICS_TOKEN')
+
+
+def admin_required(message):
+    """
+    Lets only admins through to the decorated route, answering everyone else with 401 and
+    <message>. The role is read from the claims of the already verified access token.
+    """
+    def decorator(route):
+        @wraps(route)
+        def wrapper(*args, **kwargs):
+            if not get_jwt_claims().get('admin', False) or not confirm_admin(get_jwt_identity()):
+                return jsonify({'error': message}), 401
+            return route(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def confirm_admin(identity):
+    """Confirms an admin claim against the database through role_cache if ROLE_CACHE_TTL is set"""
+    if not ROLE_CACHE_TTL:
+        return True
+    admin = role_cache.get(identity)
+    if admin is None:
+        admin = users_model.is_admin(identity)
+        role_cache.set(identity, admin)
+    return admin
+
+
+def get_page_arguments(args):
+    """Reads the 'limit' and 'cursor' query parameters of a paginated listing from <args>"""
+    limit = args.get('limit', DEFAULT_PAGE_SIZE)
+    try:
+        limit = int(limit)
+    except ValueError:
+        raise Exception('limit must be an integer')
+    if not 1 <= limit <= MAX_PAGE_SIZE:
+        raise Exception('limit must be between 1 and {}'.format(MAX_PAGE_SIZE))
+    cursor = args.get('cursor')
+    if cursor is not None:
+        decode_cursor(cursor) # reject malformed cursors before querying
+    return limit, cursor
+
+
+def get_archived_argument(args):
+    """Reads the 'archived' query parameter, which selects the archived orders of a listing"""
+    archived = args.get('archived', 'false')
+    if archived not in ('true', 'false'):
+        raise Exception('archived must be true or false')
+    return archived == 'true'
+
+
+def get_report_arguments(args):
+    """Reads the 'from' and 'to' days and the 'top' items of a sales report from <args>"""
+    try:
+        last_day = parse_day(args['to']) if 'to' in args else datetime.now(timezone.utc).date()
+        first_day = parse_day(args['from']) if 'from' in args else (
+            last_day - timedelta(days=DEFAULT_REPORT_DAYS - 1)
+        )
+    except ValueError:
+        raise Exception('from and to must be dates formatted as YYYY-MM-DD')
+    if first_day > last_day:
+        raise Exception('from must not be after to')
+    if (last_day - first_day).days >= MAX_REPORT_DAYS:
+        raise Exception('A report can cover at most {} days'.format(MAX_REPORT_DAYS))
+    try:
+        top = int(args.get('top', 10))
+    except ValueError:
+        raise Exception('top must be an integer')
+    if not 1 <= top <= MAX_REPORT_ITEMS:
+        raise Exception('top must be between 1 and {}'.format(MAX_REPORT_ITEMS))
+    return first_day, last_day, top
+
+
+def parse_day(value):
+    return datetime.strptime(value, '%Y-%m-%d').date()
+
+
+def stream_orders(orders, lines=False, batch_size=100):
+    """
+    Serializes orders lazily, <batch_size> at a time: as newline delimited JSON when <lines> is
+    set, otherwise as chunks of the same {"orders": [...]} document that listings return
+    """
+    # one encoder serializes every order, sparing the setup json.dumps does on each call
+    encode = app.json_encoder(
+        ensure_ascii=app.config['JSON_AS_ASCII'], sort_keys=app.config['JSON_SORT_KEYS']
+    ).encode
+    if not lines:
+        yield '{"orders": ['
+    batch = list()
+    for index, order in enumerate(orders):
+        text = encode(order)
+        batch.append(text + '\n' if lines else (',' if index else '') + text)
+        if len(batch) == batch_size:
+            yield ''.join(batch)
+            batch = list()
+    if not lines:
+        batch.append(']}')
+    if batch:
+        yield ''.join(batch)
+
+
+def order_event_filter(identity, admin):
+    """Admins are sent the events of all orders, other users those of their own orders"""
+    if admin:
+        return lambda event: True
+    return lambda event: event.get('customer') == identity
+
+
+def format_order_event(event):
+    return 'event: order\ndata: {}\n\n'.format(json.dumps(event))
+
+
+def stream_order_events(accept):
+    """
+    Yields server-sent events of the order changes accepted by <accept>, with a keep-alive
+    comment whenever none came for ORDER_EVENTS_KEEPALIVE seconds. The stream ends if the client
+    falls too far behind, and the client's EventSource then reconnects.
+    """
+    subscription = Subscription(accept, ORDER_EVENTS_QUEUE_SIZE)
+    key = order_events.subscribe(subscription.deliver)
+    try:
+        yield 'retry: 3000\n\n'
+        while not subscription.overflowed:
+            event = subscription.get(ORDER_EVENTS_KEEPALIVE)
+            yield ': keep-alive\n\n' if event is None else format_order_event(event)
+    finally:
+        order_events.unsubscribe(key)
+
+
+def overloaded(error, retry_after=1):
+    """Sheds load with 503, asking the client to retry after <retry_after> seconds"""
+    response = jsonify({'error': str(error)})
+    response.headers['Retry-After'] = str(retry_after)
+    return response, 503
+
+
+def replayed(response):
+    """Answers a retried request with the <response> recorded for its idempotency key"""
+    status, body = response
+    return Response(
+        body + '\n', status, mimetype='application/json', headers={'Idempotent-Replayed': 'true'}
+    )
+
+
+def read_bulk_orders(data):
+    """Returns the orders and the atomic flag of bulk order request data"""
+    if not isinstance(data, dict) or not isinstance(data.get('orders'), list):
+        raise Exception('Specify orders as a list in JSON format!')
+    if len(data['orders']) > MAX_BULK_ORDERS:
+        raise Exception('At most {} orders can be placed at once!'.format(MAX_BULK_ORDERS))
+    atomic = data.get('atomic', True)
+    if not isinstance(atomic, bool):
+        raise Exception('Specify atomic as true or false!')
+    return data['orders'], atomic
+
+
+def read_status_update(data):
+    """Returns the status, order ids and current status of bulk status update request data"""
+    if not isinstance(data, dict) or 'status' not in data:
+        raise Exception('Specify status in your request data')
+    if set(data) - {'status', 'order-ids', 'from-status'}:
+        raise Exception('Redundant data in status request')
+    order_ids = data.get('order-ids')
+    if isinstance(order_ids, list) and len(order_ids) > MAX_BULK_ORDERS:
+        raise Exception('At most {} orders can be updated at once!'.format(MAX_BULK_ORDERS))
+    return data['status'], order_ids, data.get('from-status')
+
+
+def bulk_status_code(results, success=201):
+    """
+    <success> if all orders of a bulk request were created, or accepted if they are queued,
+    207 if only some were and 400 if none were
+    """
+    created = sum(result['created'] for result in results)
+    return success if created == len(results) else 207 if created else 400
+
+
+def render_food_menu():
+    """Serializes the menu once per menu version, returning the body and its strong ETag"""
+    return render_menu(menu_model.get_food_menu())
+
+
+def render_menu(menu):
+    body = json.dumps({'menu': menu}).encode()
+    return body, sha1(body).hexdigest()
 
 
 @app.route('/api/v1/auth/signup', methods=['POST'])
@@ -29,6 +250,8 @@ def register_a_user():
         user_data = request.get_json()
         users_model.register_user(user_data)
         return jsonify({'message': 'you were successfully registered!'}), 201
+    except HashingOverloaded as e:
+        return overloaded(e)
     except Exception as e:
         return jsonify({'error': str(e)}), 400
 
@@ -40,15 +263,19 @@ def login_a_user():
     try:
         data = request.get_json()
         user = users_model.get_user(data['username'])
-        if not check_password_hash(user['password'], data['password']):
+        if not users_model.check_password(user, data['password']):
             return jsonify({'error': 'wrong password'}), 401
-        token = create_access_token(identity=user['username'])
+        token = create_access_token(
+            identity=user['username'], user_claims={'admin': user['admin']}
+        )
         response_body = {
             'message': 'You have been successfully logged in!',
-            'admin': users_model.is_admin(user['username']),
+            'admin': user['admin'],
             'token': token
         }
         return jsonify(response_body), 200
+    except HashingOverloaded as e:
+        return overloaded(e)
     except Exception as e:
         return jsonify({'error': str(e)}), 400
 
@@ -57,14 +284,52 @@ def login_a_user():
 @jwt_required
 @swag_from('docs/place_order.yml')
 def place_new_order_for_food():
-    """Adds a new order for food to the database"""
+    """
+    Adds a new order for food to the database, once per Idempotency-Key if the client sends one,
+    answering its retries with the response to its first request
+    """
     try:
+        customer = get_jwt_identity()
+        key, request_hash = request.headers.get('Idempotency-Key'), None
+        if key is not None:
+            key, request_hash = check_key(key), fingerprint(request.get_data())
+            recorded = orders_model.find_response(customer, key, request_hash)
+            if recorded is not None:
+                return replayed(recorded)
         order = request.get_json()
+        created_order = orders_model.create_order(order, customer, key, request_hash)
+        # a queued order is accepted, and created once the queue is flushed
+        return jsonify(created_order), orders_model.created_status
+    except Replayed as e:
+        return replayed(e.response)
+    except KeyReused as e:
+        return jsonify({'error': str(e)}), 422
+    except QueueFull as e:
+        return overloaded(e)
+    except Exception as e:
+        return jsonify({'error': str(e)}), 400
+
+
+@app.route('/api/v1/users/orders/bulk', methods=['POST'])
+@jwt_required
+@swag_from('docs/place_orders.yml')
+def place_new_orders_for_food():
+    """
+    Adds many orders for food to the database in one transaction, answering with a result per
+    order: 201 if all were created, 207 if only some were and 400 if none were
+    """
+    try:
+        orders, atomic = read_bulk_orders(request.get_json())
         customer = get_jwt_identity()
-        created_order = orders_model.create_order(order, customer)
-        return jsonify(created_order), 201
+        results = orders_model.create_orders(orders, customer, atomic)
+    except QueueFull as e:
+        return overloaded(e)
     except Exception as e:
         return jsonify({'error': str(e)}), 400
+    created = sum(result['created'] for result in results)
+    return jsonify({'created': created, 'results': results}), bulk_status_code(
+        results, 202 if orders_model.queued else 201
+    )
 
 
 @app.route('/api/v1/users/orders', methods=['GET'])
@@ -72,53 +337,106 @@ def place_new_order_for_food():
 @swag_from('docs/order_history.yml')
 def get_user_order_history():
     """Gets a list of orders made by a user in the past"""
+    try:
+        limit, cursor = get_page_arguments(request.args)
+        archived = get_archived_argument(request.args)
+    except Exception as e:
+        return jsonify({'error': str(e)}), 400
     try:
         customer = get_jwt_identity()
-        orders = orders_model.get_order_history(customer)
-        return jsonify({'orders': orders}), 200
+        orders, next_cursor = orders_model.get_order_history_page(
+            customer, limit, cursor, archived
+        )
+        return jsonify({'orders': orders, 'next-cursor': next_cursor}), 200
     except Exception as e:
         return jsonify({'error': str(e)}), 404
 
 
 @app.route('/api/v1/orders', methods=['GET'])
 @jwt_required
+@admin_required('only admin can get all orders')
 @swag_from('docs/orders.yml')
 def get_all_orders():
     """Retrieves all food orders from the database"""
+    stream_format = request.args.get('stream')
     try:
-        identity = get_jwt_identity()
-        if not users_model.is_admin(identity):
-            return jsonify({'error': 'only admin can get all orders'}), 401
-        return jsonify({'orders': orders_model.get_all_orders()}), 200
+        limit, cursor = get_page_arguments(request.args)
+        archived = get_archived_argument(request.args)
+        if stream_format is not None and stream_format not in STREAM_MIMETYPES:
+            raise Exception('stream must be one of json or ndjson')
+    except Exception as e:
+        return jsonify({'error': str(e)}), 400
+    try:
+        if stream_format is not None:
+            orders = orders_model.stream_all_orders(archived=archived)
+            return Response(
+                stream_with_context(stream_orders(orders, lines=stream_format == 'ndjson')),
+                mimetype=STREAM_MIMETYPES[stream_format]
+            )
+        orders, next_cursor = orders_model.get_all_orders_page(limit, cursor, archived)
+        return jsonify({'orders': orders, 'next-cursor': next_cursor}), 200
     except Exception as e:
         return jsonify({'error': str(e)}), 404
 
 
+@app.route('/api/v1/orders/events', methods=['GET'])
+@jwt_required
+@swag_from('docs/order_events.yml')
+def get_order_events():
+    """Streams creations and status changes of orders as server-sent events"""
+    identity = get_jwt_identity()
+    admin = get_jwt_claims().get('admin', False) and confirm_admin(identity)
+    response = Response(
+        stream_order_events(order_event_filter(identity, admin)), mimetype='text/event-stream'
+    )
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no' # keep proxies from buffering the stream
+    return response
+
+
 @app.route('/api/v1/orders/<order_id>', methods=['GET'])
 @jwt_required
+@admin_required('only admin can fetch a specific order')
 @swag_from('docs/order.yml')
 def get_specific_order(order_id):
     """Retrieves a specific food order from the database"""
     try:
-        if not users_model.is_admin(get_jwt_identity()):
-            return jsonify({'error': 'only admin can fetch a specific order'}), 401
         order = orders_model.get_specific_order(order_id)
         return jsonify(order), 200
     except Exception as e:
         return jsonify({'error': str(e)}), 404
 
 
+@app.route('/api/v1/orders/status', methods=['PUT'])
+@jwt_required
+@admin_required('only admin can update order status')
+@swag_from('docs/update_orders.yml')
+def update_orders_status():
+    """
+    Moves many orders, selected by id, by current status or both, to a status in one statement:
+    200 if every order selected by id was updated, 207 if only some were and 404 if none were
+    """
+    try:
+        status, order_ids, from_status = read_status_update(request.get_json())
+        updated, skipped = orders_model.update_orders_status(status, order_ids, from_status)
+    except Exception as e:
+        return jsonify({'error': str(e)}), 400
+    status_code = 200 if not skipped else 207 if updated else 404
+    return jsonify({'updated': len(updated), 'order-ids': updated, 'skipped': skipped}), status_code
+
+
 @app.route('/api/v1/orders/<order_id>', methods=['PUT'])
 @jwt_required
+@admin_required('only admin can update order status')
 @swag_from('docs/update_order.yml')
 def update_order_status(order_id):
     """Updates the status of an order in the database"""
     try:
         status = request.get_json()
-        if not users_model.is_admin(get_jwt_identity()):
-            return jsonify({'error': 'only admin can update order status'}), 401
         orders_model.update_order_status(order_id, status)
         return jsonify({'message': 'successfully updated order status'}), 200
+    except OrderNotFound as e:
+        return jsonify({'error': str(e)}), 404
     except Exception as e:
         return jsonify({'error': str(e)}), 400
 
@@ -129,8 +447,13 @@ def update_order_status(order_id):
 def get_food_items():
     """Retrieves all the available food items in the menu"""
     try:
-        menu = menu_model.get_food_menu()
-        return jsonify({'menu': menu}), 200
+        body, etag = menu_cache.get('response', menu_model.get_menu_version(), render_food_menu)
+        if etag_matches(request.if_none_match, etag):
+            response = Response(status=304)
+        else:
+            response = Response(body, status=200, mimetype='application/json')
+        response.set_etag(etag)
+        return response
     except Exception as e:
         return jsonify({'error': str(e)}), 404
 
@@ -148,12 +471,11 @@ def get_food_item(identity):
 
 @app.route('/api/v1/menu', methods=['POST'])
 @jwt_required
+@admin_required('you are not an administrator')
 @swag_from('docs/menu_item.yml')
 def add_menu_item():
     """Adds a new food menu item to the database"""
     try:
-        if not users_model.is_admin(get_jwt_identity()):
-            return jsonify({'error': 'you are not an administrator'}), 401
         menu_item = request.get_json()
         created_item = menu_model.add_menu_item(menu_item)
         return jsonify(created_item), 201
@@ -163,11 +485,10 @@ def add_menu_item():
 
 @app.route('/api/v1/menu/<int:identity>', methods=['PUT'])
 @jwt_required
+@admin_required('Only admin can edit a food item!')
 def update_menu_item(identity):
     """Edits the menu item identified by 'identity' if it exists"""
     try:
-        if not users_model.is_admin(get_jwt_identity()):
-            return jsonify({'error': 'Only admin can edit a food item!'}), 401
         updated_menu_item = request.get_json()
         menu_model.update_menu_item(identity, updated_menu_item)
         return jsonify(
@@ -181,11 +502,10 @@ def update_menu_item(identity):
 
 @app.route('/api/v1/menu/<int:identity>', methods=['DELETE'])
 @jwt_required
+@admin_required('Only admin can delete a food item!')
 def delete_menu_item(identity):
     """Deletes menu item with id specified as 'identity'"""
     try:
-        if not users_model.is_admin(get_jwt_identity()):
-            return jsonify({'error': 'Only admin can delete a food item!'}), 401
         menu_model.delete_menu_item(identity)
         return jsonify(
             {'message': 'Successfully deleted food item with id {}'.format(identity)}
@@ -194,6 +514,44 @@ def delete_menu_item(identity):
         return jsonify({'error': str(e)}), 404
 
 
+@app.route('/api/v1/stats/pool', methods=['GET'])
+@jwt_required
+@admin_required('only admin can view pool statistics')
+@swag_from('docs/pool_stats.yml')
+def get_pool_stats():
+    """Reports usage of the database connection pool of the serving process"""
+    try:
+        return jsonify({'pool': Users.pool_stats()}), 200
+    except Exception as e:
+        return jsonify({'error': str(e)}), 503
+
+
+@app.route('/api/v1/stats/sales', methods=['GET'])
+@jwt_required
+@admin_required('only admin can view sales reports')
+@swag_from('docs/sales_report.yml')
+def get_sales_report():
+    """Reports the orders, revenue and top-selling items of a range of days"""
+    try:
+        first_day, last_day, top = get_report_arguments(request.args)
+    except Exception as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify(orders_model.get_sales_report(first_day, last_day, top)), 200
+
+
+@app.route('/metrics', methods=['GET'])
+@swag_from('docs/metrics.yml')
+def get_metrics():
+    """Exposes the request metrics of the serving process in the Prometheus text format"""
+    if METRICS_TOKEN and not hmac.compare_digest(
+        request.headers.get('Authorization', ''), 'Bearer ' + METRICS_TOKEN
+    ):
+        return jsonify({'error': 'a valid metrics token is required'}), 401
+    pool_stats = Users.pool_stats() if get_storage().name == 'postgres' else None
+    queue_stats = order_queue.stats() if order_queue is not None else None
+    return Response(metrics.render(pool_stats, queue_stats), mimetype='text/plain; version=0.0.4')
+
+
 @app.errorhandler(404)
 def resource_not_found(error):
     """Displays an error message when a 404 error occurs"""
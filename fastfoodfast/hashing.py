@@ -0,0 +1,77 @@
+"""
+Password hashing and verification, run in a bounded pool of worker processes so that slow key
+derivation neither blocks request threads nor queues up without limit during bursts of logins.
+
+Configured by the environment variables PASSWORD_HASH_WORKERS (processes per serving process,
+0 hashes on the calling thread), PASSWORD_HASH_QUEUE_LIMIT (hashing jobs that may be queued or
+running at once before new ones are rejected, at least 1), PASSWORD_HASH_TIMEOUT (seconds to wait
+for a result) and PASSWORD_HASH_METHOD (werkzeug method used for new hashes).
+"""
+import os, threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from werkzeug.security import generate_password_hash, check_password_hash
+
+
+class HashingOverloaded(Exception):
+    """Raised when hashing is saturated, the request should be retried later"""
+
+
+class PasswordHasher:
+    def __init__(self, method='pbkdf2:sha256:150000', workers=0, queue_limit=32, timeout=10.0):
+        self.method = method
+        self.workers = workers
+        self.timeout = timeout
+        # hashes made by <method> all start with the same prefix, e.g. 'pbkdf2:sha256:150000'
+        self.prefix = generate_password_hash('', method).split('$')[0]
+        if workers and queue_limit < 1:
+            raise ValueError('queue_limit must be at least 1 when hashing in worker processes')
+        self._slots = threading.BoundedSemaphore(queue_limit) if workers else None
+        self._executor = None
+        self._executor_pid = None
+        self._executor_lock = threading.Lock()
+
+    def hash(self, password):
+        """Returns a hash of <password> made with the current method"""
+        return self._run(generate_password_hash, password, self.method)
+
+    def verify(self, password_hash, password):
+        """Returns True if <password> matches <password_hash>, whatever method made it"""
+        return self._run(check_password_hash, password_hash, password)
+
+    def needs_rehash(self, password_hash):
+        """Returns True if <password_hash> was made with a method other than the current one"""
+        return password_hash.split('$')[0] != self.prefix
+
+    def _run(self, function, *args):
+        if not self.workers:
+            return function(*args)
+        if not self._slots.acquire(blocking=False):
+            raise HashingOverloaded('Too many requests, please try again later')
+        try:
+            future = self._get_executor().submit(function, *args)
+        except Exception:
+            self._slots.release()
+            raise
+        # the slot is held until the job is done or cancelled, not only while a thread waits for it
+        future.add_done_callback(lambda future: self._slots.release())
+        try:
+            return future.result(timeout=self.timeout)
+        except TimeoutError:
+            future.cancel() # drops the job unless a worker already started it
+            raise HashingOverloaded('Too many requests, please try again later')
+
+    def _get_executor(self):
+        """Returns this process's executor, starting a new one in processes forked from the parent"""
+        with self._executor_lock:
+            if self._executor is None or self._executor_pid != os.getpid():
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+                self._executor_pid = os.getpid()
+            return self._executor
+
+
+hasher = PasswordHasher(
+    method=os.getenv('PASSWORD_HASH_METHOD', 'pbkdf2:sha256:150000'),
+    workers=int(os.getenv('PASSWORD_HASH_WORKERS', 0)),
+    queue_limit=int(os.getenv('PASSWORD_HASH_QUEUE_LIMIT', 32)),
+    timeout=float(os.getenv('PASSWORD_HASH_TIMEOUT', 10))
+)
@@ -0,0 +1,122 @@
+"""
+Idempotency keys for order placement. A client that sends an Idempotency-Key header with
+POST /api/v1/users/orders may retry the request with the same key and body, e.g. after a timeout
+on a bad network, and is answered with the response to its first request, marked with an
+Idempotent-Replayed header, instead of placing the order again. Keys are scoped to the customer
+sending them and kept for IDEMPOTENCY_KEY_TTL seconds (default 86400).
+
+The response to a request that placed an order is recorded in the idempotency_keys table in the
+transaction that inserts the order, so that of two concurrent requests with the same key only one
+places its order and the other is answered with its response. Responses are also kept in an
+in-process LRU cache of IDEMPOTENCY_CACHE_SIZE entries (default 10000), so that most replays are
+answered without a query. A replay is answered before its body is validated or the menu, orders
+and order items are read. Requests that placed no order, such as invalid ones, are not recorded
+and are answered anew when retried.
+
+Reusing a key with a different body is refused with 422. Expired keys are purged at most once
+every IDEMPOTENCY_PURGE_INTERVAL seconds (default 3600) by each serving process.
+"""
+import hashlib, json, os, threading, time
+from .cache import TTLCache
+
+IDEMPOTENCY_KEY_TTL = float(os.getenv('IDEMPOTENCY_KEY_TTL', 86400))
+IDEMPOTENCY_CACHE_SIZE = int(os.getenv('IDEMPOTENCY_CACHE_SIZE', 10000))
+IDEMPOTENCY_PURGE_INTERVAL = float(os.getenv('IDEMPOTENCY_PURGE_INTERVAL', 3600))
+MAX_KEY_LENGTH = 255
+# (customer, key): (request hash, status code, body) of the responses recorded lately
+responses = TTLCache(max_size=IDEMPOTENCY_CACHE_SIZE, ttl=IDEMPOTENCY_KEY_TTL)
+_purge_lock = threading.Lock()
+_purged_at = None
+
+
+class KeyReused(Exception):
+    """Raised when an idempotency key is sent again along with a different request"""
+
+
+class Replayed(Exception):
+    """Raised with the recorded response of a key when another request used it first"""
+    def __init__(self, response):
+        super().__init__('A response is already recorded for this Idempotency-Key')
+        self.response = response
+
+
+def check_key(key):
+    """Returns a valid Idempotency-Key header value, raising an Exception for others"""
+    if not 0 < len(key) <= MAX_KEY_LENGTH or not all(' ' < char <= '~' for char in key):
+        raise Exception(
+            'Idempotency-Key must be 1 to {} printable ASCII characters!'.format(MAX_KEY_LENGTH)
+        )
+    return key
+
+
+def fingerprint(body):
+    """Returns the hash of a request <body> that a replay of the request must match"""
+    return hashlib.sha256(body).hexdigest()
+
+
+def new_response(request_hash, status, body):
+    """Returns a response to record for a request, its <body> serialized as JSON"""
+    return request_hash, status, json.dumps(body)
+
+
+def matching(response, request_hash):
+    """Returns the status and body of a recorded <response> if it was made to the same request"""
+    recorded_hash, status, body = response
+    if recorded_hash != request_hash:
+        raise KeyReused('This Idempotency-Key was already used with a different request!')
+    return status, body
+
+
+def lookup(storage, customer, key, request_hash):
+    """
+    Returns the status and body of the response recorded for <customer>'s <key>, or None,
+    looking in the cache before the storage
+    """
+    response = responses.get((customer, key))
+    if response is None:
+        recorded = storage.read_response(customer, key, IDEMPOTENCY_KEY_TTL)
+        if recorded is None:
+            return None
+        response, age = recorded
+        remember(customer, key, response, age)
+    return matching(response, request_hash)
+
+
+def remember(customer, key, response, age=0):
+    """
+    Caches the <response> to <customer>'s request with <key>, recorded <age> seconds ago, for as
+    long as the key has left to live
+    """
+    ttl = IDEMPOTENCY_KEY_TTL - age
+    if ttl > 0:
+        responses.set((customer, key), response, ttl)
+
+
+def record(storage, customer, key, response, orders=()):
+    """
+    Records the <response> to <customer>'s request with <key>, inserting the (customer, order)
+    pairs of <orders> in the same transaction. Raises Replayed, having inserted nothing, if a
+    response to the same request is already recorded for the key, or KeyReused if one to another.
+    """
+    recorded = storage.record_response(customer, key, response, IDEMPOTENCY_KEY_TTL, orders)
+    remember(customer, key, *(recorded or (response, )))
+    purge_expired(storage)
+    if recorded is not None:
+        raise Replayed(matching(recorded[0], response[0]))
+
+
+def forget(storage, customer, key):
+    """Drops the response recorded for <customer>'s <key>, whose order could not be placed"""
+    responses.pop((customer, key))
+    storage.forget_response(customer, key)
+
+
+def purge_expired(storage):
+    """Deletes the expired keys from the storage, unless this process did so lately"""
+    global _purged_at
+    now = time.monotonic()
+    with _purge_lock:
+        if _purged_at is not None and now - _purged_at < IDEMPOTENCY_PURGE_INTERVAL:
+            return
+        _purged_at = now
+    storage.purge_responses(IDEMPOTENCY_KEY_TTL)
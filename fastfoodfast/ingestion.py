@@ -0,0 +1,289 @@
+"""
+Write-behind ingestion of orders. When ORDER_QUEUE_DIR is set, placed orders are validated and
+priced as usual, appended to a journal file in that directory and acknowledged with their order-id
+as soon as the journal is synced to disk, instead of after a transaction of their own. A writer
+thread of each serving process then stores the queued orders in transactions of multi-row inserts
+of up to ORDER_QUEUE_BATCH_SIZE orders (default 1000), every ORDER_QUEUE_FLUSH_INTERVAL seconds
+(default 0.05) or as soon as a batch is full, so that peaks of orders cost a commit per batch
+rather than per order. Requests appending at the same time share one sync of the journal.
+
+Each process keeps a journal of its own, locked while it runs, and empties it whenever every order
+in it is stored. As it starts, a process takes over the journals of processes that died, appending
+their orders to its own, so orders acknowledged before a crash are stored after a restart. An
+order may be stored again after a crash, so inserts skip orders whose order-id is already taken
+by the same order; an order whose id was taken by another one cannot be stored, and is written
+to rejected.journal for the operators to deal with. So is an order that the database refuses,
+found by storing the orders of a batch one at a time once the batch failed MAX_BATCH_ATTEMPTS
+times, so that it does not hold up the orders queued after it. Orders are checked against the
+ranges and lengths of the database's columns before they are queued, so that an acknowledged
+order is not refused for its values. At most ORDER_QUEUE_LIMIT orders (default 100000) wait in a
+process's queue; beyond that orders are refused until the writer catches up.
+
+Queued orders are not listed, nor is their creation published as an event, until they are stored.
+"""
+import atexit, fcntl, glob, itertools, json, os, threading, uuid
+from collections import deque
+import psycopg2
+from .storage import get_storage, storage_errors
+from .validation import ValidationError
+
+ORDER_QUEUE_DIR = os.getenv('ORDER_QUEUE_DIR')
+ORDER_QUEUE_FLUSH_INTERVAL = float(os.getenv('ORDER_QUEUE_FLUSH_INTERVAL', 0.05))
+ORDER_QUEUE_BATCH_SIZE = int(os.getenv('ORDER_QUEUE_BATCH_SIZE', 1000))
+ORDER_QUEUE_LIMIT = int(os.getenv('ORDER_QUEUE_LIMIT', 100000))
+RETRY_DELAY = 1.0 # seconds the writer waits after failing to store a batch
+# failures of a batch after which its orders are stored one at a time, singling out any order
+# that the database refuses whatever the batch it is in
+MAX_BATCH_ATTEMPTS = 3
+
+
+class QueueFull(Exception):
+    """Raised when too many orders wait to be stored, the request should be retried later"""
+
+
+class OrderQueue:
+    def __init__(self, directory, flush_interval=0.05, batch_size=1000, limit=100000):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.limit = limit
+        self._lock = threading.Lock() # guards the journal's appends and the pending orders
+        self._sync_lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._pending = deque() # (customer, order) pairs, in the order they were journaled
+        self._appended = 0 # appends made to the journal, of which the first _synced are durable
+        self._synced = 0
+        self._journal = None
+        self._journal_pid = None
+        self._path = None
+        self._writer = None
+        self._wake = threading.Event()
+        self._stopped = threading.Event()
+        self.flushed = 0
+        self.rejected = 0
+        self.flush_errors = 0
+        self._failed_attempts = 0 # consecutive failures to store the batch at the head
+
+    def put(self, orders):
+        """
+        Queues new orders, given as (customer, order) pairs, returning once they are durable in
+        the journal. Raises QueueFull if the queue has no room for them, or a ValidationError,
+        queueing none of them, if the database would refuse one of them.
+        """
+        errors = [error for customer, order in orders for error in storage_errors(customer, order)]
+        if errors:
+            raise ValidationError(errors)
+        self.start()
+        data = b''.join(encode_order(customer, order) for customer, order in orders)
+        with self._lock:
+            if len(self._pending) + len(orders) > self.limit:
+                raise QueueFull('Too many orders are waiting to be stored, please try again later')
+            ticket = self._append(data, orders)
+        self._sync(ticket)
+        if len(self._pending) >= self.batch_size:
+            self._wake.set()
+
+    def _append(self, data, orders):
+        os.write(self._journal, data) # opened for appending, so writes land at the end
+        self._pending.extend(orders)
+        self._appended += 1
+        return self._appended
+
+    def _sync(self, ticket):
+        """Syncs the journal up to the append numbered <ticket>, sharing syncs between threads"""
+        with self._sync_lock:
+            if self._synced >= ticket:
+                return # synced by another thread while this one waited
+            appended = self._appended
+            os.fdatasync(self._journal)
+            self._synced = appended
+
+    def start(self):
+        """
+        Opens this process's journal, takes over those of dead processes and starts the writer,
+        once per process
+        """
+        if self._journal is not None and self._journal_pid == os.getpid():
+            return
+        with self._lock:
+            if self._journal is not None and self._journal_pid == os.getpid():
+                return
+            if self._journal is not None:
+                # inherited from the process this one forked from, whose queue it is
+                os.close(self._journal)
+            os.makedirs(self.directory, exist_ok=True)
+            path = os.path.join(
+                self.directory, 'orders-{}-{}.journal'.format(os.getpid(), uuid.uuid4().hex[:8])
+            )
+            journal = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+            fcntl.flock(journal, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            self._journal, self._journal_pid, self._path = journal, os.getpid(), path
+            self._pending.clear()
+            self._appended = self._synced = 0
+            for orphan in glob.glob(os.path.join(self.directory, 'orders-*.journal')):
+                if orphan != path:
+                    self._adopt(orphan)
+            self._sync(self._appended)
+            self._stopped.clear()
+            self._writer = threading.Thread(target=self._write_behind, daemon=True)
+            self._writer.start()
+        atexit.register(self.close)
+
+    def _adopt(self, path):
+        """Moves the orders of the journal at <path> to this process's, if its process is dead"""
+        try:
+            orphan = os.open(path, os.O_RDONLY)
+        except FileNotFoundError:
+            return # adopted by another process
+        try:
+            try:
+                fcntl.flock(orphan, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return # its process is alive
+            if os.fstat(orphan).st_nlink == 0:
+                return # adopted by another process since it was opened
+            with os.fdopen(os.dup(orphan), 'rb') as lines:
+                orders = list(decode_orders(lines))
+            if orders:
+                self._append(b''.join(itertools.starmap(encode_order, orders)), orders)
+                self._sync(self._appended)
+            os.unlink(path)
+        finally:
+            os.close(orphan)
+
+    def _write_behind(self):
+        while not self._stopped.is_set():
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception:
+                self.flush_errors += 1
+                self._stopped.wait(RETRY_DELAY)
+
+    def flush(self):
+        """Stores the queued orders, a batch per transaction, emptying the journal once all are"""
+        with self._flush_lock:
+            while True:
+                with self._lock:
+                    batch = list(itertools.islice(self._pending, self.batch_size))
+                if not batch:
+                    return
+                try:
+                    self._store(batch)
+                except Exception:
+                    self._failed_attempts += 1
+                    if self._failed_attempts < MAX_BATCH_ATTEMPTS:
+                        raise
+                    self._store_one_by_one(batch)
+                self._failed_attempts = 0
+                with self._lock:
+                    for _ in batch:
+                        self._pending.popleft()
+                    self.flushed += len(batch)
+                    if not self._pending:
+                        # every order in the journal is stored; a crash before the truncation
+                        # is durable only makes the next process store them again
+                        os.ftruncate(self._journal, 0)
+
+    def _store(self, batch):
+        storage = get_storage()
+        stored = set(storage.insert_orders(batch, skip_existing=True))
+        rejected = list()
+        for customer, order in batch:
+            if order['order-id'] in stored:
+                continue
+            existing = storage.list_orders(public_id=order['order-id'])
+            if not existing or (existing[0][1]['customer'], existing[0][1]['total-cost']) != (
+                customer, order['total-cost']
+            ):
+                rejected.append((customer, order))
+        self._reject(rejected)
+
+    def _store_one_by_one(self, batch):
+        """
+        Stores the orders of a <batch> that keeps failing one at a time, rejecting those that
+        the database refuses. Errors that are not about an order, such as a lost connection,
+        are raised, leaving the orders not yet stored queued.
+        """
+        for customer, order in batch:
+            try:
+                self._store([(customer, order)])
+            except Exception as e:
+                if not refuses_order(e):
+                    raise
+                self._reject([(customer, order)])
+
+    def _reject(self, orders):
+        """Writes <orders> that cannot be stored to rejected.journal"""
+        if not orders:
+            return
+        with open(os.path.join(self.directory, 'rejected.journal'), 'ab') as dead_letters:
+            dead_letters.write(b''.join(itertools.starmap(encode_order, orders)))
+            dead_letters.flush()
+            os.fsync(dead_letters.fileno())
+        self.rejected += len(orders)
+
+    def stats(self):
+        return {
+            'pending': len(self._pending), 'flushed': self.flushed, 'rejected': self.rejected,
+            'flush-errors': self.flush_errors
+        }
+
+    def close(self):
+        """
+        Stops the writer after a last flush, removing the journal unless orders could not be
+        stored, which the next process to start takes over
+        """
+        if self._writer is None or self._journal_pid != os.getpid():
+            return
+        self._stopped.set()
+        self._wake.set()
+        self._writer.join()
+        try:
+            self.flush()
+        except Exception:
+            pass # replayed by the next process to start
+        with self._lock:
+            if not self._pending:
+                os.unlink(self._path)
+            os.close(self._journal)
+            self._journal = self._writer = None
+
+
+def refuses_order(error):
+    """
+    True if <error>, raised storing an order, is about the order itself, such as a value out of
+    range or a malformed journal record, so that storing it again would fail again
+    """
+    return isinstance(error, (
+        psycopg2.DataError, psycopg2.IntegrityError, KeyError, TypeError, ValueError
+    ))
+
+
+def encode_order(customer, order):
+    return json.dumps({'customer': customer, 'order': order}).encode() + b'\n'
+
+
+def decode_orders(lines):
+    """Yields the (customer, order) pairs of a journal, skipping a last line cut short by a crash"""
+    for line in lines:
+        try:
+            record = json.loads(line)
+        except ValueError:
+            continue # written in part before a crash, so never acknowledged
+        yield record['customer'], record['order']
+
+
+order_queue = ORDER_QUEUE_DIR and OrderQueue(
+    ORDER_QUEUE_DIR, ORDER_QUEUE_FLUSH_INTERVAL, ORDER_QUEUE_BATCH_SIZE, ORDER_QUEUE_LIMIT
+) or None
+
+
+def init_app(app):
+    """
+    Starts the order queue, if any, as <app> starts in a serving process, so that the orders in
+    the journals of processes that died are stored now rather than once an order is placed
+    """
+    if order_queue is not None:
+        order_queue.start()
@@ -0,0 +1,245 @@
+"""
+Per-request metrics of the serving process, exposed in the Prometheus text format on /metrics.
+
+For every request, the Flask app records its route, method, status and latency, together with the
+number and duration of the SQL statements it ran through the models' cursors, the time spent
+serializing JSON and the time spent waiting for pooled database connections. Measurements are
+gathered in a thread-local RequestStats while the request runs and folded into the process-wide
+registry once, when it ends, so the cost per request is a few clock reads and one lock.
+
+Metrics are kept per process: with several gunicorn workers, each scrape reports the worker that
+served it. In the ASGI mode, requests served natively are counted and timed, but their SQL and
+serialization are not broken down.
+"""
+import bisect, threading, time
+import psycopg2.extensions
+from flask import request
+from .encoding import JSONEncoder
+
+# upper bounds in seconds of the latency histogram buckets
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+CONNECTION_WAIT_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1) # the last one counts values above every bucket
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def samples(self):
+        """Yields the (le, cumulative count) pairs of the buckets, ending with +Inf"""
+        total = 0
+        for bound, count in zip(self.buckets + (float('inf'), ), self.counts):
+            total += count
+            yield ('+Inf' if bound == float('inf') else repr(bound)), total
+
+
+class RequestStats:
+    """What a request has spent so far, recorded by the thread serving it"""
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.statements = 0
+        self.sql_time = 0.0
+        self.json_time = 0.0
+        self.connection_wait = 0.0
+
+
+class RouteStats:
+    def __init__(self):
+        self.statuses = dict()
+        self.latency = Histogram(LATENCY_BUCKETS)
+        self.statements = 0
+        self.sql_time = 0.0
+        self.json_time = 0.0
+        self.connection_wait = 0.0
+
+
+class Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._routes = dict()
+        self._connection_wait = Histogram(CONNECTION_WAIT_BUCKETS)
+
+    def start_request(self):
+        self._local.stats = RequestStats()
+
+    def current(self):
+        """Returns the RequestStats of the request this thread is serving, or None"""
+        return getattr(self._local, 'stats', None)
+
+    def end_request(self, route, method, status):
+        """Records the request this thread was serving, once"""
+        stats = self.current()
+        if stats is None:
+            return
+        self._local.stats = None
+        self.observe_request(route, method, status, time.perf_counter() - stats.started, stats)
+
+    def observe_request(self, route, method, status, seconds, stats=None):
+        with self._lock:
+            route_stats = self._routes.get((route, method))
+            if route_stats is None:
+                route_stats = self._routes[route, method] = RouteStats()
+            route_stats.statuses[status] = route_stats.statuses.get(status, 0) + 1
+            route_stats.latency.observe(seconds)
+            if stats is not None:
+                route_stats.statements += stats.statements
+                route_stats.sql_time += stats.sql_time
+                route_stats.json_time += stats.json_time
+                route_stats.connection_wait += stats.connection_wait
+
+    def observe_statement(self, seconds):
+        stats = self.current()
+        if stats is not None:
+            stats.statements += 1
+            stats.sql_time += seconds
+
+    def observe_json(self, seconds):
+        stats = self.current()
+        if stats is not None:
+            stats.json_time += seconds
+
+    def observe_connection_wait(self, seconds):
+        stats = self.current()
+        if stats is not None:
+            stats.connection_wait += seconds
+        with self._lock:
+            self._connection_wait.observe(seconds)
+
+    def statement_count(self):
+        """Returns the number of SQL statements run by the requests recorded so far"""
+        with self._lock:
+            return sum(route_stats.statements for route_stats in self._routes.values())
+
+    def render(self, pool_stats=None, queue_stats=None):
+        """Returns the metrics in the Prometheus text exposition format"""
+        with self._lock:
+            routes = sorted(self._routes.items())
+            lines = list()
+
+            def family(name, kind, description):
+                lines.extend([
+                    '# HELP fastfoodfast_{} {}'.format(name, description),
+                    '# TYPE fastfoodfast_{} {}'.format(name, kind)
+                ])
+
+            def sample(name, labels, value):
+                text = ','.join('{}="{}"'.format(key, escape(label)) for key, label in labels)
+                lines.append('fastfoodfast_{}{} {}'.format(name, text and '{' + text + '}', value))
+
+            family('requests_total', 'counter', 'Requests served, by route, method and status.')
+            for (route, method), route_stats in routes:
+                for status, count in sorted(route_stats.statuses.items()):
+                    sample('requests_total', [
+                        ('route', route), ('method', method), ('status', str(status))
+                    ], count)
+            family('request_duration_seconds', 'histogram', 'Time taken to serve requests.')
+            for (route, method), route_stats in routes:
+                labels = [('route', route), ('method', method)]
+                for bound, count in route_stats.latency.samples():
+                    sample('request_duration_seconds_bucket', labels + [('le', bound)], count)
+                sample('request_duration_seconds_sum', labels, route_stats.latency.sum)
+                sample('request_duration_seconds_count', labels, sum(route_stats.latency.counts))
+            for name, attribute, description in [
+                ('sql_statements_total', 'statements', 'SQL statements run by requests.'),
+                ('sql_duration_seconds_total', 'sql_time', 'Time requests spent running SQL.'),
+                ('json_duration_seconds_total', 'json_time',
+                 'Time requests spent serializing JSON.'),
+                ('connection_wait_seconds_total', 'connection_wait',
+                 'Time requests spent waiting for database connections.')
+            ]:
+                family(name, 'counter', description)
+                for (route, method), route_stats in routes:
+                    sample(name, [('route', route), ('method', method)],
+                           getattr(route_stats, attribute))
+            family('connection_wait_seconds', 'histogram',
+                   'Time taken to check database connections out of the pool.')
+            for bound, count in self._connection_wait.samples():
+                sample('connection_wait_seconds_bucket', [('le', bound)], count)
+            sample('connection_wait_seconds_sum', [], self._connection_wait.sum)
+            sample('connection_wait_seconds_count', [], sum(self._connection_wait.counts))
+        if pool_stats is not None:
+            for name, key, description in [
+                ('pool_connections', 'size', 'Database connections opened by the pool.'),
+                ('pool_connections_in_use', 'in-use', 'Pooled connections checked out.'),
+                ('pool_waiting', 'waiting', 'Threads waiting for a pooled connection.'),
+                ('pool_timeouts_total', 'timeouts', 'Checkouts that timed out.')
+            ]:
+                family(name, 'counter' if name.endswith('_total') else 'gauge', description)
+                sample(name, [], pool_stats[key])
+        if queue_stats is not None:
+            for name, key, description in [
+                ('order_queue_pending', 'pending', 'Queued orders waiting to be stored.'),
+                ('order_queue_flushed_total', 'flushed', 'Queued orders stored.'),
+                ('order_queue_rejected_total', 'rejected',
+                 'Queued orders that could not be stored.'),
+                ('order_queue_flush_errors_total', 'flush-errors',
+                 'Flushes of the queue that failed.')
+            ]:
+                family(name, 'counter' if name.endswith('_total') else 'gauge', description)
+                sample(name, [], queue_stats[key])
+        return '\n'.join(lines) + '\n'
+
+
+def escape(label):
+    return label.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+metrics = Metrics()
+
+
+class TimedCursor(psycopg2.extensions.cursor):
+    """A cursor recording the statements it runs in the metrics of the current request"""
+    def execute(self, query, params=None):
+        started = time.perf_counter()
+        try:
+            return super().execute(query, params)
+        finally:
+            metrics.observe_statement(time.perf_counter() - started)
+
+    def executemany(self, query, params_list):
+        started = time.perf_counter()
+        try:
+            return super().executemany(query, params_list)
+        finally:
+            metrics.observe_statement(time.perf_counter() - started)
+
+
+class TimedJSONEncoder(JSONEncoder):
+    """The app's JSON encoder, recording the time it takes in the metrics of the current request"""
+    def encode(self, o):
+        started = time.perf_counter()
+        try:
+            return super().encode(o)
+        finally:
+            metrics.observe_json(time.perf_counter() - started)
+
+
+def init_app(app):
+    """Records the metrics of every request served by <app>"""
+    app.json_encoder = TimedJSONEncoder
+
+    @app.before_request
+    def start_request():
+        metrics.start_request()
+
+    @app.after_request
+    def end_request(response):
+        metrics.end_request(route_of_request(), request.method, response.status_code)
+        return response
+
+    @app.teardown_request
+    def end_failed_request(error=None):
+        # a no-op unless the request failed before its response was recorded
+        metrics.end_request(route_of_request(), request.method, 500)
+
+
+def route_of_request():
+    """The rule the request matched, which keeps the number of label values bounded"""
+    return request.url_rule.rule if request.url_rule is not None else 'unmatched'
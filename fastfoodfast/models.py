@@ -1,198 +1,386 @@
-import psycopg2, uuid, os
-from .validation import Validation
-from werkzeug.security import generate_password_hash, check_password_hash
+import uuid, base64, os
+from .validation import Validation, ValidationError, MAX_COST
+from .pool import get_pool
+from .storage import get_storage
+from .cache import VersionedCache
+from .hashing import hasher
+from . import ingestion, idempotency
 
 
 validator = Validation()
+menu_cache = VersionedCache('menu', check_interval=float(os.getenv('MENU_CACHE_CHECK_INTERVAL', 0)))
+
+
+class OrderNotFound(Exception):
+    """Raised when no order has the public id looked up"""
+
+
+def encode_cursor(primary_key):
+    """Returns the opaque pagination cursor of the page following order <primary_key>"""
+    return base64.urlsafe_b64encode(str(primary_key).encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Returns the primary key of the order that a pagination cursor points after"""
+    try:
+        padding = '=' * (-len(cursor) % 4)
+        order_id = int(base64.urlsafe_b64decode((cursor + padding).encode()).decode())
+    except (ValueError, TypeError):
+        raise Exception('Invalid cursor {}'.format(cursor))
+    if order_id < 1: # orders are numbered from 1
+        raise Exception('Invalid cursor {}'.format(cursor))
+    return order_id
+
+
+def seek_page(where, params, cursor):
+    """Narrows <where> to the orders older than those before <cursor>, if one is given"""
+    if cursor is None:
+        return where, params
+    return ' AND '.join(filter(None, [where, 'id < %s'])), params + (decode_cursor(cursor), )
+
+
+def split_page(orders, limit):
+    """
+    Splits (primary key, order) pairs, fetched with a LIMIT of <limit> + 1 to learn whether
+    another page follows, into the page of orders and the cursor of the next page, or None
+    """
+    next_cursor = encode_cursor(orders[limit - 1][0]) if len(orders) > limit else None
+    return [order for _, order in orders[:limit]], next_cursor
 
 
 class Model:
-    """Base class for the model classes"""
-    def connect_to_db(self):
-        self.conn = psycopg2.connect(os.getenv('DATABASE_URL'))
-        self.cursor = self.conn.cursor()
+    """Base class for the model classes, which keep their data in the configured storage backend"""
+    @property
+    def storage(self):
+        return get_storage()
+
+    def read_version(self, name):
+        """Returns the counter that every write to table <name> bumps"""
+        return self.storage.read_version(name)
+
+    @staticmethod
+    def pool_stats():
+        """Returns usage statistics of the connection pool shared by the models"""
+        return get_pool().stats()
 
 
 class Users(Model):
     def register_user(self, user_data):
         """Adds a new user to the database"""
         user_data = validator.validate_user_data(user_data)
-        self.connect_to_db()
-        validator.ensure_user_not_existent(user_data['username'], self.cursor)
-        password_hash = generate_password_hash(user_data['password'], method='sha256')
-        self.cursor.execute(
-            'INSERT INTO users (username, password, email, telephone, admin)'
-            ' VALUES (%s, %s, %s, %s, %s)',
-            (
-                user_data['username'], password_hash, user_data['email'],
-                user_data['telephone'], False
-            )
-        )
-        self.conn.commit()
-        self.conn.close()
+        password_hash = hasher.hash(user_data['password'])
+        if not self.storage.insert_user(
+            user_data['username'], password_hash, user_data['email'], user_data['telephone']
+        ):
+            raise Exception('{} already exists!'.format(user_data['username']))
     
     def get_user(self, username):
         """Retrieves a user from the database"""
         if not isinstance(username, str):
             raise Exception('Username must be a string')
-        self.connect_to_db()
-        self.cursor.execute(
-            'SELECT username, password FROM users WHERE username = %s',
-            (username, )
-        )
-        result = self.cursor.fetchone()
-        self.conn.close()
+        result = self.storage.get_user(username)
         if not result:
             raise Exception('No user with name {} exists!'.format(username))
         user = dict()
         user['username'] = result[0]
         user['password'] = result[1]
+        user['admin'] = result[2]
         return user
     
+    def check_password(self, user, password):
+        """
+        Returns True if <password> is the password of <user>, as returned by get_user. A hash made
+        with an outdated method is transparently replaced by one made with the current method.
+        """
+        if not hasher.verify(user['password'], password):
+            return False
+        if hasher.needs_rehash(user['password']):
+            user['password'] = hasher.hash(password)
+            self.storage.set_password(user['username'], user['password'])
+        return True
+    
     def is_admin(self, user):
         """Returns True if user is admin, False otherwise"""
-        self.connect_to_db()
-        self.cursor.execute('SELECT admin FROM users WHERE username = %s', (user, ))
-        value = self.cursor.fetchone()[0]
-        self.conn.close()
-        return value
+        result = self.storage.get_user(user)
+        return bool(result and result[2])
 
 
 class Orders(Model):
-    def create_order(self, order, customer):
-        """Adds a new order to the database"""
-        validator.validate_order(order)
-        total_cost = 0
-        for item in order['items']:
-            item['item'] = item['item'].strip() # remove leading and lagging spaces
-            total_cost += float(item['cost'])
-        order_id = str(uuid.uuid4())[:8] # random public ID for security
-        new_order = {
-            'items': order['items'], 'status': 'new',
-            'total-cost': total_cost, 'order-id': order_id
-        }
-        # add order to the database
-        self.connect_to_db()
-        self.cursor.execute(
-            'INSERT INTO orders (public_id, customer, status, total_cost) VALUES (%s, %s, %s, %s)',
-            (order_id, customer, 'new', total_cost)
-        )
-        self.cursor.execute(
-            'SELECT id FROM orders WHERE public_id = %s', (order_id, )
-        )
-        primary_key = self.cursor.fetchone()[0]
-        for item in new_order['items']:
-            self.cursor.execute(
-                'INSERT INTO order_items (order_id, item, quantity, cost) VALUES (%s, %s, %s, %s)',
-                (primary_key, item['item'], item['quantity'], item['cost'])
+    @property
+    def queued(self):
+        """True if new orders are queued to be written behind, see ingestion.py"""
+        return ingestion.order_queue is not None
+
+    @property
+    def created_status(self):
+        """The status code of placed orders: 202 if they are queued, to be created on a flush"""
+        return 202 if self.queued else 201
+
+    def store_orders(self, orders):
+        """Stores new orders, given as (customer, order) pairs, or queues them if queued is set"""
+        if self.queued:
+            ingestion.order_queue.put(orders)
+        else:
+            self.storage.insert_orders(orders)
+
+    def create_order(self, order, customer, idempotency_key=None, request_hash=None):
+        """
+        Adds a new order to the database. Given an <idempotency_key>, the response to the request
+        with <request_hash> that placed it is recorded along with it, see idempotency.py.
+        """
+        new_order = self.new_order(validator.validate_order(order), Menu().get_price_index())
+        if idempotency_key is None:
+            self.store_orders([(customer, new_order)])
+            return new_order
+        response = idempotency.new_response(request_hash, self.created_status, new_order)
+        if not self.queued:
+            idempotency.record(
+                self.storage, customer, idempotency_key, response, [(customer, new_order)]
             )
-        self.conn.commit()
-        self.conn.close()
+            return new_order
+        # the key is recorded before the order is journaled, so that a concurrent request with
+        # the same key is not queued too
+        idempotency.record(self.storage, customer, idempotency_key, response)
+        try:
+            self.store_orders([(customer, new_order)])
+        except Exception:
+            idempotency.forget(self.storage, customer, idempotency_key)
+            raise
         return new_order
+
+    def find_response(self, customer, idempotency_key, request_hash):
+        """
+        Returns the status code and JSON body of the response recorded for <customer>'s request
+        with <idempotency_key>, or None
+        """
+        return idempotency.lookup(self.storage, customer, idempotency_key, request_hash)
+
+    def create_orders(self, orders, customer, atomic=True):
+        """
+        Validates all of <orders> up front, then adds the valid ones to the database in a single
+        transaction of multi-row inserts. Returns a result per order, in the same order, saying
+        whether it was created along with the new order or the errors that made it invalid. If
+        <atomic> is set, no order is created unless every one of them is valid.
+        """
+        results, new_orders = self.prepare_orders(
+            orders, customer, Menu().get_price_index(), atomic
+        )
+        if new_orders:
+            self.store_orders(new_orders)
+        return results
+
+    @classmethod
+    def prepare_orders(cls, orders, customer, prices, atomic=True):
+        """
+        Validates and prices <orders> for create_orders, returning the results to report and the
+        (customer, order) pairs to insert, none if <atomic> is set and some order is invalid
+        """
+        if not isinstance(orders, list) or not orders:
+            raise Exception('Specify orders as a non-empty list!')
+        results, new_orders = list(), list()
+        for index, order in enumerate(orders):
+            try:
+                new_order = cls.new_order(validator.validate_order(order), prices)
+            except ValidationError as e:
+                results.append({'index': index, 'created': False, 'errors': e.errors})
+                continue
+            results.append({'index': index, 'created': True, 'order': new_order})
+            new_orders.append((customer, new_order))
+        if atomic and len(new_orders) < len(orders):
+            for result in results:
+                if result.pop('order', None) is not None:
+                    result['created'] = False
+            return results, list()
+        return results, new_orders
+
+    @staticmethod
+    def new_order(order, prices):
+        """
+        Returns a new order, yet to be stored, of the items of the validated <order>, each costing
+        its quantity times its rate in <prices>, as returned by Menu.get_price_index. Raises a
+        ValidationError if some of the items are not on the menu, or if an item or the order costs
+        more than MAX_COST.
+        """
+        items, errors = list(), list()
+        for index, item in enumerate(order['items']):
+            price = prices.get(item['item'].lower())
+            if price is None:
+                errors.append('Item {}: {} is not on the menu!'.format(index + 1, item['item']))
+                continue
+            name, rate = price
+            quantity = item['quantity']
+            cost = rate * quantity
+            if not cost <= MAX_COST: # also refuses infinite and NaN costs
+                errors.append('Item {}: cost can be at most {}!'.format(index + 1, MAX_COST))
+            items.append({'item': name, 'quantity': quantity, 'cost': cost})
+        total_cost = sum(item['cost'] for item in items)
+        if not errors and not total_cost <= MAX_COST:
+            errors.append('Total cost can be at most {}!'.format(MAX_COST))
+        if errors:
+            raise ValidationError(errors)
+        return {
+            'items': items, 'status': 'new', 'total-cost': total_cost,
+            'order-id': str(uuid.uuid4())[:8] # random public ID for security
+        }
     
     def get_order_history(self, customer):
         """Returns a list of all orders made by a user"""
-        self.connect_to_db()
-        self.cursor.execute(
-            'SELECT id, public_id, status, total_cost FROM orders WHERE customer = %s',
-            (customer, )
+        orders = self.storage.list_orders(customer=customer, include_customer=False)
+        if not orders:
+            raise Exception('No orders made by {}!'.format(customer))
+        return [order for _, order in orders]
+    
+    def get_order_history_page(self, customer, limit, cursor=None, archived=False):
+        """
+        Returns up to <limit> orders made by a user older than those before <cursor>, along with
+        the cursor of the next page, or None if this is the last page. Only archived orders are
+        listed if <archived> is set, only the others otherwise.
+        """
+        page = self.get_page(
+            limit, cursor, include_customer=False, customer=customer, archived=archived
         )
-        records = self.cursor.fetchall()
-        if not records:
+        if not page[0] and cursor is None:
             raise Exception('No orders made by {}!'.format(customer))
-        orders = list()
-        for record in records:
-            order = dict()
-            order['order-id'] = record[1]
-            order['status'] = record[2]
-            order['total-cost'] = record[3]
-            self.cursor.execute(
-                'SELECT item, quantity, cost FROM order_items WHERE order_id = %s',
-                (record[0], )
-            )
-            items = list()
-            for item in self.cursor.fetchall():
-                item = {'item': item[0], 'quantity': item[1], 'cost': item[2]}
-                items.append(item)
-            order['items'] = items
-            orders.append(order)
-        return orders
+        return page
     
     def get_all_orders(self):
         """Fetches all orders from the database"""
-        self.connect_to_db()
-        self.cursor.execute(
-            'SELECT id, public_id, customer, status, total_cost FROM orders'
-        )
-        records = self.cursor.fetchall()
-        if not records:
+        orders = self.storage.list_orders()
+        if not orders:
             raise Exception('No orders available!')
-        orders = list()
-        for record in records:
-            order = dict()
-            order['order-id'] = record[1]
-            order['customer'] = record[2]
-            order['status'] = record[3]
-            order['total-cost'] = record[4]
-            self.cursor.execute(
-                'SELECT item, quantity, cost FROM order_items WHERE order_id = %s',
-                (record[0], )
-            )
-            items = list()
-            for item in self.cursor.fetchall():
-                item = {'item': item[0], 'quantity': item[1], 'cost': item[2]}
-                items.append(item)
-            order['items'] = items
-            orders.append(order)
-        self.conn.close()
-        return orders
+        return [order for _, order in orders]
+    
+    def stream_all_orders(self, batch_size=1000, archived=False):
+        """
+        Yields every order, or every archived one if <archived> is set, newest first, reading
+        rows from a server-side cursor <batch_size> at a time so that memory use does not depend
+        on the number of orders
+        """
+        return self.storage.stream_orders(batch_size, archived)
+    
+    def get_all_orders_page(self, limit, cursor=None, archived=False):
+        """
+        Fetches a page of <limit> orders older than <cursor>, archived ones if <archived> is set,
+        and the cursor of the next page
+        """
+        page = self.get_page(limit, cursor, archived=archived)
+        if not page[0] and cursor is None:
+            raise Exception('No orders available!')
+        return page
+    
+    def get_page(self, limit, cursor=None, include_customer=True, **narrowing):
+        """
+        Keyset pagination over orders.id: the page is found through the primary key index by
+        seeking past the cursor, so fetching any page costs the same however deep it is
+        """
+        before = None if cursor is None else decode_cursor(cursor)
+        # fetch one order more than asked for, to learn whether another page follows
+        orders = self.storage.list_orders(
+            before=before, limit=limit + 1, include_customer=include_customer, **narrowing
+        )
+        return split_page(orders, limit)
     
     def get_specific_order(self, order_id):
         """"Fetches a specific order from the database with public_id = <order_id>"""
-        self.connect_to_db()
-        self.cursor.execute('SELECT * FROM orders WHERE public_id = %s', (order_id, ))
-        record = self.cursor.fetchone()
-        if not record:
-            raise Exception('No order with id {} exists!'.format(order_id))
-        order = dict()
-        items = list()
-        self.cursor.execute(
-            'SELECT item, quantity, cost FROM order_items WHERE order_id = %s',
-            (record[0], )
+        # the archive is only searched for orders that are not among the recent ones
+        orders = self.storage.list_orders(public_id=order_id) or self.storage.list_orders(
+            public_id=order_id, archived=True
         )
-        for item in self.cursor.fetchall():
-            item = {'item': item[0], 'quantity': item[1], 'cost': item[2]}
-            items.append(item)
-        order['items'] = items
-        order['order-id'] = record[1]
-        order['customer'] = record[2]
-        order['status'] = record[3]
-        order['total-cost'] = record[4]
-        self.conn.close()
-        return order
+        if not orders:
+            raise OrderNotFound('No order with id {} exists!'.format(order_id))
+        return orders[0][1]
     
+    def archive_orders(self, days):
+        """
+        Moves the orders completed or cancelled that were placed more than <days> days ago to
+        the archive, where they are listed apart and no longer change. Returns how many were.
+        """
+        return self.storage.archive_orders(days)
+
     def update_order_status(self, order_id, status):
-        """Updates the status of an order with <order_id>"""
-        if not self.get_specific_order(order_id):
-            raise Exception('The specified order does not exist!')
-        validator.validate_status_data(status)
-        self.connect_to_db()
-        self.cursor.execute(
-            'UPDATE orders SET status = %s WHERE public_id = %s',
-            (status['status'], order_id)
-        )
-        self.conn.commit()
-        self.conn.close()
+        """Updates the status of an order with <order_id>, in a single statement"""
+        status = validator.validate_status_data(status)
+        if not self.storage.set_order_status(order_id, status['status']):
+            raise OrderNotFound('No order with id {} exists!'.format(order_id))
+
+    def update_orders_status(self, status, order_ids=None, from_status=None):
+        """
+        Moves the orders with one of <order_ids> and in <from_status>, whichever are given, to
+        <status> in a single statement. Returns the ids of the orders updated, and those of
+        <order_ids> that were not, as they do not exist or are in another status.
+        """
+        status = validator.validate_status_data({'status': status})['status']
+        if from_status is not None:
+            from_status = validator.validate_status_data({'status': from_status})['status']
+        if order_ids is None and from_status is None:
+            raise Exception('Specify the order-ids or the from-status of the orders to update!')
+        if order_ids is not None and (
+            not isinstance(order_ids, list) or not order_ids
+            or not all(isinstance(order_id, str) for order_id in order_ids)
+        ):
+            raise Exception('Specify order-ids as a non-empty list of order ids!')
+        updated = self.storage.set_orders_status(status, order_ids, from_status)
+        found = set(updated)
+        return updated, [order_id for order_id in order_ids or [] if order_id not in found]
+
+    def get_sales_report(self, first_day, last_day, top=10):
+        """
+        Reports the orders placed from <first_day> to <last_day> inclusive: their number, in all
+        and by status, and their revenue, leaving out cancelled orders, for the whole range and
+        for each day with orders, along with the <top> items sold most. It is read from rollups
+        that every order write maintains, so it costs the same however many orders there are.
+        """
+        days, items = self.storage.read_sales(first_day, last_day, top)
+        report = {
+            'from': first_day.isoformat(), 'to': last_day.isoformat(),
+            'orders': 0, 'revenue': 0, 'statuses': dict(), 'days': list(),
+            'top-items': [
+                {'item': item, 'quantity': quantity, 'revenue': revenue}
+                for item, quantity, revenue in items
+            ]
+        }
+        for day, status, orders, revenue in days:
+            if not report['days'] or report['days'][-1]['date'] != day.isoformat():
+                report['days'].append(
+                    {'date': day.isoformat(), 'orders': 0, 'revenue': 0, 'statuses': dict()}
+                )
+            for totals in (report, report['days'][-1]):
+                totals['orders'] += orders
+                totals['statuses'][status] = totals['statuses'].get(status, 0) + orders
+                if status != 'cancelled':
+                    totals['revenue'] += revenue
+        return report
 
 
 class Menu(Model):
+    def get_menu_version(self):
+        """Returns the version of the menu, discarding cached menu data if it has changed"""
+        return menu_cache.current_version(lambda: self.read_version('menu'))
+    
     def get_food_menu(self, return_id=True):
         """Returns all food items in the menu"""
-        self.connect_to_db()
-        self.cursor.execute(
-            'SELECT id, item, unit, rate FROM menu'
-        )
-        menu_items = self.cursor.fetchall()
+        menu_items = menu_cache.get('items', self.get_menu_version(), self.load_food_menu)
+        return self.format_menu(menu_items, return_id)
+
+    def get_price_index(self):
+        """
+        Returns the index orders are priced from, mapping the lowercased name of every menu item
+        to its name and rate. It is built once per menu version, so pricing an order costs no
+        more round trips than checking the version, however many items it has.
+        """
+        version = self.get_menu_version()
+        return menu_cache.get('prices', version, lambda: self.index_prices(
+            menu_cache.get('items', version, self.load_food_menu)
+        ))
+
+    @staticmethod
+    def index_prices(menu_items):
+        """Returns the price index of the rows of the menu table"""
+        return {item[1].lower(): (item[1], item[3]) for item in menu_items}
+
+    @staticmethod
+    def format_menu(menu_items, return_id=True):
+        """Turns rows of the menu table into menu items"""
         if not menu_items:
             raise Exception('The food menu is empty')
         menu = list()
@@ -202,59 +390,44 @@ class Menu(Model):
         else:
             for item in menu_items:
                 menu.append({'item': item[1], 'unit': item[2], 'rate': item[3]})
-        self.conn.close()
         return menu
     
+    def load_food_menu(self):
+        """Reads the rows of the menu table, bypassing the menu cache"""
+        return self.storage.load_menu()
+    
     def get_specific_menu_item(self, identity):
         """Returns specific item in the food menu"""
-        self.connect_to_db()
-        self.cursor.execute(
-            'SELECT item, unit, rate FROM menu WHERE id = %s', (identity, )
-        )
-        item = self.cursor.fetchone()
+        item = self.storage.get_menu_item(identity)
         if not item:
             raise Exception('No item with id {} exists!'.format(identity))
-        self.conn.close()
         return {'item': item[0], 'unit': item[1], 'rate': item[2]}
     
     def add_menu_item(self, menu_item):
         """Adds a new item to the food menu"""
-        validator.validate_menu_item(menu_item)
-        self.connect_to_db()
-        validator.ensure_menu_item_not_existent(menu_item['item'].strip(), self.cursor)
-        new_item = {
-            'item': menu_item['item'].strip(), 'unit': menu_item['unit'].strip(),
-            'rate': float(menu_item['rate'])
-        }
-        self.cursor.execute(
-            'INSERT INTO menu (item, unit, rate) VALUES (%s, %s, %s)',
-            (new_item['item'], new_item['unit'], new_item['rate'])
+        new_item = validator.validate_menu_item(menu_item)
+        identity = self.storage.insert_menu_item(
+            new_item['item'], new_item['unit'], new_item['rate']
         )
-        self.cursor.execute('SELECT id FROM menu WHERE item = %s', (new_item['item'], ))
-        new_item['id'] = self.cursor.fetchone()[0]
-        self.conn.commit()
-        self.conn.close()
+        if identity is None:
+            raise Exception(new_item['item'] + ' already exists!')
+        new_item['id'] = identity
+        menu_cache.invalidate()
         return new_item
     
     def update_menu_item(self, identity, new_menu_item):
         """Updates menu item identified by 'identity' with 'new_menu_item'"""
-        validator.validate_menu_item(new_menu_item)
+        new_menu_item = validator.validate_menu_item(new_menu_item)
         item_to_update = self.get_specific_menu_item(identity)
         item_to_update.update(new_menu_item)
-        self.connect_to_db()
-        self.cursor.execute(
-            'UPDATE menu SET item = %s, unit = %s, rate = %s WHERE id = %s',
-            (item_to_update['item'], item_to_update['unit'], item_to_update['rate'], identity)
-        )
-        self.conn.commit()
-        self.conn.close()
+        if not self.storage.update_menu_item(
+            identity, item_to_update['item'], item_to_update['unit'], item_to_update['rate']
+        ):
+            raise Exception(item_to_update['item'] + ' already exists!')
+        menu_cache.invalidate()
     
     def delete_menu_item(self, identity):
         """Deletes menu item whose id is specified by the 'identity' parameter"""
-        self.connect_to_db()
-        self.cursor.execute('SELECT item FROM menu WHERE id = %s', (identity, ))
-        item = self.cursor.fetchone()
-        assert item, 'No item with id {} exists!'.format(identity)
-        self.cursor.execute('DELETE FROM menu WHERE id = %s', (identity, ))
-        self.conn.commit()
-        self.conn.close()
+        deleted = self.storage.delete_menu_item(identity)
+        assert deleted, 'No item with id {} exists!'.format(identity)
+        menu_cache.invalidate()
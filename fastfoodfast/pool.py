@@ -0,0 +1,216 @@
+"""
+A per-process pool of reusable database connections shared by the model classes.
+
+The pool is created lazily on first use from the DATABASE_URL environment variable and is
+sized by DB_POOL_MIN_SIZE, DB_POOL_MAX_SIZE, DB_POOL_TIMEOUT (seconds to wait for a free
+connection) and DB_POOL_HEALTH_CHECK_INTERVAL (seconds a connection may sit idle before it
+is pinged on checkout).
+"""
+import os, threading, time
+from collections import deque
+import psycopg2
+from psycopg2 import extensions
+from .metrics import TimedCursor
+
+
+class PoolTimeout(Exception):
+    """Raised when no connection becomes free within the checkout timeout"""
+
+
+class ConnectionPool:
+    def __init__(self, dsn, min_size=1, max_size=10, timeout=5.0,
+                 health_check_interval=30.0, connect=psycopg2.connect):
+        if not 0 <= min_size <= max_size or max_size < 1:
+            raise ValueError('Pool sizes must satisfy 0 <= min_size <= max_size, max_size >= 1')
+        self.dsn = dsn
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.health_check_interval = health_check_interval
+        self._connect = connect
+        self._orphans = list()
+        self._reset_state()
+
+    def _reset_state(self):
+        self._pid = os.getpid()
+        self._condition = threading.Condition()
+        self._idle = deque() # (connection, time it was returned) pairs, most recent last
+        self._size = 0 # connections opened by this process, idle or in use
+        self._in_use = 0
+        self._waiting = 0
+        self._checkouts = 0
+        self._timeouts = 0
+        self._discarded = 0
+        self._checkout_time = 0.0
+        self._max_checkout_time = 0.0
+
+    def _check_process(self):
+        """
+        Drops connections inherited from a parent process, e.g. when gunicorn forks workers
+        after the app was preloaded. The inherited sockets still belong to the parent, so they
+        are kept referenced rather than closed, which would terminate the parent's sessions.
+        """
+        if self._pid == os.getpid():
+            return
+        self._orphans.extend(conn for conn, _ in self._idle)
+        self._reset_state()
+
+    def getconn(self):
+        """Checks a healthy connection out of the pool, opening a new one if there is room"""
+        self._check_process()
+        if self._size < self.min_size:
+            self.fill()
+        started = time.monotonic()
+        deadline = started + self.timeout
+        conn, returned_at = None, None
+        with self._condition:
+            self._waiting += 1
+            try:
+                while True:
+                    if self._idle:
+                        conn, returned_at = self._idle.pop()
+                        break
+                    if self._size < self.max_size:
+                        self._size += 1 # reserve a slot, the connection is opened unlocked
+                        break
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._timeouts += 1
+                        raise PoolTimeout(
+                            'No database connection available after {} seconds'.format(self.timeout)
+                        )
+                    self._condition.wait(remaining)
+            finally:
+                self._waiting -= 1
+            self._in_use += 1
+        try:
+            if conn is not None and not self._is_healthy(conn, returned_at):
+                self._close_quietly(conn)
+                with self._condition:
+                    self._discarded += 1
+                conn = None
+            if conn is None:
+                conn = self._connect(self.dsn)
+        except BaseException:
+            with self._condition:
+                self._size -= 1
+                self._in_use -= 1
+                self._condition.notify()
+            raise
+        elapsed = time.monotonic() - started
+        with self._condition:
+            self._checkouts += 1
+            self._checkout_time += elapsed
+            self._max_checkout_time = max(self._max_checkout_time, elapsed)
+        return conn
+
+    def putconn(self, conn, discard=False):
+        """Returns a connection to the pool, rolling back any transaction left open"""
+        if self._pid != os.getpid():
+            return # checked out before a fork, it belongs to the parent process
+        if not discard and not conn.closed:
+            if conn.get_transaction_status() != extensions.TRANSACTION_STATUS_IDLE:
+                try:
+                    conn.rollback()
+                except psycopg2.Error:
+                    discard = True
+        if discard or conn.closed:
+            self._close_quietly(conn)
+            with self._condition:
+                self._size -= 1
+                self._in_use -= 1
+                self._discarded += 1
+                self._condition.notify()
+            return
+        with self._condition:
+            self._idle.append((conn, time.monotonic()))
+            self._in_use -= 1
+            self._condition.notify()
+
+    def fill(self):
+        """Opens connections until the pool holds at least min_size of them"""
+        while True:
+            with self._condition:
+                if self._size >= self.min_size:
+                    return
+                self._size += 1
+            try:
+                conn = self._connect(self.dsn)
+            except BaseException:
+                with self._condition:
+                    self._size -= 1
+                raise
+            with self._condition:
+                self._idle.appendleft((conn, time.monotonic()))
+                self._condition.notify()
+
+    def close(self):
+        """Closes all idle connections, connections in use are closed when returned"""
+        with self._condition:
+            idle, self._idle = self._idle, deque()
+            self._size -= len(idle)
+        for conn, _ in idle:
+            self._close_quietly(conn)
+
+    def stats(self):
+        """Returns a snapshot of the pool's usage counters"""
+        self._check_process()
+        with self._condition:
+            average = self._checkout_time / self._checkouts if self._checkouts else 0.0
+            return {
+                'size': self._size, 'idle': len(self._idle), 'in-use': self._in_use,
+                'waiting': self._waiting, 'min-size': self.min_size, 'max-size': self.max_size,
+                'checkouts': self._checkouts, 'timeouts': self._timeouts,
+                'discarded': self._discarded,
+                'checkout-latency-avg-ms': round(average * 1000, 3),
+                'checkout-latency-max-ms': round(self._max_checkout_time * 1000, 3)
+            }
+
+    def _is_healthy(self, conn, returned_at):
+        if conn.closed:
+            return False
+        if time.monotonic() - returned_at < self.health_check_interval:
+            return True
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute('SELECT 1')
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    @staticmethod
+    def _close_quietly(conn):
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def connect(dsn):
+    """Opens a connection whose cursors record their statements in the request metrics"""
+    return psycopg2.connect(dsn, cursor_factory=TimedCursor)
+
+
+def get_pool():
+    """Returns this process's pool, (re)creating it when DATABASE_URL changes"""
+    global _pool
+    dsn = os.getenv('DATABASE_URL')
+    if _pool is None or _pool.dsn != dsn:
+        with _pool_lock:
+            if _pool is None or _pool.dsn != dsn:
+                previous, _pool = _pool, ConnectionPool(
+                    dsn,
+                    min_size=int(os.getenv('DB_POOL_MIN_SIZE', 1)),
+                    max_size=int(os.getenv('DB_POOL_MAX_SIZE', 10)),
+                    timeout=float(os.getenv('DB_POOL_TIMEOUT', 5)),
+                    health_check_interval=float(os.getenv('DB_POOL_HEALTH_CHECK_INTERVAL', 30)),
+                    connect=connect
+                )
+                if previous is not None:
+                    previous.close()
+    return _pool
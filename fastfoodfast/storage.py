@@ -0,0 +1,749 @@
+"""
+Storage backends of the models. A backend stores users, orders with their items and menu items,
+and answers the lookups the models make of them; the models validate and shape the data.
+
+The backend is chosen by the STORAGE_BACKEND environment variable: 'postgres' (the default)
+stores the data in the database specified by DATABASE_URL, through the connection pool, while
+'memory' keeps it in indexed dictionaries of the process, so that tests, benchmarks and profiling
+of the API logic need no database. The memory backend is not shared between processes and is
+lost when the process exits. Under it, the ASGI app serves every route through the Flask app,
+as its native routes query PostgreSQL directly.
+"""
+import bisect, itertools, os, threading, time
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+from contextlib import contextmanager
+import psycopg2
+from werkzeug.security import generate_password_hash
+from .events import order_events
+from .metrics import metrics
+from .pool import get_pool
+
+
+def select_orders(where='', limit=False):
+    """
+    Builds a query selecting the orders matching <where>, newest first, joined with their items.
+    There is one row per item, or a single row of NULL items for an order without any, so that a
+    listing costs one query however many orders it returns. With <limit> set, the query takes a
+    LIMIT parameter after those of <where> and returns only that many orders.
+    """
+    return (
+        'SELECT o.id, o.public_id, o.customer, o.status, o.total_cost, i.item, i.quantity, i.cost'
+        ' FROM (SELECT * FROM orders{}{}) o LEFT JOIN order_items i ON i.order_id = o.id'
+        ' ORDER BY o.id DESC, i.id'
+    ).format(' WHERE ' + where if where else '', ' ORDER BY id DESC LIMIT %s' if limit else '')
+
+
+def select_archived_orders(where='', limit=False):
+    """Builds a query like select_orders' over the archived orders, which hold their items"""
+    return (
+        'SELECT id, public_id, customer, status, total_cost, items FROM archived_orders{}'
+        ' ORDER BY id DESC{}'
+    ).format(' WHERE ' + where if where else '', ' LIMIT %s' if limit else '')
+
+
+def archived_order_rows(rows, include_customer=True):
+    """Yields the (primary key, order) pairs of rows selected by select_archived_orders"""
+    for row in rows:
+        order = {
+            'order-id': row[1], 'status': row[3], 'total-cost': row[4],
+            'items': [
+                # REAL columns become JSON numbers, read back as ints when whole
+                {'item': item, 'quantity': float(quantity), 'cost': float(cost)}
+                for item, quantity, cost in row[5]
+            ]
+        }
+        if include_customer:
+            order['customer'] = row[2]
+        yield row[0], order
+
+
+# orders and their items are inserted in one statement, items matched to the new orders' ids
+# through their public ids
+INSERT_ORDERS = (
+    'WITH new_orders AS ('
+    'INSERT INTO orders (public_id, customer, status, total_cost) VALUES {} RETURNING id, public_id'
+    ') INSERT INTO order_items (order_id, item, quantity, cost)'
+    ' SELECT o.id, i.item, i.quantity, i.cost FROM (VALUES {}) AS i (public_id, item, quantity, cost)'
+    ' JOIN new_orders o ON o.public_id = i.public_id'
+)
+# the same, skipping the orders whose public ids are taken, along with their items, and returning
+# the public ids of the orders inserted
+INSERT_NEW_ORDERS = (
+    'WITH new_orders AS ('
+    'INSERT INTO orders (public_id, customer, status, total_cost) VALUES {}'
+    ' ON CONFLICT (public_id) DO NOTHING RETURNING id, public_id'
+    '), new_items AS (INSERT INTO order_items (order_id, item, quantity, cost)'
+    ' SELECT o.id, i.item, i.quantity, i.cost FROM (VALUES {}) AS i (public_id, item, quantity, cost)'
+    ' JOIN new_orders o ON o.public_id = i.public_id'
+    ') SELECT public_id FROM new_orders'
+)
+MAX_ORDERS_PER_STATEMENT = 200 # bounds the size of each multi-row insert of a bulk order
+ARCHIVED_STATUSES = ['complete', 'cancelled'] # orders in these statuses are done with
+ARCHIVE_BATCH_SIZE = 1000 # orders archived per transaction
+# copies orders to the archive, their items folded into a JSON array of [item, quantity, cost]
+# arrays in the order they were added
+ARCHIVE_ORDERS = (
+    'INSERT INTO archived_orders'
+    ' (id, public_id, customer, status, total_cost, items, created_at, updated_at)'
+    " SELECT o.id, o.public_id, o.customer, o.status, o.total_cost, coalesce(i.items, '[]'),"
+    ' o.created_at, o.updated_at FROM orders o LEFT JOIN ('
+    'SELECT order_id, json_agg(json_build_array(item, quantity, cost) ORDER BY id) AS items'
+    ' FROM order_items WHERE order_id = ANY(%s) GROUP BY order_id'
+    ') i ON i.order_id = o.id WHERE o.id = ANY(%s)'
+)
+
+
+MAX_TEXT_LENGTH = 80 # of the VARCHAR(80) columns of orders and order items
+REAL_RANGE = (1.18e-38, 3.4e38) # of the magnitudes of nonzero values of the REAL columns
+
+
+def storage_errors(customer, order):
+    """
+    Returns a message for every value of the new <order> of <customer> that the orders and
+    order_items tables would refuse, for orders that are acknowledged before they are stored
+    """
+    errors = list()
+    texts = [('Customer name', customer), ('Order id', order['order-id'])]
+    numbers = [('Total cost', order['total-cost'])]
+    for index, item in enumerate(order['items']):
+        label = 'Item {}: '.format(index + 1)
+        texts.append((label + 'name', item['item']))
+        numbers += [(label + 'quantity', item['quantity']), (label + 'cost', item['cost'])]
+    for label, text in texts:
+        if len(text) > MAX_TEXT_LENGTH:
+            errors.append('{} can be at most {} characters!'.format(label, MAX_TEXT_LENGTH))
+    for label, number in numbers:
+        if number != 0 and not REAL_RANGE[0] <= abs(number) <= REAL_RANGE[1]:
+            errors.append('{} is out of the range that can be stored!'.format(label))
+    return errors
+
+
+def insert_orders_statement(orders, skip_existing=False):
+    """
+    Returns the query and parameters inserting new orders, given as (customer, order) pairs,
+    together with all of their items in a single statement, one round trip however many orders
+    and items there are. With <skip_existing> set, orders whose public ids are taken are skipped
+    and the query returns the public ids of those inserted.
+    """
+    order_rows = [
+        (order['order-id'], customer, order['status'], order['total-cost'])
+        for customer, order in orders
+    ]
+    item_rows = [
+        (order['order-id'], item['item'], item['quantity'], item['cost'])
+        for _, order in orders for item in order['items']
+    ]
+    # quantities and costs are cast since the types of a VALUES list are not inferred from the
+    # columns they are inserted into, which matters to drivers that send parameters separately
+    query = (INSERT_NEW_ORDERS if skip_existing else INSERT_ORDERS).format(
+        ', '.join(['(%s, %s, %s, %s)'] * len(order_rows)),
+        ', '.join(['(%s, %s, %s::real, %s::real)'] * len(item_rows))
+    )
+    return query, [value for row in order_rows + item_rows for value in row]
+
+
+def archive_partition_statement(month):
+    """
+    Returns the statement creating the partition of archived_orders for the UTC <month>, given
+    as a datetime of its first day
+    """
+    following = (month.replace(day=28) + timedelta(days=4)).replace(day=1)
+    return (
+        'CREATE TABLE IF NOT EXISTS archived_orders_{:%Y_%m} PARTITION OF archived_orders'
+        " FOR VALUES FROM ('{:%Y-%m-%d} 00:00+00') TO ('{:%Y-%m-%d} 00:00+00')"
+    ).format(month, month, following)
+
+
+def group_order_rows(rows, include_customer=True):
+    """
+    Folds rows selected by a select_orders query, sorted by order, into order dictionaries.
+    Yields (primary key, order) pairs lazily so that rows can be consumed from a cursor.
+    """
+    primary_key, order = None, None
+    for row in rows:
+        if row[0] != primary_key:
+            if order is not None:
+                yield primary_key, order
+            primary_key = row[0]
+            order = {'order-id': row[1], 'status': row[3], 'total-cost': row[4], 'items': list()}
+            if include_customer:
+                order['customer'] = row[2]
+        if row[5] is not None:
+            order['items'].append({'item': row[5], 'quantity': row[6], 'cost': row[7]})
+    if order is not None:
+        yield primary_key, order
+
+
+class PostgresStorage:
+    name = 'postgres'
+
+    @contextmanager
+    def transaction(self, name=None):
+        """
+        Checks a connection out of the pool and yields a cursor on it, a server-side cursor if
+        <name> is given. The transaction is committed if the block succeeds, otherwise it is
+        rolled back when the connection is returned to the pool.
+        """
+        pool = get_pool()
+        started = time.perf_counter()
+        conn = pool.getconn()
+        metrics.observe_connection_wait(time.perf_counter() - started)
+        try:
+            with conn.cursor(name=name) as cursor:
+                yield cursor
+            conn.commit()
+        finally:
+            pool.putconn(conn)
+
+    def read_version(self, name):
+        """Returns the counter in the versions table that every write to table <name> bumps"""
+        with self.transaction() as cursor:
+            cursor.execute('SELECT version FROM versions WHERE name = %s', (name, ))
+            return cursor.fetchone()[0]
+
+    def insert_user(self, username, password, email, telephone, admin=False):
+        """Adds a user, returning False if one with <username> already exists"""
+        with self.transaction() as cursor:
+            # the unique index on username detects existing users in a single index probe
+            cursor.execute(
+                'INSERT INTO users (username, password, email, telephone, admin)'
+                ' VALUES (%s, %s, %s, %s, %s) ON CONFLICT (username) DO NOTHING RETURNING id',
+                (username, password, email, telephone, admin)
+            )
+            return cursor.fetchone() is not None
+
+    def get_user(self, username):
+        """Returns the username, password hash and admin flag of a user, or None"""
+        with self.transaction() as cursor:
+            cursor.execute(
+                'SELECT username, password, admin FROM users WHERE username = %s', (username, )
+            )
+            return cursor.fetchone()
+
+    def set_password(self, username, password):
+        with self.transaction() as cursor:
+            cursor.execute(
+                'UPDATE users SET password = %s WHERE username = %s', (password, username)
+            )
+
+    def insert_orders(self, orders, skip_existing=False):
+        """
+        Inserts new orders, given as (customer, order) pairs, in one transaction of multi-row
+        inserts of at most MAX_ORDERS_PER_STATEMENT orders each. Returns the public ids of the
+        orders inserted, which leave out those whose public ids are taken if <skip_existing> is
+        set; otherwise, such an order fails the whole transaction.
+        """
+        inserted = list()
+        with self.transaction() as cursor:
+            for start in range(0, len(orders), MAX_ORDERS_PER_STATEMENT):
+                batch = orders[start:start + MAX_ORDERS_PER_STATEMENT]
+                cursor.execute(*insert_orders_statement(batch, skip_existing))
+                if skip_existing:
+                    inserted.extend(public_id for public_id, in cursor.fetchall())
+                else:
+                    inserted.extend(order['order-id'] for _, order in batch)
+        return inserted
+
+    def read_response(self, customer, key, ttl):
+        """
+        Returns the (request hash, status code, body) of the response recorded for <customer>'s
+        idempotency <key> within the last <ttl> seconds along with its age in seconds, or None
+        """
+        with self.transaction() as cursor:
+            cursor.execute(
+                'SELECT request_hash, status, body, extract(epoch FROM now() - created_at)::float8'
+                ' FROM idempotency_keys WHERE customer = %s AND idempotency_key = %s'
+                " AND created_at > now() - %s * interval '1 second'",
+                (customer, key, ttl)
+            )
+            row = cursor.fetchone()
+        return row and (row[:3], row[3])
+
+    def record_response(self, customer, key, response, ttl, orders=()):
+        """
+        Records the (request hash, status code, body) <response> for <customer>'s idempotency
+        <key> and inserts <orders> in the same transaction, returning None, unless a response was
+        recorded for the key within the last <ttl> seconds. That response is returned instead,
+        along with its age in seconds, and nothing is inserted.
+        """
+        with self.transaction() as cursor:
+            # a concurrent transaction recording the same key holds its index entry until it
+            # commits, when the conflict is detected, or rolls back, when the key is recorded
+            cursor.execute(
+                'INSERT INTO idempotency_keys AS k'
+                ' (customer, idempotency_key, request_hash, status, body)'
+                ' VALUES (%s, %s, %s, %s, %s) ON CONFLICT (customer, idempotency_key) DO UPDATE'
+                ' SET request_hash = EXCLUDED.request_hash, status = EXCLUDED.status,'
+                ' body = EXCLUDED.body, created_at = now()'
+                " WHERE k.created_at <= now() - %s * interval '1 second' RETURNING 1",
+                (customer, key) + tuple(response) + (ttl, )
+            )
+            if cursor.fetchone() is None:
+                cursor.execute(
+                    'SELECT request_hash, status, body,'
+                    ' extract(epoch FROM now() - created_at)::float8 FROM idempotency_keys'
+                    ' WHERE customer = %s AND idempotency_key = %s', (customer, key)
+                )
+                row = cursor.fetchone()
+                return row[:3], row[3]
+            orders = list(orders)
+            for start in range(0, len(orders), MAX_ORDERS_PER_STATEMENT):
+                cursor.execute(
+                    *insert_orders_statement(orders[start:start + MAX_ORDERS_PER_STATEMENT])
+                )
+        return None
+
+    def forget_response(self, customer, key):
+        with self.transaction() as cursor:
+            cursor.execute(
+                'DELETE FROM idempotency_keys WHERE customer = %s AND idempotency_key = %s',
+                (customer, key)
+            )
+
+    def purge_responses(self, ttl):
+        """Deletes the responses recorded for idempotency keys more than <ttl> seconds ago"""
+        with self.transaction() as cursor:
+            cursor.execute(
+                "DELETE FROM idempotency_keys WHERE created_at <= now() - %s * interval '1 second'",
+                (ttl, )
+            )
+
+    def list_orders(self, customer=None, public_id=None, before=None, limit=None,
+                    include_customer=True, archived=False):
+        """
+        Returns (primary key, order) pairs, newest first, of up to <limit> orders, narrowed to
+        those of <customer>, the one with <public_id> and those with primary keys below <before>.
+        Only archived orders are listed if <archived> is set, only the others otherwise.
+        """
+        conditions, params = list(), list()
+        for condition, value in [
+            ('customer = %s', customer), ('public_id = %s', public_id), ('id < %s', before)
+        ]:
+            if value is not None:
+                conditions.append(condition)
+                params.append(value)
+        if limit is not None:
+            params.append(limit)
+        select, fold = (
+            (select_archived_orders, archived_order_rows) if archived
+            else (select_orders, group_order_rows)
+        )
+        with self.transaction() as cursor:
+            cursor.execute(select(' AND '.join(conditions), limit is not None), params)
+            return list(fold(cursor, include_customer))
+
+    def stream_orders(self, batch_size, archived=False):
+        """
+        Yields every order, or every archived order if <archived> is set, newest first, reading
+        rows from a server-side cursor <batch_size> at a time so that memory use does not depend
+        on the number of orders
+        """
+        select, fold = (
+            (select_archived_orders, archived_order_rows) if archived
+            else (select_orders, group_order_rows)
+        )
+        with self.transaction(name='stream_all_orders') as cursor:
+            cursor.itersize = batch_size
+            cursor.execute(select())
+            for _, order in fold(cursor):
+                yield order
+
+    def archive_orders(self, days, batch_size=ARCHIVE_BATCH_SIZE):
+        """
+        Moves the orders in ARCHIVED_STATUSES placed more than <days> days ago, oldest first, from
+        orders and order_items to archived_orders, in transactions of up to <batch_size> orders,
+        creating the monthly partitions they go to. Returns the number of orders archived.
+        """
+        archived = 0
+        while True:
+            with self.transaction() as cursor:
+                # kept out of the sales rollups' deletions, see db_setup.py
+                cursor.execute("SET LOCAL fastfoodfast.archiving = 'on'")
+                # orders locked by a status change in progress are left for the next run
+                cursor.execute(
+                    "SELECT id, date_trunc('month', created_at AT TIME ZONE 'UTC') FROM orders"
+                    " WHERE status = ANY(%s) AND created_at < now() - %s * interval '1 day'"
+                    ' ORDER BY id LIMIT %s FOR UPDATE SKIP LOCKED',
+                    (ARCHIVED_STATUSES, days, batch_size)
+                )
+                rows = cursor.fetchall()
+                for month in sorted({month for _, month in rows}):
+                    cursor.execute(archive_partition_statement(month))
+                ids = [primary_key for primary_key, _ in rows]
+                if ids:
+                    cursor.execute(ARCHIVE_ORDERS, (ids, ids))
+                    cursor.execute('DELETE FROM order_items WHERE order_id = ANY(%s)', (ids, ))
+                    cursor.execute('DELETE FROM orders WHERE id = ANY(%s)', (ids, ))
+            archived += len(ids)
+            if len(ids) < batch_size:
+                return archived
+
+    def set_order_status(self, public_id, status):
+        """Sets the status of the order with <public_id>, returning False if there is none"""
+        with self.transaction() as cursor:
+            cursor.execute(
+                'UPDATE orders SET status = %s WHERE public_id = %s RETURNING id',
+                (status, public_id)
+            )
+            return cursor.rowcount == 1
+
+    def set_orders_status(self, status, public_ids=None, from_status=None):
+        """
+        Sets the status of the orders with <public_ids> and in status <from_status>, whichever
+        are given, in one statement, returning the public ids of the orders updated
+        """
+        conditions, params = list(), [status]
+        for condition, value in [('public_id = ANY(%s)', public_ids), ('status = %s', from_status)]:
+            if value is not None:
+                conditions.append(condition)
+                params.append(value)
+        with self.transaction() as cursor:
+            cursor.execute(
+                'UPDATE orders SET status = %s WHERE {} RETURNING public_id'.format(
+                    ' AND '.join(conditions)
+                ), params
+            )
+            return [row[0] for row in cursor.fetchall()]
+
+    def load_menu(self):
+        """Returns the (id, item, unit, rate) rows of the menu, ordered by id"""
+        with self.transaction() as cursor:
+            cursor.execute('SELECT id, item, unit, rate FROM menu ORDER BY id')
+            return tuple(cursor.fetchall())
+
+    def get_menu_item(self, identity):
+        """Returns the item, unit and rate of a menu item, or None"""
+        with self.transaction() as cursor:
+            cursor.execute('SELECT item, unit, rate FROM menu WHERE id = %s', (identity, ))
+            return cursor.fetchone()
+
+    def insert_menu_item(self, item, unit, rate):
+        """Adds a menu item, returning its id, or None if an item of that name exists"""
+        with self.transaction() as cursor:
+            # item names are unique regardless of case, through the index on lower(item)
+            cursor.execute(
+                'INSERT INTO menu (item, unit, rate) VALUES (%s, %s, %s)'
+                ' ON CONFLICT ((lower(item))) DO NOTHING RETURNING id',
+                (item, unit, rate)
+            )
+            inserted = cursor.fetchone()
+        return inserted and inserted[0]
+
+    def update_menu_item(self, identity, item, unit, rate):
+        """Updates a menu item, returning False if another item has the name <item>"""
+        try:
+            with self.transaction() as cursor:
+                cursor.execute(
+                    'UPDATE menu SET item = %s, unit = %s, rate = %s WHERE id = %s',
+                    (item, unit, rate, identity)
+                )
+        except psycopg2.IntegrityError:
+            return False
+        return True
+
+    def delete_menu_item(self, identity):
+        """Deletes a menu item, returning False if there is none with id <identity>"""
+        with self.transaction() as cursor:
+            cursor.execute('DELETE FROM menu WHERE id = %s RETURNING id', (identity, ))
+            return cursor.fetchone() is not None
+
+    def read_sales(self, first_day, last_day, top):
+        """
+        Returns the (day, status, orders, revenue) rows of the daily sales rollup and the (item,
+        quantity, revenue) rows of the <top> items sold most, between two days inclusive
+        """
+        with self.transaction() as cursor:
+            # the totals are striped over shard rows, see db_setup.py
+            cursor.execute(
+                'SELECT day, status, sum(orders), sum(revenue) FROM daily_sales'
+                ' WHERE day BETWEEN %s AND %s GROUP BY day, status HAVING sum(orders) <> 0'
+                ' ORDER BY day, status',
+                (first_day, last_day)
+            )
+            days = cursor.fetchall()
+            cursor.execute(
+                'SELECT item, sum(quantity), sum(revenue) FROM daily_item_sales'
+                ' WHERE day BETWEEN %s AND %s GROUP BY item HAVING sum(quantity) > 0'
+                ' ORDER BY sum(quantity) DESC, item LIMIT %s',
+                (first_day, last_day, top)
+            )
+            return days, cursor.fetchall()
+
+
+class MemoryStorage:
+    """
+    Keeps users by username, orders and archived orders by primary key, public id and customer,
+    each with its list of items, menu items by id and lowercased name, and responses by
+    idempotency key. Like the database's triggers, it bumps the menu version on menu writes,
+    publishes order events and rolls up daily sales.
+    """
+    name = 'memory'
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._users = {
+            # the default administrator, as db_setup.py seeds it
+            'admin': ('admin', generate_password_hash('administrator', method='sha256'), True)
+        }
+        self._orders = dict()
+        self._order_keys = list() # primary keys, ascending since they are assigned in order
+        self._public_ids = dict()
+        self._customer_keys = defaultdict(list)
+        # the archived orders, indexed the same way
+        self._archive = (dict(), list(), dict(), defaultdict(list))
+        self._menu = dict()
+        self._menu_names = dict()
+        self._versions = {'menu': 0}
+        self._daily_sales = defaultdict(lambda: [0, 0.0]) # (day, status): [orders, revenue]
+        self._daily_item_sales = defaultdict(lambda: [0.0, 0.0]) # (day, item): [quantity, revenue]
+        self._next_order_key = itertools.count(1)
+        self._next_menu_id = itertools.count(1)
+        self._responses = dict() # (customer, idempotency key): (response, time recorded)
+
+    def read_version(self, name):
+        return self._versions[name]
+
+    def insert_user(self, username, password, email, telephone, admin=False):
+        with self._lock:
+            if username in self._users:
+                return False
+            self._users[username] = (username, password, admin)
+            return True
+
+    def get_user(self, username):
+        return self._users.get(username)
+
+    def set_password(self, username, password):
+        with self._lock:
+            username, _, admin = self._users[username]
+            self._users[username] = (username, password, admin)
+
+    def insert_orders(self, orders, skip_existing=False):
+        events, inserted = list(), list()
+        with self._lock:
+            for customer, order in orders:
+                if order['order-id'] in self._public_ids:
+                    if skip_existing:
+                        continue
+                    raise Exception('Order {} already exists!'.format(order['order-id']))
+                key, placed_at = next(self._next_order_key), datetime.now(timezone.utc)
+                self._orders[key] = {
+                    'order-id': order['order-id'], 'customer': customer,
+                    'status': order['status'], 'total-cost': float(order['total-cost']),
+                    'created-at': placed_at, 'day': placed_at.date(),
+                    'items': [
+                        {
+                            'item': item['item'], 'quantity': float(item['quantity']),
+                            'cost': float(item['cost'])
+                        }
+                        for item in order['items']
+                    ]
+                }
+                self._order_keys.append(key)
+                self._public_ids[order['order-id']] = key
+                self._customer_keys[customer].append(key)
+                self.roll_up(self._orders[key], 1)
+                events.append(self.order_event('created', self._orders[key]))
+                inserted.append(order['order-id'])
+        for event in events:
+            order_events.publish(event)
+        return inserted
+
+    def read_response(self, customer, key, ttl):
+        entry = self._responses.get((customer, key))
+        if entry is None or entry[1] <= time.monotonic() - ttl:
+            return None
+        return entry[0], time.monotonic() - entry[1]
+
+    def record_response(self, customer, key, response, ttl, orders=()):
+        with self._lock:
+            entry = self._responses.get((customer, key))
+            if entry is not None and entry[1] > time.monotonic() - ttl:
+                return entry[0], time.monotonic() - entry[1]
+            self._responses[(customer, key)] = (tuple(response), time.monotonic())
+        try:
+            self.insert_orders(list(orders))
+        except Exception:
+            self.forget_response(customer, key)
+            raise
+        return None
+
+    def forget_response(self, customer, key):
+        with self._lock:
+            self._responses.pop((customer, key), None)
+
+    def purge_responses(self, ttl):
+        with self._lock:
+            expired = time.monotonic() - ttl
+            for key, (_, recorded_at) in list(self._responses.items()):
+                if recorded_at <= expired:
+                    del self._responses[key]
+
+    def list_orders(self, customer=None, public_id=None, before=None, limit=None,
+                    include_customer=True, archived=False):
+        orders, order_keys, public_ids, customer_keys = self._archive if archived else (
+            self._orders, self._order_keys, self._public_ids, self._customer_keys
+        )
+        with self._lock:
+            if public_id is not None:
+                keys = [public_ids[public_id]] if public_id in public_ids else []
+            elif customer is not None:
+                keys = customer_keys.get(customer, [])
+            else:
+                keys = order_keys
+            end = len(keys) if before is None else bisect.bisect_left(keys, before)
+            start = 0 if limit is None else max(end - limit, 0)
+            return [
+                (key, self.copy_order(orders[key], include_customer))
+                for key in reversed(keys[start:end])
+            ]
+
+    def stream_orders(self, batch_size, archived=False):
+        for _, order in self.list_orders(archived=archived):
+            yield order
+
+    def archive_orders(self, days, batch_size=ARCHIVE_BATCH_SIZE):
+        orders, order_keys, public_ids, customer_keys = self._archive
+        placed_before = datetime.now(timezone.utc) - timedelta(days=days)
+        with self._lock:
+            keys = [
+                key for key in self._order_keys
+                if self._orders[key]['status'] in ARCHIVED_STATUSES
+                and self._orders[key]['created-at'] < placed_before
+            ]
+            for key in keys:
+                order = orders[key] = self._orders.pop(key)
+                self._order_keys.remove(key)
+                self._customer_keys[order['customer']].remove(key)
+                del self._public_ids[order['order-id']]
+                # orders finished late are archived after newer ones, keep the keys sorted
+                bisect.insort(order_keys, key)
+                bisect.insort(customer_keys[order['customer']], key)
+                public_ids[order['order-id']] = key
+        return len(keys)
+
+    def set_order_status(self, public_id, status):
+        return bool(self.set_orders_status(status, public_ids=[public_id]))
+
+    def set_orders_status(self, status, public_ids=None, from_status=None):
+        events, updated = list(), list()
+        with self._lock:
+            if public_ids is None:
+                keys = self._order_keys
+            else:
+                keys = [self._public_ids[key] for key in public_ids if key in self._public_ids]
+            for key in keys:
+                order = self._orders[key]
+                if from_status is not None and order['status'] != from_status:
+                    continue
+                if order['status'] != status:
+                    self.roll_up(order, -1)
+                    order['status'] = status
+                    self.roll_up(order, 1)
+                    events.append(self.order_event('updated', order))
+                updated.append(order['order-id'])
+        for event in events:
+            order_events.publish(event)
+        return updated
+
+    def roll_up(self, order, sign):
+        """Adds <order> to the sales rollups if <sign> is 1, takes it out of them if it is -1"""
+        sales = self._daily_sales[order['day'], order['status']]
+        sales[0] += sign
+        sales[1] += sign * order['total-cost']
+        if order['status'] == 'cancelled':
+            return
+        for item in order['items']:
+            item_sales = self._daily_item_sales[order['day'], item['item']]
+            item_sales[0] += sign * item['quantity']
+            item_sales[1] += sign * item['cost']
+
+    def read_sales(self, first_day, last_day, top):
+        items = defaultdict(lambda: [0.0, 0.0])
+        with self._lock:
+            days = sorted(
+                (day, status, orders, revenue)
+                for (day, status), (orders, revenue) in self._daily_sales.items()
+                if first_day <= day <= last_day and orders
+            )
+            for (day, item), (quantity, revenue) in self._daily_item_sales.items():
+                if first_day <= day <= last_day:
+                    items[item][0] += quantity
+                    items[item][1] += revenue
+        sold = [(item, totals[0], totals[1]) for item, totals in items.items() if totals[0] > 0]
+        return days, sorted(sold, key=lambda row: (-row[1], row[0]))[:top]
+
+    def load_menu(self):
+        with self._lock:
+            return tuple(self._menu[identity] for identity in sorted(self._menu))
+
+    def get_menu_item(self, identity):
+        row = self._menu.get(identity)
+        return row and row[1:]
+
+    def insert_menu_item(self, item, unit, rate):
+        with self._lock:
+            if item.lower() in self._menu_names:
+                return None
+            identity = next(self._next_menu_id)
+            self._menu[identity] = (identity, item, unit, float(rate))
+            self._menu_names[item.lower()] = identity
+            self._versions['menu'] += 1
+            return identity
+
+    def update_menu_item(self, identity, item, unit, rate):
+        with self._lock:
+            if self._menu_names.get(item.lower(), identity) != identity:
+                return False
+            if identity in self._menu:
+                del self._menu_names[self._menu[identity][1].lower()]
+                self._menu[identity] = (identity, item, unit, float(rate))
+                self._menu_names[item.lower()] = identity
+                self._versions['menu'] += 1
+            return True
+
+    def delete_menu_item(self, identity):
+        with self._lock:
+            row = self._menu.pop(identity, None)
+            if row is None:
+                return False
+            del self._menu_names[row[1].lower()]
+            self._versions['menu'] += 1
+            return True
+
+    @staticmethod
+    def copy_order(order, include_customer=True):
+        copy = {
+            'order-id': order['order-id'], 'status': order['status'],
+            'total-cost': order['total-cost'], 'items': [dict(item) for item in order['items']]
+        }
+        if include_customer:
+            copy['customer'] = order['customer']
+        return copy
+
+    @staticmethod
+    def order_event(event, order):
+        """The event that the database's order triggers would publish"""
+        return {
+            'event': event, 'order-id': order['order-id'], 'customer': order['customer'],
+            'status': order['status'], 'total-cost': order['total-cost']
+        }
+
+
+BACKENDS = {'postgres': PostgresStorage, 'memory': MemoryStorage}
+_storage = None
+_storage_lock = threading.Lock()
+
+
+def get_storage():
+    """Returns this process's storage backend, (re)creating it when STORAGE_BACKEND changes"""
+    global _storage
+    name = os.getenv('STORAGE_BACKEND', 'postgres')
+    if _storage is None or _storage.name != name:
+        with _storage_lock:
+            if _storage is None or _storage.name != name:
+                if name not in BACKENDS:
+                    raise ValueError('STORAGE_BACKEND must be one of ' + ', '.join(BACKENDS))
+                _storage = BACKENDS[name]()
+    return _storage
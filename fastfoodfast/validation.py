@@ -1,122 +1,291 @@
 """
 Validation code for checking the correctness of data sent to the API.
+
+Request data is described by declarative schemas, built and compiled once at import. Validating a
+payload checks all of it in a single pass and raises a ValidationError reporting every problem
+found, along with returning a cleaned copy of the data (strings stripped, numbers parsed).
 """
 import re
 
+INFINITY = float('inf')
+# business limits, well within the range of the REAL columns that quantities and costs are kept in
+MAX_QUANTITY = 1000 # of an item in an order
+MAX_COST = 10 ** 9 # of a menu item's rate, an order item and an order
+ITEM_NAME_PATTERN = re.compile(r'[a-zA-Z]{2,30}( [a-zA-Z]{2,30})*$')
+NAME_PATTERN = re.compile(r'[a-zA-Z]{3,30}( [a-zA-Z]{3,30})*$') # of users and menu items
+EMAIL_PATTERN = re.compile(r'[a-zA-Z0-9]+@[a-zA-Z]+\.[a-zA-Z]{2,3}((\.[a-zA-Z]{2,3})+)?$')
+TELEPHONE_PATTERN = re.compile(r'\+[0-9]{1,3}-[0-9]{3}-[0-9]{6}$')
+UNIT_PATTERN = re.compile(r'[a-zA-Z]{2,30}$')
+
+
+class ValidationError(Exception):
+    """Raised with the list of every problem found in request data"""
+    def __init__(self, errors):
+        super().__init__('; '.join(errors))
+        self.errors = errors
+
+
+class Rule:
+    """
+    Checks and cleans the value of a field. Messages for problems are appended to a list of
+    errors, prefixed with a label locating the value within the request data.
+    """
+    def check(self, value, errors, prefix):
+        raise NotImplementedError
+
+
+class Text(Rule):
+    """A string, stripped of surrounding spaces, that must match the compiled <pattern> if given"""
+    def __init__(self, type_error, pattern=None, pattern_error=None):
+        self.type_error = type_error
+        self.pattern = pattern
+        self.pattern_error = pattern_error
+
+    def check(self, value, errors, prefix):
+        if not isinstance(value, str):
+            errors.append(prefix + self.type_error)
+            return None
+        value = value.strip()
+        if self.pattern is not None and not self.pattern.match(value):
+            errors.append(prefix + self.pattern_error)
+        return value
+
+
+class OneOf(Text):
+    """A string that, stripped and lowercased, must be one of <choices>"""
+    def __init__(self, choices, type_error, choice_error):
+        super().__init__(type_error)
+        self.choices = frozenset(choices)
+        self.choice_error = choice_error
+
+    def check(self, value, errors, prefix):
+        value = super().check(value, errors, prefix)
+        if value is None:
+            return None
+        value = value.lower()
+        if value not in self.choices:
+            errors.append(prefix + self.choice_error)
+        return value
+
+
+class PositiveNumber(Rule):
+    """
+    A finite number, or a string holding one, that must be greater than zero and at most
+    <maximum>, if given
+    """
+    def __init__(self, type_error, positive_error, maximum=INFINITY, maximum_error=None):
+        self.type_error = type_error
+        self.positive_error = positive_error
+        self.maximum = maximum
+        self.maximum_error = maximum_error
+
+    def check(self, value, errors, prefix):
+        try:
+            number = float(value)
+        except (TypeError, ValueError):
+            errors.append(prefix + self.type_error)
+            return None
+        if not 0 < number < INFINITY or value is True:
+            if number > 0 or number != number or value is True: # infinite, NaN or boolean
+                errors.append(prefix + self.type_error)
+            else:
+                errors.append(prefix + self.positive_error)
+        elif number > self.maximum:
+            errors.append(prefix + self.maximum_error)
+        return number
+
+
+class Password(Rule):
+    """A password of 6 to 12 characters with a lowercase and an uppercase letter and a digit"""
+    def __init__(self, type_error, error):
+        self.type_error = type_error
+        self.error = error
+
+    def check(self, value, errors, prefix):
+        if not isinstance(value, str):
+            errors.append(prefix + self.type_error)
+            return None
+        valid = (
+            6 <= len(value) <= 12 and any(map(str.islower, value))
+            and any(map(str.isupper, value)) and any(map(str.isdigit, value))
+        )
+        if not valid:
+            errors.append(prefix + self.error)
+        return value
+
+
+class ListOf(Rule):
+    """A non-empty list of objects described by <schema>, labelled by <item_prefix> in errors"""
+    def __init__(self, schema, type_error, empty_error, item_prefix):
+        self.schema = schema
+        self.type_error = type_error
+        self.empty_error = empty_error
+        self.item_prefix = item_prefix
+
+    def check(self, value, errors, prefix):
+        if not isinstance(value, list):
+            errors.append(prefix + self.type_error)
+            return None
+        if not value:
+            errors.append(prefix + self.empty_error)
+        check, cleaned = self.schema.check, list()
+        for index, element in enumerate(value):
+            count = len(errors)
+            cleaned.append(check(element, errors, ''))
+            if len(errors) > count: # label the element's errors only when there are some
+                label = prefix + self.item_prefix.format(index + 1)
+                errors[count:] = [label + error for error in errors[count:]]
+        return cleaned
+
+
+class Schema:
+    def __init__(self, fields, type_error, redundant_error=None):
+        """
+        <fields> is a list of (name, message if missing, rule) triples, where a message of None
+        makes the field optional. If <redundant_error> is given, fields other than those declared
+        are rejected with it.
+
+        The schema is compiled once into plain functions, its check and validate methods, which
+        call the check methods of its rules bound ahead of time.
+        """
+        self.fields = fields
+        self.type_error = type_error
+        self.redundant_error = redundant_error
+        self.check, self.validate = self.compile()
+
+    def compile(self):
+        """
+        Returns the check and validate functions of the schema. check(data, errors, prefix='')
+        returns a cleaned copy of <data>, appending a message for every problem to <errors>.
+        validate(data) returns the cleaned copy, raising a ValidationError if there are problems.
+        """
+        fields = [(name, missing_error, rule.check) for name, missing_error, rule in self.fields]
+        type_error, redundant_error = self.type_error, self.redundant_error
+
+        def check(data, errors, prefix=''):
+            if not isinstance(data, dict):
+                errors.append(prefix + type_error)
+                return None
+            cleaned = dict() if redundant_error else dict(data)
+            for name, missing_error, check_value in fields:
+                if name in data:
+                    cleaned[name] = check_value(data[name], errors, prefix)
+                elif missing_error is not None:
+                    errors.append(prefix + missing_error)
+            if redundant_error is not None and len(data) > len(cleaned):
+                errors.append(prefix + redundant_error) # only declared fields are copied to cleaned
+            return cleaned
+
+        def validate(data):
+            errors = list()
+            cleaned = check(data, errors)
+            if errors:
+                raise ValidationError(errors)
+            return cleaned
+
+        return check, validate
+
+
+STATUS_SCHEMA = Schema(
+    [
+        ('status', 'Specify status in your request data', OneOf(
+            ['new', 'processing', 'cancelled', 'complete'], 'Specify status as a string',
+            'Specify status as new, processing, cancelled, or complete'
+        ))
+    ],
+    'Enter a dictionary to update status', 'Redundant data in status request'
+)
+
+ORDER_ITEM_SCHEMA = Schema(
+    [
+        ('item', 'Specify item name!', Text(
+            'Item name must be a string!', ITEM_NAME_PATTERN, 'Invalid item specified!'
+        )),
+        ('quantity', 'Item quantity not specified!', PositiveNumber(
+            'Specify quantity as a number!', 'Item quantity must be greater than zero!',
+            MAX_QUANTITY, 'Item quantity can be at most {}!'.format(MAX_QUANTITY)
+        )),
+        # orders are priced from the menu, a cost sent by older clients is checked but ignored
+        ('cost', None, PositiveNumber(
+            'Specify item cost as a number!', 'Item cost must be greater than zero!'
+        ))
+    ],
+    'Specify order item as a dictionary!', 'Redundant fields in request data!'
+)
+
+ORDER_SCHEMA = Schema(
+    [
+        ('items', 'items to order not specified!', ListOf(
+            ORDER_ITEM_SCHEMA, 'Specify order items as a list', 'Items list empty!', 'Item {}: '
+        ))
+    ],
+    'Order data must be represented in JSON!'
+)
+
+USER_SCHEMA = Schema(
+    [
+        ('username', 'Username not specified!', Text(
+            'Username must be a string!', NAME_PATTERN,
+            'Username can only contain letters. Names (firstname/lastname) are separated'
+            ' by single spaces and each must contain atleast three letters!'
+        )),
+        ('password', 'Password not specified!', Password(
+            'Password must be a string!',
+            'Password must contain atleast one lowercase letter, one uppercase letter,'
+            ' a digit and be 6 to 12 characters long!'
+        )),
+        ('email', 'Email address not specified!', Text(
+            'Email address must be a string!', EMAIL_PATTERN, 'Email address is invalid!'
+        )),
+        ('telephone', 'Phone number not specified!', Text(
+            'Telephone contact must be a string!', TELEPHONE_PATTERN,
+            'Telephone contact is invalid!'
+        ))
+    ],
+    'Specify registration data in JSON format!'
+)
+
+MENU_ITEM_SCHEMA = Schema(
+    [
+        ('item', 'item not specified!', Text(
+            'item must be specified as a string!', NAME_PATTERN, 'invalid item name!'
+        )),
+        ('unit', 'unit not specified!', Text(
+            'unit must be specified as a string!', UNIT_PATTERN, 'invalid unit specified!'
+        )),
+        ('rate', 'rate not specified!', PositiveNumber(
+            'specify rate as a number greater than zero',
+            'specify rate as a number greater than zero',
+            MAX_COST, 'rate can be at most {}'.format(MAX_COST)
+        ))
+    ],
+    'Specify menu item as a valid JSON string', 'redundant data in request body!'
+)
+
 
 class Validation:
     def validate_status_data(self, status_data):
         """
         Checks if request data sent by admin to update the status of an order is valid i.e is
         of the form {'status': '<status>'}, where <status> can only be 'new', 'processing',
-        'cancelled' or 'complete'. An exception is raised if the data is invalid.
+        'cancelled' or 'complete'. Returns the data with the status normalized to lowercase.
         """
-        assert isinstance(status_data, dict), 'Enter a dictionary to update status'
-        assert 'status' in status_data, 'Specify status in your request data'
-        status_data['status'] = status_data['status'].strip().lower()
-        if status_data['status'] not in ['new', 'processing', 'cancelled', 'complete']:
-            raise Exception('Specify status as new, processing, cancelled, or complete')
-        assert len(status_data) == 1, 'Redundant data in status request'
-    
+        return STATUS_SCHEMA.validate(status_data)
+
     def validate_order(self, order):
-        assert isinstance(order, dict), 'Order data must be represented in JSON!'
-        assert 'items' in order, 'items to order not specified!'
-        assert isinstance(order['items'], list), 'Specify order items as a list'
-        assert len(order['items']) > 0, 'Items list empty!'
-        for item in order['items']:
-            self.validate_order_item(item)
-    
+        """
+        Returns the order with its items' names stripped and quantities parsed. Orders are priced
+        from the menu by Orders.new_order, so the items' costs are optional.
+        """
+        return ORDER_SCHEMA.validate(order)
+
     def validate_order_item(self, item):
-        assert isinstance(item, dict), 'Specify order item as a dictionary!'
-        assert 'item' in item, 'Specify item name!'
-        assert 'quantity' in item, 'Item quantity not specified!'
-        assert 'cost' in item, 'Item cost not specified!'
-        assert isinstance(item['item'], str), 'Item name must be a string!'
-        pattern = re.compile(r'[a-zA-Z]{2,30}( [a-zA-Z]{2,30})*$')
-        assert pattern.match(item['item'].strip()), 'Invalid item specified!'
-        assert float(item['quantity']), 'Specify quantity as a number!'
-        assert float(item['quantity']) > 0, 'Item quantity cannot be negative!'
-        assert float(item['cost']), 'Specify item cost as a number!'
-        assert float(item['cost']) > 0, 'Item cost cannot be negative!'
-        assert len(item) == 3, 'Redundant fields in request data!'
-    
+        return ORDER_ITEM_SCHEMA.validate(item)
+
     def validate_user_data(self, user_data):
-        assert isinstance(user_data, dict), 'Specify registration data in JSON format!'
-        self.ensure_required_fields_present(user_data)
-        self.validate_username(user_data['username'])
-        self.validate_email_address(user_data['email'])
-        self.validate_telephone_number(user_data['telephone'])
-        self.validate_password(user_data['password'])
-        return self.process_user_data(user_data)
-    
-    def ensure_required_fields_present(self, user_data):
-        assert 'username' in user_data, 'Username not specified!'
-        assert 'password' in user_data, 'Password not specified!'
-        assert 'email' in user_data, 'Email address not specified!'
-        assert 'telephone' in user_data, 'Phone number not specified!'
-    
-    def validate_username(self, username):
-        assert isinstance(username, str), 'Username must be a string!'
-        username_pattern = re.compile(r'[a-zA-Z]{3,30}( [a-zA-Z]{3,30})*$')
-        error_message = (
-            'Username can only contain letters. Names (firstname/lastname) are separated'
-            ' by single spaces and each must contain atleast three letters!'
-        )
-        assert username_pattern.match(username.strip()), error_message
-    
-    def validate_email_address(self, email_address):
-        assert isinstance(email_address, str), 'Email address must be a string!'
-        pattern = re.compile(r'[a-zA-Z0-9]+@[a-zA-Z]+\.[a-zA-Z]{2,3}((\.[a-zA-Z]{2,3})+)?$')
-        assert pattern.match(email_address.strip()), 'Email address is invalid!'
-    
-    def validate_telephone_number(self, telephone_number):
-        assert isinstance(telephone_number, str), 'Telephone contact must be a string!'
-        telephone_pattern = re.compile(r'\+[0-9]{1,3}-[0-9]{3}-[0-9]{6}$')
-        assert telephone_pattern.match(telephone_number.strip()), 'Telephone contact is invalid!'
-    
-    def validate_password(self, password):
-        assert isinstance(password, str), 'Password must be a string!'
-        checks = {'a-z': str.islower, 'A-Z': str.isupper, '0-9': str.isdigit}
-        for character in password:
-            for key, check in checks.items():
-                if check(character):
-                    del checks[key]
-                    break # move onto the next character
-        password_is_valid = len(checks) == 0 and 6 <= len(password) <= 12
-        error_message = (
-            'Password must contain atleast one lowercase letter, one uppercase letter,'
-            ' a digit and be 6 to 12 characters long!'
-        )
-        assert password_is_valid, error_message
-    
-    def process_user_data(self, user_data):
-        user_data['username'] = user_data['username'].strip()
-        user_data['email'] = user_data['email'].strip()
-        user_data['telephone'] = user_data['telephone'].strip()
-        return user_data
-    
-    def ensure_user_not_existent(self, username, cursor):
-        cursor.execute('SELECT username FROM users')
-        for record in cursor.fetchall():
-            if username in record:
-                raise Exception('{} already exists!'.format(username))
-    
+        """Returns the registration data with username, email and telephone stripped"""
+        return USER_SCHEMA.validate(user_data)
+
     def validate_menu_item(self, menu_item):
         """Ensures that menu item data sent by admin is valid, raises exception if invalid. """
-        assert isinstance(menu_item, dict), 'Specify menu item as a valid JSON string'
-        assert 'item' in menu_item, 'item not specified!'
-        assert 'unit' in menu_item, 'unit not specified!'
-        assert 'rate' in menu_item, 'rate not specified!'
-        assert len(menu_item) == 3, 'redundant data in request body!'
-        assert isinstance(menu_item['item'], str), 'item must be specified as a string!'
-        item_pattern = re.compile('[a-zA-Z]{3,30}( [a-zA-Z]{3,30})*$')
-        assert item_pattern.match(menu_item['item'].strip()), 'invalid item name!'
-        assert isinstance(menu_item['unit'], str), 'unit must be specified as a string!'
-        unit_pattern = re.compile('[a-zA-Z]{2,30}$')
-        assert unit_pattern.match(menu_item['unit'].strip()), 'invalid unit specified!'
-        assert float(menu_item['rate']) > 0, 'specify rate as a number greater than zero'
-    
-    def ensure_menu_item_not_existent(self, item_name, cursor):
-        cursor.execute('SELECT item FROM menu')
-        for item in cursor.fetchall():
-            assert item_name.lower() != item[0].lower(), item_name + ' already exists!'
+        return MENU_ITEM_SCHEMA.validate(menu_item)
@@ -0,0 +1,60 @@
+import os, pytest
+from flask_jwt_extended import create_access_token
+from fastfoodfast import app, storage
+from fastfoodfast.models import menu_cache
+
+
+class RecordingHub:
+    """Stands in for the order event hub, recording what is published"""
+    def __init__(self):
+        self.events = list()
+
+    def publish(self, event):
+        self.events.append(event)
+
+
+def pytest_configure(config):
+    config.addinivalue_line(
+        'markers', 'postgres: tests the PostgreSQL backend, skipped when STORAGE_BACKEND=memory'
+    )
+
+
+def pytest_collection_modifyitems(config, items):
+    if os.getenv('STORAGE_BACKEND') == 'memory':
+        for item in items:
+            if 'postgres' in item.keywords:
+                item.add_marker(pytest.mark.skip(reason='needs the PostgreSQL backend'))
+
+
+@pytest.fixture(autouse=True)
+def fresh_memory_backend(monkeypatch):
+    """
+    Runs each test on a fresh backend when the suite runs with STORAGE_BACKEND=memory, so that
+    what a test stores needs no cleaning up
+    """
+    if os.getenv('STORAGE_BACKEND') == 'memory':
+        monkeypatch.setattr(storage, '_storage', storage.MemoryStorage())
+        menu_cache.invalidate()
+
+
+@pytest.fixture
+def memory_storage(monkeypatch):
+    """Runs the models on a fresh memory backend, with no database reachable"""
+    monkeypatch.setenv('STORAGE_BACKEND', 'memory')
+    monkeypatch.setenv('DATABASE_URL', 'postgres://nobody@127.0.0.1:1/nowhere')
+    backend = storage.MemoryStorage()
+    monkeypatch.setattr(storage, '_storage', backend)
+    monkeypatch.setattr(storage, 'order_events', RecordingHub())
+    menu_cache.invalidate() # the menu versions of the backends are unrelated
+    yield backend
+    menu_cache.invalidate()
+
+
+@pytest.fixture
+def access_headers():
+    """Returns a function making the headers of a request sent by the customer <identity>"""
+    def headers(identity):
+        with app.app_context():
+            token = create_access_token(identity=identity, user_claims={'admin': False})
+        return {'Authorization': 'Bearer ' + token}
+    return headers
@@ -0,0 +1,68 @@
+import pytest
+from fastfoodfast import app, admission
+from fastfoodfast.admission import SharedBuckets, AdmissionControl, parse_limit, route_class
+
+
+@pytest.fixture
+def control(monkeypatch, tmp_path):
+    """Installs the admission control returned by the fixture's callable in the app"""
+    def install(**options):
+        installed = AdmissionControl(path=str(tmp_path / 'buckets'), **options)
+        monkeypatch.setattr(admission, 'admission', installed)
+        return installed
+    return install
+
+
+def test_token_buckets_are_shared_through_their_file(tmp_path):
+    path = str(tmp_path / 'buckets')
+    worker, other_worker = SharedBuckets(path, slots=64), SharedBuckets(path, slots=64)
+    assert worker.take('writes:user:tony', 2, 10, now=100) == 0
+    assert other_worker.take('writes:user:tony', 2, 10, now=100) == 0
+    assert worker.take('writes:user:tony', 2, 10, now=100) == pytest.approx(5)
+    assert other_worker.take('writes:user:pepper', 2, 10, now=100) == 0
+    assert other_worker.take('writes:user:tony', 2, 10, now=105) == 0 # refilled at 1 per 5s
+
+
+def test_token_buckets_make_room_for_new_clients_when_the_table_is_full(tmp_path):
+    buckets = SharedBuckets(str(tmp_path / 'buckets'), slots=8)
+    for number in range(8):
+        assert buckets.take('reads:ip:10.0.0.{}'.format(number), 1, 60, now=number) == 0
+    assert buckets.take('reads:ip:10.0.0.99', 1, 60, now=10) == 0
+    assert buckets.take('reads:ip:10.0.0.99', 1, 60, now=10) > 0
+
+
+def test_rate_limits_and_route_classes_are_read_from_configuration():
+    assert parse_limit('60/60') == (60, 60) and parse_limit('') is None
+    with pytest.raises(ValueError):
+        parse_limit('sixty')
+    with pytest.raises(ValueError):
+        parse_limit('0/60')
+    assert route_class('POST', '/api/v1/auth/login') == 'auth'
+    assert route_class('POST', '/api/v1/users/orders') == 'writes'
+    assert route_class('GET', '/api/v1/users/orders') == 'reads'
+
+
+def test_api_limits_clients_by_identity_or_else_by_ip(control, access_headers):
+    control(limits={'auth': (2, 60), 'reads': (1, 60)})
+    client = app.test_client()
+    for _ in range(2):
+        assert client.post('/api/v1/auth/signup', json={}).status_code == 400
+    response = client.post('/api/v1/auth/signup', json={})
+    assert response.status_code == 429 and int(response.headers['Retry-After']) == 30
+    assert response.get_json() == {'error': 'Too many requests, please try again later'}
+    assert client.get('/api/v1/menu/0', headers=access_headers('happy hogan')).status_code != 429
+    assert client.get('/api/v1/menu/0', headers=access_headers('happy hogan')).status_code == 429
+    assert client.get('/api/v1/menu/0', headers=access_headers('may parker')).status_code != 429
+
+
+def test_api_sheds_requests_beyond_the_concurrency_cap(control):
+    installed = control(max_concurrent=1)
+    client = app.test_client()
+    assert installed.enter() # a request in flight
+    response = client.get('/api/v1/menu/0')
+    assert response.status_code == 503 and response.headers['Retry-After'] == '1'
+    assert client.get('/metrics').status_code == 200
+    installed.leave()
+    assert client.get('/api/v1/menu/0').status_code == 401
+    assert installed.enter() # released by the requests that were admitted
+    installed.leave()
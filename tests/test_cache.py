@@ -0,0 +1,56 @@
+from fastfoodfast.cache import VersionedCache, TTLCache
+
+
+def test_cache_computes_value_once_per_version():
+    cache = VersionedCache('menu')
+    calls = list()
+    def compute():
+        calls.append(1)
+        return 'value'
+    version = cache.current_version(lambda: 1)
+    assert cache.get('key', version, compute) == 'value'
+    assert cache.get('key', cache.current_version(lambda: 1), compute) == 'value'
+    assert len(calls) == 1
+
+
+def test_cache_recomputes_value_after_version_changes():
+    cache = VersionedCache('menu')
+    cache.get('key', cache.current_version(lambda: 1), lambda: 'old')
+    assert cache.get('key', cache.current_version(lambda: 2), lambda: 'new') == 'new'
+
+
+def test_cache_reads_version_at_most_once_per_check_interval():
+    cache = VersionedCache('menu', check_interval=60)
+    reads = list()
+    def read_version():
+        reads.append(1)
+        return 7
+    assert cache.current_version(read_version) == 7
+    assert cache.current_version(read_version) == 7
+    assert len(reads) == 1
+    cache.invalidate()
+    cache.current_version(read_version)
+    assert len(reads) == 2
+
+
+def test_cache_does_not_store_values_computed_for_an_outdated_version():
+    cache = VersionedCache('menu')
+    old_version = cache.current_version(lambda: 1)
+    cache.current_version(lambda: 2)
+    cache.get('key', old_version, lambda: 'stale')
+    assert cache.get('key', 2, lambda: 'fresh') == 'fresh'
+
+
+def test_ttl_cache_evicts_least_recently_used_entry():
+    cache = TTLCache(max_size=2, ttl=60)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.get('a')
+    cache.set('c', 3)
+    assert cache.get('a') == 1 and cache.get('b') is None and cache.get('c') == 3
+
+
+def test_ttl_cache_expires_entries():
+    cache = TTLCache(max_size=2, ttl=0)
+    cache.set('a', 1)
+    assert cache.get('a', 'expired') == 'expired'
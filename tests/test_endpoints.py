@@ -1,5 +1,5 @@
-import pytest, psycopg2, os
-from fastfoodfast import app
+import pytest, psycopg2, os, json
+from fastfoodfast import app, fastfoodfast, storage
 from werkzeug.security import check_password_hash
 
 
@@ -11,10 +11,29 @@ def test_client():
 
 @pytest.fixture
 def connection():
+    if storage.get_storage().name == 'memory':
+        return None # the backend is fresh for each test, so there is nothing to clean up
     conn = psycopg2.connect(os.getenv('DATABASE_URL'))
     return conn
 
 
+MENU = [
+    ('pizza', 'slice', 18000), ('chips', 'packet', 2000), ('hot dog', 'piece', 7500),
+    ('salad', 'bowl', 10000), ('water', 'bottle', 1000), ('rolex', 'piece', 1000),
+    ('milk', 'cup', 5000)
+]
+
+
+@pytest.fixture
+def menu(test_client):
+    """Puts the items ordered by the tests on the menu, which orders are priced from"""
+    backend = storage.get_storage()
+    ids = [backend.insert_menu_item(item, unit, rate) for item, unit, rate in MENU]
+    yield
+    for identity in ids:
+        backend.delete_menu_item(identity)
+
+
 def register_and_login_user(name, password, test_client):
     """Signs up and logs in a new user, returns Authorization header for the user"""
     user_data = {
@@ -40,6 +59,8 @@ def login_administrator(test_client):
 
 def clean_users(conn, *usernames):
     """Used by tests to reset changes made to users table"""
+    if conn is None:
+        return
     cursor = conn.cursor()
     for username in usernames:
         cursor.execute('DELETE FROM users WHERE username = %s', (username, ))
@@ -47,6 +68,8 @@ def clean_users(conn, *usernames):
 
 def clean_orders(conn, customer):
     """Used by tests to revert changes made to database when testing orders management"""
+    if conn is None:
+        return
     cursor = conn.cursor()
     cursor.execute('SELECT id FROM orders WHERE customer = %s', (customer, ))
     for order_id in cursor.fetchall():
@@ -55,6 +78,8 @@ def clean_orders(conn, customer):
 
 
 def commit_and_close(conn):
+    if conn is None:
+        return
     conn.commit()
     conn.close()
 
@@ -100,17 +125,39 @@ def test_api_returns_error_message_given_wrong_login_data(test_client):
     assert 'error' in response.get_json()
 
 
-def test_api_can_place_an_order_for_food(test_client, connection):
+def test_api_can_place_an_order_for_food(test_client, connection, menu):
     headers = register_and_login_user('Loki Odinson', 'M1sch1ef', test_client)
     order = {'items': [{'item': 'pizza', 'quantity': 1, 'cost': 20000}]}
     response = test_client.post('/api/v1/users/orders', json=order, headers=headers)
     assert response.status_code == 201
     assert 'order-id' in response.get_json()
+    assert response.get_json()['total-cost'] == 18000 # priced from the menu
+    order = {'items': [{'item': 'pizza', 'quantity': 1}, {'item': 'caviar', 'quantity': 1}]}
+    response = test_client.post('/api/v1/users/orders', json=order, headers=headers)
+    assert response.status_code == 400
+    assert response.get_json()['error'] == 'Item 2: caviar is not on the menu!'
     clean_orders(connection, 'Loki Odinson')
     clean_users(connection, 'Loki Odinson')
     commit_and_close(connection)
 
 
+def test_api_refuses_quantities_and_rates_out_of_range_of_the_database(
+        test_client, connection, menu):
+    headers = register_and_login_user('Ego', 'L1v1ngPl4n3t', test_client)
+    order = {'items': [{'item': 'pizza', 'quantity': 1e37}]}
+    response = test_client.post('/api/v1/users/orders', json=order, headers=headers)
+    assert response.status_code == 400
+    assert response.get_json()['error'] == 'Item 1: Item quantity can be at most 1000!'
+    menu_item = {'item': 'gold leaf', 'unit': 'sheet', 'rate': 1e39}
+    admin_headers = login_administrator(test_client)
+    response = test_client.post('/api/v1/menu', json=menu_item, headers=admin_headers)
+    assert response.status_code == 400
+    assert response.get_json()['error'] == 'rate can be at most 1000000000'
+    assert test_client.get('/api/v1/users/orders', headers=headers).status_code == 404
+    clean_users(connection, 'Ego')
+    commit_and_close(connection)
+
+
 def test_api_returns_error_message_given_incorrect_post_order_data(test_client, connection):
     headers = register_and_login_user('okoye', 'Genera1', test_client)
     response = test_client.post('/api/v1/users/orders', json={}, headers=headers)
@@ -120,7 +167,34 @@ def test_api_returns_error_message_given_incorrect_post_order_data(test_client,
     commit_and_close(connection)
 
 
-def test_api_returns_user_order_history(test_client, connection):
+def test_api_places_bulk_orders_atomically_or_partially(test_client, connection, menu):
+    headers = register_and_login_user('wanda maximoff', 'H3xMag1c', test_client)
+    valid = {'items': [{'item': 'chips', 'quantity': 2, 'cost': 4000}]}
+    invalid = {'items': [{'item': 'chips', 'quantity': -1, 'cost': 4000}]}
+    url = '/api/v1/users/orders/bulk'
+    response = test_client.post(url, json={'orders': [valid] * 3}, headers=headers)
+    assert response.status_code == 201
+    assert response.get_json()['created'] == 3
+    response = test_client.post(url, json={'orders': [valid, invalid]}, headers=headers)
+    assert response.status_code == 400
+    results = response.get_json()['results']
+    assert [result['created'] for result in results] == [False, False]
+    assert results[1]['errors'] == ['Item 1: Item quantity must be greater than zero!']
+    response = test_client.post(
+        url, json={'orders': [invalid, valid], 'atomic': False}, headers=headers
+    )
+    assert response.status_code == 207
+    results = response.get_json()['results']
+    assert [result['created'] for result in results] == [False, True]
+    assert 'order-id' in results[1]['order']
+    history = test_client.get('/api/v1/users/orders', headers=headers).get_json()
+    assert len(history['orders']) == 4
+    clean_orders(connection, 'wanda maximoff')
+    clean_users(connection, 'wanda maximoff')
+    commit_and_close(connection)
+
+
+def test_api_returns_user_order_history(test_client, connection, menu):
     headers = register_and_login_user('steve rodgers', 'C4pit4n', test_client)
     order_1 = {'items': [{'item': 'hot dog', 'quantity': 2, 'cost': 15000}]}
     order_2 = {'items': [{'item': 'salad', 'quantity': 1, 'cost': 10000}]}
@@ -136,17 +210,42 @@ def test_api_returns_user_order_history(test_client, connection):
     commit_and_close(connection)
 
 
+def test_api_paginates_user_order_history_with_cursor(test_client, connection, menu):
+    headers = register_and_login_user('natasha', 'Bl4ckW1d', test_client)
+    order = {'items': [{'item': 'salad', 'quantity': 1, 'cost': 10000}]}
+    order_ids = list()
+    for _ in range(3):
+        response = test_client.post('/api/v1/users/orders', json=order, headers=headers)
+        order_ids.append(response.get_json()['order-id'])
+    response_1 = test_client.get('/api/v1/users/orders?limit=2', headers=headers)
+    cursor = response_1.get_json()['next-cursor']
+    response_2 = test_client.get(
+        '/api/v1/users/orders?limit=2&cursor={}'.format(cursor), headers=headers
+    )
+    response_3 = test_client.get('/api/v1/users/orders?limit=0', headers=headers)
+    assert response_1.status_code == 200 and response_2.status_code == 200
+    page_1 = [order['order-id'] for order in response_1.get_json()['orders']]
+    page_2 = [order['order-id'] for order in response_2.get_json()['orders']]
+    assert page_1 + page_2 == list(reversed(order_ids)) # newest first
+    assert response_2.get_json()['next-cursor'] is None
+    assert response_3.status_code == 400
+    for cursor in ('not-a-cursor', 'LTE', 'MA'): # 'LTE' and 'MA' decode to -1 and 0
+        response = test_client.get('/api/v1/users/orders?cursor=' + cursor, headers=headers)
+        assert response.status_code == 400
+    clean_orders(connection, 'natasha')
+    clean_users(connection, 'natasha')
+    commit_and_close(connection)
+
+
 def test_api_returns_message_when_getting_non_existent_order_history(test_client, connection):
     headers = register_and_login_user('winter soldier', 'S0ldier', test_client)
     response = test_client.get('/api/v1/users/orders', headers=headers)
     assert response.status_code == 404
     assert 'error' in response.get_json()
-    cursor = connection.cursor()
-    cursor.execute('DELETE FROM users WHERE username = %s', ('winter soldier', ))
-    connection.commit()
-    connection.close()
+    clean_users(connection, 'winter soldier')
+    commit_and_close(connection)
 
-def test_admin_can_get_all_orders_from_database(test_client, connection):
+def test_admin_can_get_all_orders_from_database(test_client, connection, menu):
     headers_1 = register_and_login_user('Prisca', 'Pr1sca$', test_client)
     headers_2 = register_and_login_user('Banner', 'St0ng3st', test_client)
     headers_3 = login_administrator(test_client)
@@ -166,7 +265,58 @@ def test_admin_can_get_all_orders_from_database(test_client, connection):
     commit_and_close(connection)
 
 
-def test_admin_can_get_a_specific_order_by_id(test_client, connection):
+def test_admin_can_stream_all_orders_as_json_lines(test_client, connection, menu):
+    headers_1 = register_and_login_user('Wong', 'S0rc3rer', test_client)
+    headers_2 = login_administrator(test_client)
+    order = {'items': [{'item': 'salad', 'quantity': 1, 'cost': 10000}]}
+    order_id = test_client.post(
+        '/api/v1/users/orders', json=order, headers=headers_1
+    ).get_json()['order-id']
+    # each streamed response is read to the end before the next request is made
+    response_1 = test_client.get('/api/v1/orders?stream=ndjson', headers=headers_2)
+    assert response_1.status_code == 200
+    assert response_1.mimetype == 'application/x-ndjson'
+    lines = response_1.get_data(as_text=True).splitlines()
+    assert order_id in [json.loads(line)['order-id'] for line in lines]
+    response_2 = test_client.get('/api/v1/orders?stream=json', headers=headers_2)
+    assert response_2.status_code == 200
+    assert order_id in [order['order-id'] for order in json.loads(response_2.get_data())['orders']]
+    response_3 = test_client.get('/api/v1/orders?stream=xml', headers=headers_2)
+    assert response_3.status_code == 400
+    clean_orders(connection, 'Wong')
+    clean_users(connection, 'Wong')
+    commit_and_close(connection)
+
+
+def test_api_streams_changes_of_own_orders_as_server_sent_events(test_client, connection, menu):
+    headers_1 = register_and_login_user('Groot', 'Iam9r00t', test_client)
+    headers_2 = register_and_login_user('Rocket', 'R4cc00n!', test_client)
+    response = test_client.get('/api/v1/orders/events', headers=headers_1, buffered=False)
+    assert response.status_code == 200
+    assert response.mimetype == 'text/event-stream'
+    chunks = iter(response.response)
+    assert next(chunks) == b'retry: 3000\n\n' # subscribed once the stream has started
+    if storage.get_storage().name == 'postgres': # the memory backend publishes events itself
+        assert fastfoodfast.order_events.listening.wait(timeout=5)
+    order = {'items': [{'item': 'water', 'quantity': 1, 'cost': 1000}]}
+    test_client.post('/api/v1/users/orders', json=order, headers=headers_2)
+    order_id = test_client.post(
+        '/api/v1/users/orders', json=order, headers=headers_1
+    ).get_json()['order-id']
+    event = next(chunks).decode()
+    response.close()
+    assert event.startswith('event: order\ndata: ')
+    assert json.loads(event.split('data: ')[1]) == {
+        'event': 'created', 'order-id': order_id, 'customer': 'Groot',
+        'status': 'new', 'total-cost': 1000
+    }
+    clean_orders(connection, 'Groot')
+    clean_orders(connection, 'Rocket')
+    clean_users(connection, 'Groot', 'Rocket')
+    commit_and_close(connection)
+
+
+def test_admin_can_get_a_specific_order_by_id(test_client, connection, menu):
     headers = login_administrator(test_client)
     order = {'items': [{'item': 'rolex', 'quantity': 2, 'cost': 2000}]}
     response_1 = test_client.post('/api/v1/users/orders', json=order, headers=headers)
@@ -181,7 +331,7 @@ def test_admin_can_get_a_specific_order_by_id(test_client, connection):
     commit_and_close(connection)
 
 
-def test_admin_can_update_order_status(test_client, connection):
+def test_admin_can_update_order_status(test_client, connection, menu):
     headers_1 = register_and_login_user('quill', 'St4rl0rd', test_client)
     order = {'items': [{'item': 'milk', 'quantity': 1, 'cost': 5000}]}
     response_1 = test_client.post('/api/v1/users/orders', json=order, headers=headers_1)
@@ -198,6 +348,75 @@ def test_admin_can_update_order_status(test_client, connection):
     commit_and_close(connection)
 
 
+def test_admin_can_update_status_of_many_orders_at_once(test_client, connection, menu):
+    headers_1 = register_and_login_user('kraglin', 'R4v4g3r', test_client)
+    headers_2 = login_administrator(test_client)
+    order = {'items': [{'item': 'milk', 'quantity': 1}]}
+    response = test_client.post(
+        '/api/v1/users/orders/bulk', json={'orders': [order] * 3}, headers=headers_1
+    )
+    order_ids = [result['order']['order-id'] for result in response.get_json()['results']]
+    url = '/api/v1/orders/status'
+    response_1 = test_client.put(
+        url, json={'status': 'processing', 'order-ids': order_ids[:2]}, headers=headers_2
+    )
+    response_2 = test_client.put(
+        url, json={'status': 'complete', 'from-status': 'processing', 'order-ids': order_ids},
+        headers=headers_2
+    )
+    response_3 = test_client.put(
+        url, json={'status': 'complete', 'order-ids': ['missing']}, headers=headers_2
+    )
+    response_4 = test_client.put(url, json={'status': 'complete'}, headers=headers_2)
+    response_5 = test_client.put(
+        url, json={'status': 'complete', 'order-ids': order_ids}, headers=headers_1
+    )
+    assert response_1.status_code == 200 and response_1.get_json()['updated'] == 2
+    assert response_2.status_code == 207
+    assert sorted(response_2.get_json()['order-ids']) == sorted(order_ids[:2])
+    assert response_2.get_json()['skipped'] == order_ids[2:]
+    assert response_3.status_code == 404 and response_3.get_json()['skipped'] == ['missing']
+    assert response_4.status_code == 400 and response_5.status_code == 401
+    history = test_client.get('/api/v1/users/orders', headers=headers_1).get_json()['orders']
+    assert sorted(order['status'] for order in history) == ['complete', 'complete', 'new']
+    response = test_client.put('/api/v1/orders/missing', json={'status': 'new'}, headers=headers_2)
+    assert response.status_code == 404
+    response = test_client.put(
+        '/api/v1/orders/missing', json={'status': 'eaten'}, headers=headers_2
+    )
+    assert response.status_code == 400
+    clean_orders(connection, 'kraglin')
+    clean_users(connection, 'kraglin')
+    commit_and_close(connection)
+
+
+def test_admin_can_get_a_sales_report_for_a_range_of_days(test_client, connection, menu):
+    headers_1 = register_and_login_user('mantis', 'Emp4th1c', test_client)
+    headers_2 = login_administrator(test_client)
+    order = {'items': [{'item': 'salad', 'quantity': 2}]}
+    test_client.post('/api/v1/users/orders', json=order, headers=headers_1)
+    response_1 = test_client.get('/api/v1/stats/sales', headers=headers_2)
+    today = response_1.get_json()['to']
+    response_2 = test_client.get(
+        '/api/v1/stats/sales?from={0}&to={0}&top=1'.format(today), headers=headers_2
+    )
+    url = '/api/v1/stats/sales?'
+    response_3 = test_client.get(url + 'from=2018-10-18&to=2018-10-01', headers=headers_2)
+    response_4 = test_client.get(url + 'from=2017-01-01&to=2018-10-01', headers=headers_2)
+    response_5 = test_client.get(url + 'to=yesterday', headers=headers_2)
+    response_6 = test_client.get('/api/v1/stats/sales', headers=headers_1)
+    assert response_1.status_code == 200 and response_2.status_code == 200
+    report = response_2.get_json()
+    assert report['days'][0]['date'] == today and report['orders'] >= 1
+    assert report['statuses']['new'] >= 1 and report['revenue'] >= 20000
+    assert len(report['top-items']) == 1
+    assert response_3.status_code == response_4.status_code == response_5.status_code == 400
+    assert response_6.status_code == 401
+    clean_orders(connection, 'mantis')
+    clean_users(connection, 'mantis')
+    commit_and_close(connection)
+
+
 def test_api_can_return_created_menu_item_to_admin(test_client, connection):
     headers = login_administrator(test_client)
     menu_item = {'item': 'spaghetti', 'unit': 'pack', 'rate': 5000}
@@ -209,9 +428,29 @@ def test_api_can_return_created_menu_item_to_admin(test_client, connection):
     assert created_item in response_2.get_json()['menu']
     assert menu_item == response_3.get_json()
     assert response_2.status_code == 200
-    connection.cursor().execute('DELETE FROM menu WHERE item = %s', ('spaghetti', ))
-    connection.commit()
-    connection.close
+    storage.get_storage().delete_menu_item(created_item['id'])
+    commit_and_close(connection)
+
+
+def test_api_returns_304_for_unchanged_menu_and_200_after_it_changes(test_client, connection):
+    headers = login_administrator(test_client)
+    menu_item = {'item': 'pancakes', 'unit': 'plate', 'rate': 6000}
+    item_ids = [test_client.post('/api/v1/menu', json=menu_item, headers=headers).get_json()['id']]
+    response_1 = test_client.get('/api/v1/menu', headers=headers)
+    etag = response_1.headers['ETag']
+    headers['If-None-Match'] = etag
+    response_2 = test_client.get('/api/v1/menu', headers=headers)
+    menu_item['item'] = 'waffles'
+    item_ids.append(
+        test_client.post('/api/v1/menu', json=menu_item, headers=headers).get_json()['id']
+    )
+    response_3 = test_client.get('/api/v1/menu', headers=headers)
+    assert response_1.status_code == 200
+    assert response_2.status_code == 304 and response_2.get_data() == b''
+    assert response_3.status_code == 200 and response_3.headers['ETag'] != etag
+    for item_id in item_ids:
+        storage.get_storage().delete_menu_item(item_id)
+    commit_and_close(connection)
 
 
 def test_api_raises_404_when_fetching_non_existent_menu_item(test_client):
@@ -231,7 +470,7 @@ def test_api_enables_admin_to_edit_a_menu_item(test_client, connection):
     assert response_1.status_code == 201 and response_2.status_code == 200
     assert response_3.status_code == 200
     assert item == response_3.get_json()
-    connection.cursor().execute('DELETE FROM menu WHERE item = %s', ('Muchomo', ))
+    storage.get_storage().delete_menu_item(item_id)
     commit_and_close(connection)
 
 
@@ -291,6 +530,15 @@ def test_api_returns_error_for_unauthorized_access_to_admin_routes(test_client,
     commit_and_close(connection)
 
 
+def test_admin_routes_authorize_from_token_claims_without_querying_roles(test_client, monkeypatch):
+    headers = login_administrator(test_client)
+    def is_admin(user):
+        raise Exception('role looked up in the database')
+    monkeypatch.setattr(fastfoodfast.users_model, 'is_admin', is_admin)
+    response = test_client.get('/api/v1/orders/67DAEDe', headers=headers)
+    assert response.status_code == 404 # authorized, but there is no such order
+
+
 def test_api_returns_404_error_when_requesting_non_existent_url(test_client):
     response = test_client.get('/api/v2')
     assert response.status_code == 404
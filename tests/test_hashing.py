@@ -0,0 +1,49 @@
+import pytest, time
+from werkzeug.security import generate_password_hash
+from fastfoodfast.hashing import PasswordHasher, HashingOverloaded
+
+
+def test_hasher_verifies_passwords_it_hashed():
+    hasher = PasswordHasher(method='pbkdf2:sha256:1000')
+    password_hash = hasher.hash('P4$$word')
+    assert hasher.verify(password_hash, 'P4$$word')
+    assert not hasher.verify(password_hash, 'wrong')
+
+
+def test_hasher_runs_hashing_in_worker_processes():
+    hasher = PasswordHasher(method='pbkdf2:sha256:1000', workers=1)
+    assert hasher.verify(hasher.hash('P4$$word'), 'P4$$word')
+
+
+def test_hasher_sheds_load_when_queue_is_full():
+    hasher = PasswordHasher(method='pbkdf2:sha256:1000000', workers=1, queue_limit=1)
+    password_hash = generate_password_hash('P4$$word', method='pbkdf2:sha256:1000')
+    assert hasher.verify(password_hash, 'P4$$word') # starts the worker process
+    hasher.timeout = 0.01
+    with pytest.raises(HashingOverloaded):
+        hasher.hash('P4$$word')
+    hasher.timeout = 10
+    with pytest.raises(HashingOverloaded): # the job that timed out holds its slot until done
+        hasher.verify(password_hash, 'P4$$word')
+    deadline = time.monotonic() + 10
+    while True:
+        try:
+            assert hasher.verify(password_hash, 'P4$$word')
+            break
+        except HashingOverloaded:
+            assert time.monotonic() < deadline
+            time.sleep(0.05)
+
+
+def test_hasher_refuses_an_empty_queue_for_worker_processes():
+    with pytest.raises(ValueError):
+        PasswordHasher(workers=1, queue_limit=0)
+    assert PasswordHasher(method='pbkdf2:sha256:1000', queue_limit=0).hash('P4$$word')
+
+
+def test_hasher_flags_hashes_made_with_outdated_methods_for_rehashing():
+    hasher = PasswordHasher(method='pbkdf2:sha256:1000')
+    assert hasher.needs_rehash(generate_password_hash('P4$$word', method='sha256'))
+    assert hasher.needs_rehash(generate_password_hash('P4$$word', method='pbkdf2:sha256:500'))
+    assert not hasher.needs_rehash(hasher.hash('P4$$word'))
+    assert hasher.verify(generate_password_hash('P4$$word', method='sha256'), 'P4$$word')
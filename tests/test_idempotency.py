@@ -0,0 +1,86 @@
+import time
+import pytest
+from fastfoodfast import app, idempotency, ingestion
+from fastfoodfast.idempotency import KeyReused, Replayed, new_response
+from fastfoodfast.ingestion import OrderQueue
+from fastfoodfast.models import Orders, Menu
+
+
+@pytest.fixture
+def responses(monkeypatch):
+    """A fresh cache of recorded responses"""
+    cache = idempotency.TTLCache(max_size=16, ttl=60)
+    monkeypatch.setattr(idempotency, 'responses', cache)
+    return cache
+
+
+def test_retries_with_a_key_are_answered_with_the_first_response(
+        memory_storage, responses, access_headers):
+    tea = Menu().add_menu_item({'item': 'tea', 'unit': 'cup', 'rate': 500})
+    client = app.test_client()
+    headers = dict(access_headers('kraglin'), **{'Idempotency-Key': 'order-1'})
+    order = {'items': [{'item': 'tea', 'quantity': 2}]}
+    first = client.post('/api/v1/users/orders', json=order, headers=headers)
+    assert first.status_code == 201 and 'Idempotent-Replayed' not in first.headers
+    Menu().delete_menu_item(tea['id']) # replays are not validated again
+    for cached in (True, False):
+        if not cached:
+            responses.pop(('kraglin', 'order-1'))
+        retry = client.post('/api/v1/users/orders', json=order, headers=headers)
+        assert retry.status_code == 201 and retry.headers['Idempotent-Replayed'] == 'true'
+        assert retry.get_json() == first.get_json()
+    assert len(Orders().get_order_history('kraglin')) == 1
+    other = {'items': [{'item': 'tea', 'quantity': 3}]}
+    response = client.post('/api/v1/users/orders', json=other, headers=headers)
+    assert response.status_code == 422
+    # keys are scoped to their customer
+    headers = dict(access_headers('taserface'), **{'Idempotency-Key': 'order-1'})
+    assert client.post('/api/v1/users/orders', json=order, headers=headers).status_code == 400
+    headers['Idempotency-Key'] = 'x' * 256
+    response = client.post('/api/v1/users/orders', json=order, headers=headers)
+    assert response.status_code == 400 and 'Idempotency-Key' in response.get_json()['error']
+
+
+def test_a_key_recorded_by_a_concurrent_request_places_no_order(memory_storage, responses):
+    order = {'order-id': 'c1', 'status': 'new', 'total-cost': 500, 'items': []}
+    won = new_response('hash', 201, order)
+    idempotency.record(memory_storage, 'nebula', 'key', won, [('nebula', order)])
+    lost = new_response('hash', 201, dict(order, **{'order-id': 'c2'}))
+    responses.pop(('nebula', 'key')) # recorded by another process
+    with pytest.raises(Replayed) as replayed:
+        idempotency.record(memory_storage, 'nebula', 'key', lost, [('nebula', order)])
+    assert replayed.value.response == (201, won[2])
+    with pytest.raises(KeyReused):
+        idempotency.record(memory_storage, 'nebula', 'key', new_response('other', 201, order))
+    assert [order['order-id'] for _, order in memory_storage.list_orders()] == ['c1']
+    assert memory_storage.read_response('nebula', 'key', ttl=0) is None
+    memory_storage.purge_responses(ttl=0)
+    assert memory_storage.read_response('nebula', 'key', ttl=60) is None
+
+
+def test_responses_read_back_are_cached_only_for_the_time_their_key_has_left(
+        memory_storage, responses, monkeypatch):
+    monkeypatch.setattr(idempotency, 'IDEMPOTENCY_KEY_TTL', 60)
+    response = new_response('hash', 201, {'order-id': 'c1'})
+    for key, age in (('young', 59.9), ('expiring', 60)):
+        # recorded by another process <age> seconds ago
+        memory_storage._responses[('drax', key)] = (response, time.monotonic() - age)
+        idempotency.lookup(memory_storage, 'drax', key, 'hash')
+    assert responses.get(('drax', 'young')) == response
+    assert responses.get(('drax', 'expiring')) is None
+    time.sleep(0.2)
+    assert responses.get(('drax', 'young')) is None
+def test_keys_of_orders_the_queue_refuses_are_forgotten(
+        memory_storage, responses, tmp_path, monkeypatch, access_headers):
+    queue = OrderQueue(str(tmp_path), flush_interval=60, limit=1)
+    monkeypatch.setattr(ingestion, 'order_queue', queue)
+    Menu().add_menu_item({'item': 'tea', 'unit': 'cup', 'rate': 500})
+    client = app.test_client()
+    headers = access_headers('yondu')
+    order = {'items': [{'item': 'tea', 'quantity': 1}]}
+    for key, status in (('first', 202), ('second', 503), ('first', 202)):
+        headers['Idempotency-Key'] = key
+        assert client.post('/api/v1/users/orders', json=order, headers=headers).status_code == status
+    assert memory_storage.read_response('yondu', 'second', ttl=60) is None
+    queue.close()
+    assert len(Orders().get_order_history('yondu')) == 1
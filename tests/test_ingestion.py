@@ -0,0 +1,154 @@
+import os, json, time, pytest, psycopg2
+from fastfoodfast import app, ingestion
+from fastfoodfast.ingestion import OrderQueue, QueueFull, encode_order
+from fastfoodfast.models import Orders, Menu
+
+
+def tea_order(order_id, quantity=1):
+    return {
+        'order-id': order_id, 'status': 'new', 'total-cost': 500 * quantity,
+        'items': [{'item': 'tea', 'quantity': quantity, 'cost': 500 * quantity}]
+    }
+
+
+def journals(directory):
+    return sorted(name for name in os.listdir(str(directory)) if name.startswith('orders-'))
+
+
+def test_queued_orders_are_journaled_then_flushed(memory_storage, tmp_path):
+    queue = OrderQueue(str(tmp_path), flush_interval=60, batch_size=4, limit=3)
+    queue.put([('rocket', tea_order('a1')), ('rocket', tea_order('a2'))])
+    queue.put([('groot', tea_order('a3'))])
+    with pytest.raises(QueueFull):
+        queue.put([('groot', tea_order('a4'))])
+    journal = tmp_path / journals(tmp_path)[0]
+    assert len(journal.read_bytes().splitlines()) == 3
+    assert memory_storage.list_orders() == []
+    queue.flush()
+    assert [order['order-id'] for _, order in memory_storage.list_orders()] == ['a3', 'a2', 'a1']
+    assert journal.read_bytes() == b'' and queue.stats()['pending'] == 0
+    assert queue.stats()['flushed'] == 3
+    queue.close()
+    assert journals(tmp_path) == []
+
+
+def test_journals_of_dead_processes_are_replayed_once(memory_storage, tmp_path):
+    memory_storage.insert_orders([('drax', tea_order('b1')), ('nebula', tea_order('b2'))])
+    (tmp_path / 'orders-1-dead.journal').write_bytes(
+        encode_order('drax', tea_order('b1')) # stored before the crash
+        + encode_order('mantis', tea_order('b2')) # its id taken by another order since
+        + encode_order('drax', tea_order('b3', 2))
+        + b'{"customer": "drax", "ord' # cut short by the crash
+    )
+    queue = OrderQueue(str(tmp_path), flush_interval=60)
+    queue.start()
+    assert not (tmp_path / 'orders-1-dead.journal').exists()
+    queue.flush()
+    stored = {order['order-id']: order for _, order in memory_storage.list_orders()}
+    assert sorted(stored) == ['b1', 'b2', 'b3']
+    assert stored['b2']['customer'] == 'nebula' and stored['b3']['total-cost'] == 1000
+    rejected = (tmp_path / 'rejected.journal').read_bytes().splitlines()
+    assert [json.loads(line)['customer'] for line in rejected] == ['mantis']
+    assert queue.stats()['rejected'] == 1
+    other = OrderQueue(str(tmp_path), flush_interval=60)
+    other.start() # a live process's journal is left alone
+    assert len(journals(tmp_path)) == 2
+    other.close()
+    queue.close()
+
+
+def test_journals_of_dead_processes_are_replayed_as_the_app_starts(
+        memory_storage, tmp_path, monkeypatch):
+    (tmp_path / 'orders-1-dead.journal').write_bytes(encode_order('drax', tea_order('d1')))
+    queue = OrderQueue(str(tmp_path), flush_interval=0.01)
+    monkeypatch.setattr(ingestion, 'order_queue', queue)
+    ingestion.init_app(app)
+    for _ in range(100):
+        if queue.stats()['flushed']:
+            break
+        time.sleep(0.01)
+    assert [order['order-id'] for _, order in memory_storage.list_orders()] == ['d1']
+    queue.close()
+    assert journals(tmp_path) == []
+
+
+def test_api_accepts_queued_orders_with_202(
+        memory_storage, tmp_path, monkeypatch, access_headers):
+    queue = OrderQueue(str(tmp_path), flush_interval=60, limit=1)
+    monkeypatch.setattr(ingestion, 'order_queue', queue)
+    Menu().add_menu_item({'item': 'tea', 'unit': 'cup', 'rate': 500})
+    client = app.test_client()
+    headers = access_headers('yondu')
+    order = {'items': [{'item': 'tea', 'quantity': 2}]}
+    response = client.post('/api/v1/users/orders', json=order, headers=headers)
+    assert response.status_code == 202
+    order_id = response.get_json()['order-id']
+    response = client.post('/api/v1/users/orders', json=order, headers=headers)
+    assert response.status_code == 503 and response.headers['Retry-After'] == '1'
+    queue.flush()
+    assert Orders().get_specific_order(order_id)['total-cost'] == 1000
+    response = client.post('/api/v1/users/orders/bulk', json={'orders': [order]}, headers=headers)
+    assert response.status_code == 202
+    queue.close()
+    assert len(Orders().get_order_history('yondu')) == 2
+
+
+def test_orders_the_database_refuses_are_set_aside_after_failed_batches(
+        memory_storage, tmp_path, monkeypatch):
+    insert_orders = memory_storage.insert_orders
+
+    def refusing(orders, skip_existing=False):
+        if any(order['total-cost'] > 10 ** 6 for _, order in orders):
+            raise psycopg2.DataError('value out of range for type real')
+        return insert_orders(orders, skip_existing)
+    monkeypatch.setattr(memory_storage, 'insert_orders', refusing)
+    queue = OrderQueue(str(tmp_path), flush_interval=60)
+    queue.put([
+        ('groot', tea_order('e1')), ('groot', tea_order('e2', 10 ** 4)), ('groot', tea_order('e3'))
+    ])
+    for _ in range(ingestion.MAX_BATCH_ATTEMPTS - 1):
+        with pytest.raises(psycopg2.DataError):
+            queue.flush()
+    queue.flush()
+    assert sorted(order['order-id'] for _, order in memory_storage.list_orders()) == ['e1', 'e3']
+    rejected = (tmp_path / 'rejected.journal').read_bytes().splitlines()
+    assert [json.loads(line)['order']['order-id'] for line in rejected] == ['e2']
+    assert queue.stats()['pending'] == 0 and queue.stats()['rejected'] == 1
+    queue.close()
+
+
+def test_batches_stay_queued_while_the_database_is_unreachable(
+        memory_storage, tmp_path, monkeypatch):
+    insert_orders = memory_storage.insert_orders
+
+    def unreachable(orders, skip_existing=False):
+        raise psycopg2.OperationalError('could not connect to server')
+    monkeypatch.setattr(memory_storage, 'insert_orders', unreachable)
+    queue = OrderQueue(str(tmp_path), flush_interval=60)
+    queue.put([('groot', tea_order('f1'))])
+    for _ in range(ingestion.MAX_BATCH_ATTEMPTS + 1):
+        with pytest.raises(psycopg2.OperationalError):
+            queue.flush()
+    assert queue.stats()['pending'] == 1 and queue.stats()['rejected'] == 0
+    monkeypatch.setattr(memory_storage, 'insert_orders', insert_orders) # reachable again
+    queue.close()
+    assert [order['order-id'] for _, order in memory_storage.list_orders()] == ['f1']
+
+
+def test_api_refuses_queued_orders_the_database_would_refuse(
+        memory_storage, tmp_path, monkeypatch, access_headers):
+    queue = OrderQueue(str(tmp_path), flush_interval=60)
+    monkeypatch.setattr(ingestion, 'order_queue', queue)
+    Menu().add_menu_item({'item': 'tea', 'unit': 'cup', 'rate': 500})
+    client = app.test_client()
+    for customer, quantity, error in [
+        ('yondu', 1e37, 'Item 1: Item quantity can be at most 1000!'),
+        ('yondu', 1e-40, 'Item 1: quantity is out of the range that can be stored!'),
+        ('y' * 81, 1, 'Customer name can be at most 80 characters!')
+    ]:
+        order = {'items': [{'item': 'tea', 'quantity': quantity}]}
+        response = client.post('/api/v1/users/orders', json=order, headers=access_headers(customer))
+        assert response.status_code == 400
+        assert response.get_json()['error'].startswith(error)
+    queue.close()
+    assert queue.flushed == queue.rejected == 0 and memory_storage.list_orders() == []
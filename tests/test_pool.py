@@ -0,0 +1,95 @@
+import pytest, os
+from psycopg2 import extensions
+from fastfoodfast.pool import ConnectionPool, PoolTimeout
+
+
+class FakeConnection:
+    """Stands in for a psycopg2 connection so that the pool can be tested without a database"""
+    def __init__(self, dsn):
+        self.dsn = dsn
+        self.closed = 0
+        self.rollbacks = 0
+        self.status = extensions.TRANSACTION_STATUS_IDLE
+
+    def get_transaction_status(self):
+        return self.status
+
+    def rollback(self):
+        self.rollbacks += 1
+        self.status = extensions.TRANSACTION_STATUS_IDLE
+
+    def close(self):
+        self.closed = 1
+
+
+def create_pool(**options):
+    opened = list()
+    def connect(dsn):
+        opened.append(FakeConnection(dsn))
+        return opened[-1]
+    return ConnectionPool('postgres://test', connect=connect, **options), opened
+
+
+def test_pool_reuses_returned_connections():
+    pool, opened = create_pool(min_size=0, max_size=2)
+    conn = pool.getconn()
+    pool.putconn(conn)
+    assert pool.getconn() is conn
+    assert len(opened) == 1
+
+
+def test_pool_opens_min_size_connections_on_first_checkout():
+    pool, opened = create_pool(min_size=3, max_size=5)
+    pool.getconn()
+    assert len(opened) == 3
+    assert pool.stats()['idle'] == 2 and pool.stats()['in-use'] == 1
+
+
+def test_pool_raises_timeout_when_exhausted():
+    pool, _ = create_pool(min_size=0, max_size=1, timeout=0.05)
+    pool.getconn()
+    with pytest.raises(PoolTimeout):
+        pool.getconn()
+    assert pool.stats()['timeouts'] == 1
+
+
+def test_pool_rolls_back_open_transactions_when_connection_is_returned():
+    pool, _ = create_pool(min_size=0, max_size=1)
+    conn = pool.getconn()
+    conn.status = extensions.TRANSACTION_STATUS_INTRANS
+    pool.putconn(conn)
+    assert conn.rollbacks == 1 and pool.getconn() is conn
+
+
+def test_pool_replaces_closed_connections_on_checkout():
+    pool, opened = create_pool(min_size=0, max_size=1)
+    conn = pool.getconn()
+    pool.putconn(conn)
+    conn.closed = 1 # e.g. the server restarted while the connection sat idle
+    assert pool.getconn() is not conn
+    assert len(opened) == 2 and pool.stats()['discarded'] == 1
+
+
+def test_pool_frees_slot_of_discarded_connection():
+    pool, _ = create_pool(min_size=0, max_size=1, timeout=0.05)
+    pool.putconn(pool.getconn(), discard=True)
+    assert pool.getconn() is not None
+    assert pool.stats()['size'] == 1
+
+
+def test_pool_does_not_reuse_connections_inherited_across_fork():
+    pool, opened = create_pool(min_size=0, max_size=1)
+    conn = pool.getconn()
+    pool.putconn(conn)
+    pool._pid = os.getpid() + 1 # pretend the pool was created by a parent process
+    assert pool.getconn() is not conn
+    assert not conn.closed # the parent's socket must not be terminated by the child
+
+
+def test_pool_reports_checkout_statistics():
+    pool, _ = create_pool(min_size=0, max_size=2)
+    pool.putconn(pool.getconn())
+    pool.getconn()
+    stats = pool.stats()
+    assert stats['checkouts'] == 2 and stats['in-use'] == 1 and stats['waiting'] == 0
+    assert stats['checkout-latency-avg-ms'] >= 0
@@ -0,0 +1,180 @@
+import pytest
+from datetime import datetime, timezone
+from fastfoodfast import app, storage
+from fastfoodfast.models import Users, Orders, Menu
+
+
+def test_storage_backend_is_selected_by_configuration(monkeypatch):
+    monkeypatch.setattr(storage, '_storage', None)
+    monkeypatch.setenv('STORAGE_BACKEND', 'memory')
+    assert isinstance(storage.get_storage(), storage.MemoryStorage)
+    monkeypatch.setenv('STORAGE_BACKEND', 'postgres')
+    assert isinstance(storage.get_storage(), storage.PostgresStorage)
+    monkeypatch.setenv('STORAGE_BACKEND', 'sqlite')
+    with pytest.raises(ValueError):
+        storage.get_storage()
+
+
+def test_memory_storage_keeps_users(memory_storage):
+    users_model = Users()
+    user = {
+        'username': 'Loki', 'password': 'M1sch1ef',
+        'email': 'loki@asgard.avr', 'telephone': '+23-345-916921'
+    }
+    users_model.register_user(user)
+    with pytest.raises(Exception):
+        users_model.register_user(user)
+    assert users_model.check_password(users_model.get_user('Loki'), 'M1sch1ef')
+    assert not users_model.is_admin('Loki') and users_model.is_admin('admin')
+    with pytest.raises(Exception):
+        users_model.get_user('Odin')
+
+
+def test_memory_storage_lists_and_pages_orders_newest_first(memory_storage):
+    Menu().add_menu_item({'item': 'tea', 'unit': 'cup', 'rate': 500})
+    orders_model = Orders()
+    created = [
+        orders_model.create_order({'items': [{'item': 'tea', 'quantity': 1, 'cost': 500}]}, name)
+        for name in ['drax', 'mantis', 'drax', 'drax']
+    ]
+    history = orders_model.get_order_history('drax')
+    assert [order['order-id'] for order in history] == [
+        created[3]['order-id'], created[2]['order-id'], created[0]['order-id']
+    ]
+    assert history[0]['items'] == [{'item': 'tea', 'quantity': 1.0, 'cost': 500.0}]
+    page, cursor = orders_model.get_order_history_page('drax', 2)
+    assert len(page) == 2 and cursor is not None
+    page, cursor = orders_model.get_order_history_page('drax', 2, cursor)
+    assert page == history[2:] and cursor is None
+    assert len(orders_model.get_all_orders()) == 4
+    assert [order['customer'] for order in orders_model.stream_all_orders()] == [
+        'drax', 'drax', 'mantis', 'drax'
+    ]
+    results = orders_model.create_orders(
+        [{'items': [{'item': 'tea', 'quantity': 1, 'cost': 500}]}, {'items': []}], 'drax',
+        atomic=False
+    )
+    assert [result['created'] for result in results] == [True, False]
+    with pytest.raises(Exception):
+        orders_model.get_order_history('nebula')
+
+
+def test_memory_storage_updates_status_and_publishes_order_events(memory_storage):
+    Menu().add_menu_item({'item': 'tea', 'unit': 'cup', 'rate': 500})
+    orders_model = Orders()
+    order = orders_model.create_order(
+        {'items': [{'item': 'tea', 'quantity': 1, 'cost': 500}]}, 'yondu'
+    )
+    orders_model.update_order_status(order['order-id'], {'status': 'complete'})
+    orders_model.update_order_status(order['order-id'], {'status': 'complete'})
+    assert orders_model.get_specific_order(order['order-id'])['status'] == 'complete'
+    assert [(event['event'], event['status']) for event in storage.order_events.events] == [
+        ('created', 'new'), ('updated', 'complete')
+    ]
+    with pytest.raises(Exception):
+        orders_model.get_specific_order('missing')
+    with pytest.raises(Exception):
+        orders_model.update_order_status('missing', {'status': 'complete'})
+    other = orders_model.create_order({'items': [{'item': 'tea', 'quantity': 1}]}, 'yondu')
+    updated, skipped = orders_model.update_orders_status(
+        'processing', [order['order-id'], other['order-id'], 'missing'], 'new'
+    )
+    assert updated == [other['order-id']] and skipped == [order['order-id'], 'missing']
+    updated, _ = orders_model.update_orders_status('cancelled', from_status='processing')
+    assert updated == [other['order-id']]
+    today = datetime.now(timezone.utc).date()
+    report = orders_model.get_sales_report(today, today)
+    assert report['orders'] == 2 and report['revenue'] == 500
+    assert report['statuses'] == {'complete': 1, 'cancelled': 1}
+    assert report['top-items'] == [{'item': 'tea', 'quantity': 1.0, 'revenue': 500.0}]
+
+
+def test_memory_storage_keeps_menu_items_unique_and_versioned(memory_storage):
+    menu_model = Menu()
+    with pytest.raises(Exception):
+        menu_model.get_food_menu()
+    version = menu_model.read_version('menu')
+    item = menu_model.add_menu_item({'item': 'Katogo', 'unit': 'plate', 'rate': 4000})
+    with pytest.raises(Exception):
+        menu_model.add_menu_item({'item': 'KATOGO', 'unit': 'plate', 'rate': 4000})
+    other = menu_model.add_menu_item({'item': 'Luwombo', 'unit': 'pot', 'rate': 20000})
+    with pytest.raises(Exception):
+        menu_model.update_menu_item(other['id'], {'item': 'katogo', 'unit': 'pot', 'rate': 1})
+    menu_model.update_menu_item(item['id'], {'item': 'Katogo', 'unit': 'bowl', 'rate': 4500})
+    assert menu_model.get_specific_menu_item(item['id'])['unit'] == 'bowl'
+    assert [entry['item'] for entry in menu_model.get_food_menu()] == ['Katogo', 'Luwombo']
+    menu_model.delete_menu_item(other['id'])
+    with pytest.raises(Exception):
+        menu_model.delete_menu_item(other['id'])
+    assert menu_model.read_version('menu') == version + 4 # two adds, an update and a delete
+
+
+def test_api_runs_on_memory_storage(memory_storage):
+    client = app.test_client()
+    user = {
+        'username': 'Kraglin', 'password': 'Arr0ws',
+        'email': 'kraglin@ravager.sp', 'telephone': '+23-345-916922'
+    }
+    assert client.post('/api/v1/auth/signup', json=user).status_code == 201
+    token = client.post('/api/v1/auth/login', json=user).get_json()['token']
+    headers = {'Authorization': 'Bearer ' + token}
+    admin = {'username': 'admin', 'password': 'administrator'}
+    admin_token = client.post('/api/v1/auth/login', json=admin).get_json()['token']
+    admin_headers = {'Authorization': 'Bearer ' + admin_token}
+    response = client.post(
+        '/api/v1/menu', json={'item': 'fish', 'unit': 'plate', 'rate': 9000}, headers=admin_headers
+    )
+    assert response.status_code == 201
+    assert client.get('/api/v1/menu', headers=headers).get_json()['menu'][0]['item'] == 'fish'
+    order = {'items': [{'item': 'fish', 'quantity': 2}]}
+    response = client.post('/api/v1/users/orders', json=order, headers=headers)
+    assert response.get_json()['total-cost'] == 18000
+    history = client.get('/api/v1/users/orders', headers=headers).get_json()
+    assert [order['order-id'] for order in history['orders']] == [response.get_json()['order-id']]
+
+
+def test_api_lists_archived_orders_apart(memory_storage, access_headers):
+    Menu().add_menu_item({'item': 'fish', 'unit': 'plate', 'rate': 9000})
+    client = app.test_client()
+    headers = access_headers('Kraglin')
+    placed = [
+        client.post(
+            '/api/v1/users/orders', json={'items': [{'item': 'fish', 'quantity': quantity}]},
+            headers=headers
+        ).get_json()['order-id']
+        for quantity in (1, 2, 3)
+    ]
+    Orders().update_orders_status('complete', order_ids=placed[:2])
+    assert Orders().archive_orders(days=1) == 0 # placed just now
+    assert Orders().archive_orders(days=0) == 2
+    history = client.get('/api/v1/users/orders', headers=headers).get_json()
+    assert [order['order-id'] for order in history['orders']] == placed[2:]
+    archived = client.get('/api/v1/users/orders?archived=true&limit=1', headers=headers).get_json()
+    assert [order['order-id'] for order in archived['orders']] == [placed[1]]
+    archived = client.get(
+        '/api/v1/users/orders?archived=true&cursor=' + archived['next-cursor'], headers=headers
+    ).get_json()
+    assert [order['order-id'] for order in archived['orders']] == [placed[0]]
+    response = client.get('/api/v1/users/orders?archived=yes', headers=headers)
+    assert response.status_code == 400
+    assert Orders().get_specific_order(placed[0])['total-cost'] == 9000
+
+
+def test_api_refuses_orders_costing_more_than_can_be_stored(memory_storage, access_headers):
+    Menu().add_menu_item({'item': 'caviar', 'unit': 'tin', 'rate': 4 * 10 ** 6})
+    client = app.test_client()
+    headers = access_headers('Taserface')
+    for quantity, error in [
+        (1e308, 'Item 1: Item quantity can be at most 1000!'),
+        (300, 'Item 1: cost can be at most 1000000000!')
+    ]:
+        order = {'items': [{'item': 'caviar', 'quantity': quantity}]}
+        response = client.post('/api/v1/users/orders', json=order, headers=headers)
+        assert response.status_code == 400 and response.get_json()['error'] == error
+    order = {'items': [{'item': 'caviar', 'quantity': 200}] * 2}
+    response = client.post('/api/v1/users/orders', json=order, headers=headers)
+    assert response.status_code == 400
+    assert response.get_json()['error'] == 'Total cost can be at most 1000000000!'
+    assert memory_storage.list_orders() == []
+    today = datetime.now(timezone.utc).date()
+    assert Orders().get_sales_report(today, today)['revenue'] == 0
@@ -0,0 +1,64 @@
+import pytest
+from fastfoodfast.validation import Validation, ValidationError
+
+validator = Validation()
+
+
+def test_validator_returns_cleaned_order():
+    order = validator.validate_order(
+        {'items': [{'item': ' hot dog ', 'quantity': '2', 'cost': 15000}]}
+    )
+    assert order['items'] == [{'item': 'hot dog', 'quantity': 2.0, 'cost': 15000.0}]
+    order = validator.validate_order({'items': [{'item': 'tea', 'quantity': 1}]})
+    assert order['items'] == [{'item': 'tea', 'quantity': 1.0}] # costs come from the menu
+
+
+def test_validator_reports_every_error_in_an_order_at_once():
+    order = {
+        'items': [
+            {'item': 'pizza', 'quantity': 1, 'cost': 20000},
+            {'item': '3', 'quantity': 0, 'cost': 'free'},
+            'salad'
+        ]
+    }
+    with pytest.raises(ValidationError) as error:
+        validator.validate_order(order)
+    assert error.value.errors == [
+        'Item 2: Invalid item specified!', 'Item 2: Item quantity must be greater than zero!',
+        'Item 2: Specify item cost as a number!', 'Item 3: Specify order item as a dictionary!'
+    ]
+
+
+def test_validator_rejects_redundant_fields_and_non_numeric_values():
+    with pytest.raises(ValidationError):
+        validator.validate_order_item({'item': 'tea', 'quantity': 1, 'cost': 1, 'discount': 1})
+    with pytest.raises(ValidationError):
+        validator.validate_order_item({'item': 'tea', 'quantity': True, 'cost': float('nan')})
+
+
+def test_validator_reports_all_missing_registration_fields():
+    with pytest.raises(ValidationError) as error:
+        validator.validate_user_data({'username': 'Tony Stark'})
+    assert len(error.value.errors) == 3
+
+
+def test_validator_normalizes_status():
+    assert validator.validate_status_data({'status': ' Complete '}) == {'status': 'complete'}
+    with pytest.raises(ValidationError):
+        validator.validate_status_data({'status': 'eaten'})
+
+
+def test_validator_validates_menu_items():
+    item = validator.validate_menu_item({'item': ' Roast Chicken ', 'unit': 'Set', 'rate': '15000'})
+    assert item == {'item': 'Roast Chicken', 'unit': 'Set', 'rate': 15000.0}
+    with pytest.raises(ValidationError):
+        validator.validate_menu_item({'item': 'Hamburger', 'unit': 'Pack'})
+
+
+def test_validator_bounds_quantities_and_rates():
+    with pytest.raises(ValidationError) as error:
+        validator.validate_order({'items': [{'item': 'tea', 'quantity': 1001}]})
+    assert error.value.errors == ['Item 1: Item quantity can be at most 1000!']
+    assert validator.validate_order_item({'item': 'tea', 'quantity': 1000})['quantity'] == 1000
+    with pytest.raises(ValidationError):
+        validator.validate_menu_item({'item': 'Caviar', 'unit': 'tin', 'rate': 1e39})